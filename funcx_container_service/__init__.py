@@ -1,20 +1,29 @@
+import asyncio
 from uuid import uuid4
 from functools import lru_cache
+import json
+import os
 import tempfile
+from typing import Optional
 
 from logging.config import dictConfig
 import logging
 from .config import LogConfig
 
-from fastapi import (FastAPI, BackgroundTasks, Depends, Request, status)
+from fastapi import (FastAPI, Depends, Header, HTTPException, Request, status)
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 
-from .callback_router import build_callback_router
-from .build import background_build
+from . import callback_router
+from .buildlog import read_saved_log
+from .callback_router import build_callback_router, status_publisher
 from .container import Container
 from .models import ContainerSpec, BuildStatus
 from .config import Settings
+from .db import BuildStore
+from .scheduler import BuildScheduler, SchedulerClosed
+from .singularity import sif_converter
 from .version import container_service_version
 
 DOCKER_BASE_URL = 'unix://var/run/docker.sock'
@@ -26,6 +35,9 @@ app = FastAPI()
 
 RUN_ID = str(uuid4())
 
+# queued status updates still being sent, kept so they are not garbage collected
+queued_updates = set()
+
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -40,6 +52,23 @@ def get_settings():
     return Settings()
 
 
+@lru_cache()
+def get_build_store():
+    settings = get_settings()
+    db_url = settings.BUILD_DB_URL or f"sqlite:///{os.path.join(settings.CACHE_DIR, 'builds.db')}"
+    return BuildStore(db_url)
+
+
+@lru_cache()
+def get_scheduler():
+    settings = get_settings()
+    return BuildScheduler(max_concurrent_builds=settings.MAX_CONCURRENT_BUILDS,
+                          shutdown_timeout=settings.SHUTDOWN_TIMEOUT,
+                          build_store=get_build_store(),
+                          log_dir=settings.BUILD_LOG_DIR or os.path.join(settings.CACHE_DIR, 'logs'),
+                          recent_builds=settings.RECENT_BUILDS)
+
+
 @app.on_event("startup")
 async def startup_event():
     settings = get_settings()
@@ -49,19 +78,31 @@ async def startup_event():
     log.info(
         f"Username for container registry (from '.env' file): {settings.REGISTRY_USERNAME}")
     log.info(f"Build timeout (from '.env' file): {settings.BUILD_TIMEOUT}")
+    log.info(f"Concurrent builds (from '.env' file): {settings.MAX_CONCURRENT_BUILDS}")
+    scheduler = get_scheduler()
+    scheduler.start()
+    await scheduler.recover(RUN_ID, settings, DOCKER_BASE_URL)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    log.info("Shutting down funcx container service...")
+    await get_scheduler().shutdown()
+    await sif_converter.drain(get_settings().SHUTDOWN_TIMEOUT)
+    await status_publisher.aclose()
 
 
 @app.post("/build", callbacks=build_callback_router.routes)
 async def build_container_image(spec: ContainerSpec,
-                                tasks: BackgroundTasks,
-                                settings: Settings = Depends(get_settings)):
+                                settings: Settings = Depends(get_settings),
+                                scheduler: BuildScheduler = Depends(get_scheduler)):
     """
     Build a container based on a submitted JSON specification.
     Returns an ID that can be used to query container status.
     """
     log.info(f'container specification received for run_id {RUN_ID}')
 
-    temp_dir = tempfile.mkdtemp()
+    temp_dir = await run_in_threadpool(tempfile.mkdtemp)
 
     # instantiate container object
     container = Container(container_spec=spec,
@@ -69,20 +110,74 @@ async def build_container_image(spec: ContainerSpec,
                           settings=settings,
                           temp_dir=temp_dir,
                           DOCKER_BASE_URL=DOCKER_BASE_URL)
+    await run_in_threadpool(container.build_spec_to_file)
+
+    # the response does not wait on the webservice, whose retries can take
+    # minutes. The update is handed to the status publisher before the build
+    # can be picked up, so it is still sent ahead of the build's own updates.
+    container.build_spec.build_status = BuildStatus.queued
+    queued_update = asyncio.create_task(callback_router.update_status(container))
+    queued_updates.add(queued_update)
+    queued_update.add_done_callback(queued_updates.discard)
+
+    try:
+        queue_position = await scheduler.submit(container)
+    except SchedulerClosed as e:
+        await container.log_error(str(e))
+        await container.delete_temp_dir()
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
+    return {"container_id": str(container.container_spec.container_id),
+            "build_id": str(container.build_spec.build_id),
+            "RUN_ID": str(container.build_spec.RUN_ID),
+            "queue_position": queue_position}
+
+
+@app.get("/build/{build_id}")
+async def get_build_info(build_id: str, scheduler: BuildScheduler = Depends(get_scheduler)):
+    """
+    Report the queue position and time spent waiting for a build that is
+    queued or running on this server.
+    """
+    build_info = scheduler.build_info(build_id)
+    if build_info is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"build {build_id} is not queued or running on this server")
+    return build_info
 
-    tasks.add_task(background_build, container)
-
-    build_response = container.update_status(BuildStatus.queued)
-
-    # if build_response.status_code == 200:
-    if build_response.status_code:  # testing
-        return {"container_id": str(container.container_spec.container_id),
-                "build_id": str(container.build_spec.build_id),
-                "RUN_ID": str(container.build_spec.RUN_ID)}
 
-    else:
-        return {
-            "msg": f"webservice returned {build_response} when attempting to register the build"}
+@app.get("/build/{build_id}/logs")
+async def stream_build_logs(build_id: str,
+                            last_event_id: Optional[int] = Header(None),
+                            scheduler: BuildScheduler = Depends(get_scheduler)):
+    """
+    Stream the output of a build as server-sent events. A finished build's
+    whole saved log is sent; a build still in progress starts with the
+    lines still held in its log buffer and follows it from there.
+    Reconnecting clients can send the Last-Event-ID header to resume after
+    the last line they received.
+    """
+    start = last_event_id + 1 if last_event_id is not None else 0
+
+    lines = None
+    build_log = scheduler.build_log(build_id)
+    if build_log is None or build_log.closed:
+        log_path = scheduler.log_path(build_id)
+        if log_path is not None and await run_in_threadpool(os.path.isfile, log_path):
+            lines = iterate_in_threadpool(read_saved_log(log_path, start))
+    if lines is None and build_log is not None:
+        lines = build_log.follow(start)
+    if lines is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"no log for build {build_id} on this server")
+
+    async def events():
+        async for line_number, timestamp, stream, line in lines:
+            data = json.dumps({"time": timestamp, "stream": stream, "line": line})
+            yield f"id: {line_number}\ndata: {data}\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 @app.get("/")
@@ -0,0 +1,218 @@
+import io
+import logging
+import os
+import tarfile
+import time
+import zipfile
+
+import zstandard
+
+log = logging.getLogger("funcx_container_service")
+
+COPY_CHUNK_SIZE = 1024 * 1024
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class PayloadError(Exception):
+    pass
+
+
+class ByteBudget():
+
+    """
+    Running total of the bytes an extraction has declared and written,
+    raising PayloadError as soon as either passes the limit
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.declared = 0
+        self.written = 0
+
+    def declare(self, size, name):
+        self.declared += size
+        if self.declared > self.limit:
+            raise PayloadError(f'payload expands to more than {self.limit} bytes (at {name}) - not extracting it')
+
+    def spend(self, size):
+        self.written += size
+        if self.written > self.limit:
+            raise PayloadError(f'payload wrote more than {self.limit} bytes - extraction aborted')
+
+
+def extract_archive(path, dest, max_bytes, protected=()):
+    """
+    Extract a zip, tar, tar.gz, tar.bz2, tar.xz or tar.zst archive into
+    dest, streaming each member to disk in chunks. Extraction stops with a
+    PayloadError as soon as the archive declares or writes more than
+    max_bytes, or has a member that would land outside dest or on one of
+    the protected paths. Returns the number of bytes written.
+    """
+    budget = ByteBudget(max_bytes)
+    protected = {os.path.realpath(p) for p in (path, *protected)}
+    for info, src in archive_members(path, budget):
+        target = member_path(dest, info.name)
+        if target in protected:
+            raise PayloadError(f'archive member {info.name} would overwrite {target}')
+        if info.isdir():
+            os.makedirs(target, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if info.issym():
+            os.symlink(info.linkname, target)
+        elif info.islnk():
+            os.link(member_path(dest, info.linkname), target)
+        else:
+            with open(target, 'wb') as dst:
+                copy_limited(src, dst, budget)
+            os.chmod(target, (info.mode & 0o777) | 0o600)
+    return budget.written
+
+
+def context_stream(payload_path, files, max_bytes):
+    """
+    Yield a docker build context as an uncompressed tar stream, a chunk at
+    a time: the members of the payload archive (if any) followed by files,
+    a dict of generated file names and contents that take the place of any
+    payload members with the same names. Payload members are copied across
+    without touching the disk, under the same max_bytes budget and name
+    checks as extract_archive.
+    """
+    budget = ByteBudget(max_bytes)
+    if payload_path is not None:
+        for info, src in archive_members(payload_path, budget):
+            if os.path.normpath(info.name) in files:
+                log.info(f'payload member {info.name} replaced by the generated file')
+                continue
+            yield from tar_member(info, src, budget)
+
+    for name, data in files.items():
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        yield from tar_member(info, io.BytesIO(data), None)
+
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def tar_member(info, src, budget):
+    yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+    if src is None:
+        return
+
+    copied = 0
+    while True:
+        chunk = src.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        if budget is not None:
+            budget.spend(len(chunk))
+        copied += len(chunk)
+        yield chunk
+
+    if copied != info.size:
+        raise PayloadError(f'archive member {info.name} is truncated')
+    remainder = info.size % tarfile.BLOCKSIZE
+    if remainder:
+        yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+
+def archive_members(path, budget):
+    """
+    Yield (TarInfo, file object) for each directory, regular file and link
+    of a zip or tar archive, in archive order. The file object is None for
+    anything but a regular file and is only valid until the next member is
+    requested. Declared sizes are charged to budget, and names and link
+    targets that would escape the archive root raise PayloadError.
+    """
+    if zipfile.is_zipfile(path):
+        log.debug(f'reading zip archive {path}')
+        yield from zip_members(path, budget)
+        return
+
+    with open(path, 'rb') as f:
+        is_zstd = f.read(len(ZSTD_MAGIC)) == ZSTD_MAGIC
+
+    if is_zstd:
+        log.debug(f'reading tar.zst archive {path}')
+        with open(path, 'rb') as raw, zstandard.ZstdDecompressor().stream_reader(raw) as reader:
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                yield from tar_members(tar, budget)
+        return
+
+    try:
+        tar = tarfile.open(path, mode='r|*')
+    except tarfile.ReadError:
+        raise PayloadError('payload is not an acceptable archive format (zip, tar, tar.gz, tar.bz2, tar.xz '
+                           'or tar.zst)')
+    log.debug(f'reading tar archive {path}')
+    with tar:
+        yield from tar_members(tar, budget)
+
+
+def zip_members(path, budget):
+    with zipfile.ZipFile(path) as zip_obj:
+        infos = zip_obj.infolist()
+        # the central directory declares every size up front
+        for info in infos:
+            budget.declare(info.file_size, info.filename)
+
+        for info in infos:
+            check_name(info.filename)
+            member = tarfile.TarInfo(info.filename)
+            member.mtime = int(time.mktime(info.date_time + (0, 0, -1)))
+            member.mode = (info.external_attr >> 16) & 0o777 or 0o644
+            if info.is_dir():
+                member.type = tarfile.DIRTYPE
+                member.mode |= 0o700
+                yield member, None
+                continue
+            member.size = info.file_size
+            with zip_obj.open(info) as src:
+                yield member, src
+
+
+def tar_members(tar, budget):
+    # a streamed tar reveals each member's size as it is reached
+    for member in tar:
+        check_name(member.name)
+        if member.isfile():
+            budget.declare(member.size, member.name)
+            yield member, tar.extractfile(member)
+        elif member.isdir():
+            yield member, None
+        elif member.issym():
+            check_name(os.path.join(os.path.dirname(member.name), member.linkname))
+            yield member, None
+        elif member.islnk():
+            check_name(member.linkname)
+            yield member, None
+        else:
+            log.info(f'skipping special file {member.name} in payload')
+
+
+def check_name(name):
+    normalized = os.path.normpath(name)
+    if os.path.isabs(normalized) or normalized == '..' or normalized.startswith('../'):
+        raise PayloadError(f'archive member {name} would be extracted outside the build directory')
+
+
+def member_path(dest, name):
+    """
+    Where an archive member belongs under dest, refusing names that would
+    escape it
+    """
+    dest = os.path.realpath(dest)
+    target = os.path.realpath(os.path.join(dest, name))
+    if os.path.commonpath([dest, target]) != dest:
+        raise PayloadError(f'archive member {name} would be extracted outside the build directory')
+    return target
+
+
+def copy_limited(src, dst, budget):
+    while True:
+        chunk = src.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            return
+        budget.spend(len(chunk))
+        dst.write(chunk)
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+
+from docker.errors import APIError, ImageNotFound
+from fastapi.concurrency import run_in_threadpool
+
+from .docker_pool import docker_clients, registry_auth, cli_docker_host
+from .dockerfile import BASE_IMAGE_VERSION, emit_base
+
+log = logging.getLogger("funcx_container_service")
+
+
+class BaseImageError(Exception):
+    pass
+
+
+def base_image_repository(settings):
+    if settings.REGISTRY_USERNAME:
+        return f'{settings.REGISTRY_USERNAME}/{settings.BASE_IMAGE_NAME}'
+    return settings.BASE_IMAGE_NAME
+
+
+class BaseImages():
+
+    """
+    Makes sure the image built from dockerfile.HEADER is available on a
+    docker daemon before a spec is built on top of it. The image is tagged
+    with BASE_IMAGE_VERSION, a digest of the HEADER text, so a change to
+    HEADER yields a new base image rather than a stale one.
+
+    The first build on a daemon looks for the image locally, then tries to
+    pull it from the registry, and only builds it (and pushes it for other
+    nodes) when neither has it. Builds that need the image while it is being
+    prepared wait for that instead of building it again.
+    """
+
+    def __init__(self):
+        self._ready = set()
+        self._locks = {}
+
+    def _lock(self, key):
+        if key not in self._locks:
+            self._locks[key] = asyncio.Lock()
+        return self._locks[key]
+
+    async def ensure(self, container):
+        """
+        Return the name of the base image, making it available on the
+        container's docker daemon first. Raises BaseImageError if it can be
+        neither found nor built.
+        """
+        settings = container.settings
+        repository = base_image_repository(settings)
+        image_name = f'{repository}:{BASE_IMAGE_VERSION}'
+        key = (container.DOCKER_BASE_URL, image_name)
+
+        if key in self._ready:
+            return image_name
+
+        async with self._lock(key):
+            if key in self._ready:
+                return image_name
+
+            docker_client = await run_in_threadpool(docker_clients.get, container.DOCKER_BASE_URL)
+            if await run_in_threadpool(image_present, docker_client, image_name):
+                log.info(f'using base image {image_name}')
+            elif settings.REGISTRY_USERNAME and await run_in_threadpool(pull_base_image, docker_client,
+                                                                        settings, repository):
+                log.info(f'pulled base image {image_name} from the registry')
+            else:
+                await build_base_image(container, image_name)
+                if settings.REGISTRY_USERNAME:
+                    await run_in_threadpool(push_base_image, docker_client, settings, repository)
+
+            self._ready.add(key)
+        return image_name
+
+
+def image_present(docker_client, image_name):
+    try:
+        docker_client.inspect_image(image_name)
+        return True
+    except ImageNotFound:
+        return False
+
+
+def pull_base_image(docker_client, settings, repository):
+    auth_dict = {'username': settings.REGISTRY_USERNAME,
+                 'password': settings.REGISTRY_PWD}
+    try:
+        docker_client.pull(repository, tag=BASE_IMAGE_VERSION, auth_config=auth_dict)
+    except APIError as e:
+        log.info(f'base image {repository}:{BASE_IMAGE_VERSION} not in the registry: {e}')
+        return False
+    return image_present(docker_client, f'{repository}:{BASE_IMAGE_VERSION}')
+
+
+def push_base_image(docker_client, settings, repository):
+    """
+    Publish a freshly built base image so other nodes can pull it. A failed
+    push only costs those nodes a build, so it is logged rather than raised.
+    """
+    response = registry_auth.login(docker_client,
+                                   username=settings.REGISTRY_USERNAME,
+                                   password=settings.REGISTRY_PWD,
+                                   registry=settings.REGISTRY_URL)
+    if response.get('Status') != 'Login Succeeded':
+        log.warning(f'could not log in to push base image {repository}:{BASE_IMAGE_VERSION}')
+        return
+
+    auth_dict = {'username': settings.REGISTRY_USERNAME,
+                 'password': settings.REGISTRY_PWD}
+    for line in docker_client.push(repository, tag=BASE_IMAGE_VERSION, stream=True, decode=True,
+                                   auth_config=auth_dict):
+        if 'error' in line:
+            log.warning(f'push of base image {repository}:{BASE_IMAGE_VERSION} failed: {line["error"]}')
+            return
+    log.info(f'pushed base image {repository}:{BASE_IMAGE_VERSION}')
+
+
+async def build_base_image(container, image_name):
+    """
+    Build the base image from HEADER with BuildKit, in a build context of
+    its own that holds nothing but the Dockerfile. Output goes to the build
+    log of the container that triggered the build.
+    """
+    log.info(f'building base image {image_name}')
+    context_dir = await run_in_threadpool(write_base_context)
+    cmd = [container.settings.DOCKER_PATH or 'docker', 'build', '--progress=plain', '--tag', image_name, context_dir]
+    try:
+        process = await asyncio.create_subprocess_exec(*cmd,
+                                                       env={**os.environ,
+                                                            "DOCKER_BUILDKIT": "1",
+                                                            "DOCKER_HOST": cli_docker_host(container.DOCKER_BASE_URL)},
+                                                       stdout=subprocess.PIPE,
+                                                       stderr=subprocess.PIPE,
+                                                       start_new_session=True)
+
+        build_log = container.build_log
+        try:
+            await asyncio.wait_for(asyncio.gather(build_log.consume(process.stdout, 'stdout'),
+                                                  build_log.consume(process.stderr, 'stderr'),
+                                                  process.wait()),
+                                   timeout=container.build_timeout)
+        except asyncio.TimeoutError:
+            os.killpg(process.pid, signal.SIGTERM)
+            raise BaseImageError(f'base image build timed out after {container.build_timeout}s')
+
+        if process.returncode != 0:
+            raise BaseImageError(f'base image build failed with return code {process.returncode}')
+    finally:
+        await run_in_threadpool(shutil.rmtree, context_dir, True)
+
+
+def write_base_context():
+    context_dir = tempfile.mkdtemp()
+    with open(os.path.join(context_dir, 'Dockerfile'), 'w') as f:
+        f.write(emit_base())
+    return context_dir
+
+
+base_images = BaseImages()
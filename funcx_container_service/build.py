@@ -1,5 +1,8 @@
+import asyncio
+import json
 import logging
 import os
+import re
 import signal
 import subprocess
 import sys
@@ -7,10 +10,17 @@ import time
 
 import docker
 from docker.errors import ImageNotFound
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
 
+from .archive import PayloadError, context_stream
+from .cache import ImageCache, LayerIndex, LockStore, PackageCache, spec_packages
 from .config import Settings
 from .container import Container, BuildStatus
-from .models import CompletionSpec, BuildType
+from .base_image import base_images, BaseImageError
+from .docker_pool import docker_clients, cli_docker_host
+from .dockerfile import BASE_IMAGE_VERSION, LOCK_CONTEXT, LOCK_DIR, emit_dockerfile, layer_keys, plan_layers
+from .models import CompletionSpec, BuildBackend, BuildType, ContainerRuntime
+from .singularity import sif_converter
 
 settings = Settings()
 
@@ -19,43 +29,96 @@ if settings.REPO2DOCKER_PATH:
 else:
     r2d_path = 'jupyter-repo2docker'
 
-REPO2DOCKER_CMD = f'{r2d_path} --no-run --image-name {{}} {{}}'
-SINGULARITY_CMD = 'singularity build --force {} docker-daemon://{}:latest'
+REPO2DOCKER_CMD = [r2d_path, '--no-run', '--image-name']
+DOCKER_BUILD_CMD = [settings.DOCKER_PATH or 'docker', 'build', '--progress=plain']
+
+# build output marking the start and end of a conda environment solve
+SOLVE_START = re.compile(r'Collecting package metadata|RUN .*micromamba install')
+SOLVE_END = re.compile(r'Solving environment: .*done|\bTransaction\s*$')
+
+# reads the solved environment back out of a built image
+LOCK_SEPARATOR = '----- pip freeze -----'
+LOCK_SCRIPT = (f'conda list -p "$NB_PYTHON_PREFIX" --explicit && echo "{LOCK_SEPARATOR}" && '
+               f'"$KERNEL_PYTHON_PREFIX/bin/pip" freeze')
+LOCK_TIMEOUT = 120
+
+image_cache = ImageCache(os.path.join(settings.CACHE_DIR, 'image_index.json'))
+layer_index = LayerIndex(os.path.join(settings.CACHE_DIR, 'layer_index.json'))
+package_cache = PackageCache(settings.PACKAGE_CACHE_SIZE)
+lock_store = LockStore(os.path.join(settings.CACHE_DIR, 'locks'))
 
 log = logging.getLogger("funcx_container_service")
 
 
-def background_build(container: Container):
+async def background_build(container: Container):
     """
     Build processes passed to a task through route activation.
     Start by checking state of build from the webservice. If status is
     appropriate (as indicated by container.start_build()) proceed to construct
     the container using repo2docker, push image to specified registry,
-    and update webservice upon successful completion
+    and update webservice upon successful completion. Blocking docker and
+    filesystem work is handed to the threadpool so the event loop stays free.
 
     :param Container container: The Container object instance
     """
     try:
         if container.container_spec:
 
-            container.update_status(BuildStatus.building)
-            container.update_build_type()
-
-            docker_client = docker.APIClient(base_url=container.DOCKER_BASE_URL)
-
-            repo2docker_build(container, docker_client.version())
-            # push container to registry
-            container_push_start_time = time.time()
-            container.push_image()
-            container_push_end_time = time.time()
-
-            container_push_time = container_push_end_time - container_push_start_time
-            log.info(f'Time to push container to repository: {container_push_time}s.')
-            container.completion_spec.container_push_time = container_push_time
-
-            completion_response = container.update_status(BuildStatus.ready)
-
-            log.info(f'Build process complete - finished with: {completion_response}')
+            await container.update_status(BuildStatus.building)
+            await container.update_build_type()
+            if container.build_spec.build_status == BuildStatus.failed:
+                return
+
+            docker_client = await run_in_threadpool(docker_clients.get, container.DOCKER_BASE_URL)
+            docker_client_version = await run_in_threadpool(docker_clients.version, container.DOCKER_BASE_URL)
+
+            # only specs without a payload are fully described by their digest
+            digest = container.container_spec.digest()
+            cacheable = container.build_type == BuildType.container
+
+            cache_hit = False
+            solved = None
+            if cacheable and not container.container_spec.force_solve:
+                cache_hit = await run_in_threadpool(reuse_cached_image, container, docker_client,
+                                                    docker_client_version, digest)
+
+            if not cache_hit:
+                # github sources are only understood by repo2docker
+                if (container.settings.BUILD_BACKEND == BuildBackend.docker
+                        and container.build_type != BuildType.github):
+                    backend = BuildBackend.docker
+                else:
+                    backend = BuildBackend.repo2docker
+
+                # github repos bring their own environment
+                lock = None
+                if container.build_type != BuildType.github and not container.container_spec.force_solve:
+                    lock = await run_in_threadpool(lock_store.lookup, container.container_spec, backend)
+
+                incremental = None
+                if backend == BuildBackend.docker and cacheable and not container.container_spec.force_solve:
+                    incremental = await run_in_threadpool(find_incremental_base, container, docker_client)
+
+                if backend == BuildBackend.docker:
+                    await docker_build(container, docker_client_version, lock, incremental)
+                else:
+                    await repo2docker_build(container, docker_client_version, lock)
+                if container.build_spec.build_status == BuildStatus.failed:
+                    return
+                if cacheable:
+                    await run_in_threadpool(record_cached_image, container, docker_client, digest)
+                if container.build_type != BuildType.github:
+                    solved = (backend, lock)
+
+            container.completion_spec.spec_digest = digest
+            container.completion_spec.payload_digest = container.payload_digest
+            container.completion_spec.payload_cache_hit = container.payload_cache_hit
+
+            await publish_image(container)
+
+            # read back once the image is out, so the push and ready status don't wait on it
+            if solved is not None:
+                await store_lock(container, docker_client, *solved)
 
         else:
             err_msg = "Container spec not present!"
@@ -66,26 +129,29 @@ def background_build(container: Container):
 
         err_msg = f'Exception raised trying to instantiate docker client: {sys.exc_info()} - \
                   is docker running and accessible?'
-        container.log_error(err_msg)
+        await container.log_error(err_msg)
 
     except Exception as e:
         log.exception(e)
         err_msg = f'Exception during background build: {sys.exc_info()}'
-        container.log_error(err_msg)
+        await container.log_error(err_msg)
 
     finally:
-        container.delete_temp_dir()
+        await container.delete_temp_dir()
 
 
-def repo2docker_build(container, docker_client_version):
+async def repo2docker_build(container, docker_client_version, lock=None):
     """
     Pass the file with the build specs to repo2docker to create the build and
-    collect the resulting log information.
+    collect the resulting log information. With a lock, the environment is
+    pinned to the locked packages.
     """
-    repo2docker_start_time = time.time()
-
     source = None
 
+    if lock is not None:
+        log.info(f"pinning environment to the lock of spec digest {lock['digest']}")
+        await run_in_threadpool(write_locked_environment, container, lock)
+
     if container.build_type == BuildType.github:
         log.info('building container image from github repo')
         source = container.container_spec.payload_url
@@ -93,56 +159,217 @@ def repo2docker_build(container, docker_client_version):
         log.info('building container image by downloading source')
         source = container.temp_dir
 
-    cmd = REPO2DOCKER_CMD.format(container.image_name, source)
+    cmd = REPO2DOCKER_CMD + [container.image_name, source]
+    await run_build_process(container, cmd, docker_client_version, BuildBackend.repo2docker)
+    if container.completion_spec is not None and lock is not None:
+        container.completion_spec.lockfile_digest = lock['digest']
+
+
+async def docker_build(container, docker_client_version, lock=None, incremental=None):
+    """
+    Build the image straight from the Dockerfile generated by
+    dockerfile.emit_dockerfile, using BuildKit, without going through
+    repo2docker. A payload build streams its context to docker build as a
+    tar of the generated files and the payload's members, so the payload
+    is never extracted; otherwise the temp dir is the build context. With a
+    lock, conda and pip install the locked packages without solving,
+    mounting the lock from a build context of its own. With an incremental base (an image cache entry), the build
+    starts from that image and only installs the packages it lacks.
+    """
+    log.info('building container image from generated Dockerfile')
+
+    packages = spec_packages(container.container_spec)
+    base_image = None
+    if incremental is not None:
+        base_image = incremental['image_name']
+        packages = {manager: [pkg for pkg in pkgs if pkg not in incremental['packages'][manager]]
+                    for manager, pkgs in packages.items()}
+        log.info(f'building {container.image_name} on {base_image}, adding {packages}')
+    elif container.settings.USE_BASE_IMAGE:
+        try:
+            base_image = await base_images.ensure(container)
+        except BaseImageError as e:
+            log.warning(f'{e} - building {container.image_name} from the full Dockerfile')
+
+    context = None
+    if container.streams_build_context:
+        files = await run_in_threadpool(context_files, container, base_image, lock, packages)
+        context = context_stream(container.payload_path, files, container.settings.MAX_PAYLOAD_SIZE)
+    else:
+        await run_in_threadpool(write_dockerfile, container, base_image, lock, packages)
+    lock_digest = lock['digest'] if lock is not None else None
+    build_contexts = []
+    if lock is not None:
+        lock_dir = await run_in_threadpool(write_lock, container, lock)
+        build_contexts = ['--build-context', f'{LOCK_CONTEXT}={lock_dir}']
+
+    # the build cache belongs to the daemon, so layers are tracked per daemon
+    cache_mounts = container.settings.PACKAGE_CACHE
+    keys = layer_keys(plan_layers(packages['apt'], packages['conda'], packages['pip']),
+                      f'{container.DOCKER_BASE_URL} {base_image or BASE_IMAGE_VERSION}', cache_mounts,
+                      container.settings.CONDA_SOLVER, lock_digest, container.settings.MICROMAMBA_VERSION)
+    hit_ratio = await run_in_threadpool(layer_index.hit_ratio, keys)
+    if hit_ratio is not None:
+        log.info(f'{container.image_name}: expecting {hit_ratio:.0%} of {len(keys)} package layers from cache')
+
+    cmd = DOCKER_BUILD_CMD + build_contexts + ['--tag', container.image_name,
+                                               '-' if context is not None else container.temp_dir]
+    await run_build_process(container, cmd, docker_client_version, BuildBackend.docker,
+                            env={"DOCKER_BUILDKIT": "1",
+                                 "DOCKER_HOST": cli_docker_host(container.DOCKER_BASE_URL)},
+                            stdin=context)
+    if container.completion_spec is not None:
+        container.completion_spec.base_image = base_image
+        container.completion_spec.layer_cache_hit_ratio = hit_ratio
+        container.completion_spec.conda_solver = container.settings.CONDA_SOLVER
+        container.completion_spec.lockfile_digest = lock_digest
+        if incremental is not None:
+            container.completion_spec.incremental_base_image = base_image
+            container.completion_spec.incremental_time_saved = incremental.get('build_time')
+    if container.build_spec.build_status != BuildStatus.failed:
+        await run_in_threadpool(layer_index.record, keys)
+
+    if cache_mounts:
+        lines = [line for _, _, line in container.build_log.lines_since(container.build_output_start)]
+        hits, misses = package_cache.count(lines)
+        log.info(f'{container.image_name}: {hits} package cache hits, {misses} misses '
+                 f'({package_cache.hits} hits, {package_cache.misses} misses on this node)')
+        if container.completion_spec is not None:
+            container.completion_spec.package_cache_hits = hits
+            container.completion_spec.package_cache_misses = misses
+        docker_client = await run_in_threadpool(docker_clients.get, container.DOCKER_BASE_URL)
+        await run_in_threadpool(package_cache.evict, docker_client)
+
+
+def write_dockerfile(container, base_image=None, lock=None, packages=None):
+    for name, data in context_files(container, base_image, lock, packages).items():
+        path = os.path.join(container.temp_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+def write_lock(container, lock):
+    """
+    Write a lock's conda and pip lines to LOCK_DIR in the temp dir, which
+    the build mounts as the LOCK_CONTEXT build context, and return its path
+    """
+    lock_dir = os.path.join(container.temp_dir, LOCK_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    for name in ('conda', 'pip'):
+        with open(os.path.join(lock_dir, f'{name}.txt'), 'w') as f:
+            f.writelines(line + '\n' for line in lock[name])
+    return lock_dir
+
+
+def context_files(container, base_image=None, lock=None, packages=None):
+    """
+    The generated files of a native build context, keyed by their path in
+    the context
+    """
+    packages = packages or spec_packages(container.container_spec)
+    files = {}
+    files['Dockerfile'] = emit_dockerfile(packages['apt'], packages['conda'], packages['pip'],
+                                          copy_context=container.build_type == BuildType.payload,
+                                          base_image=base_image,
+                                          cache_mounts=container.settings.PACKAGE_CACHE,
+                                          conda_solver=container.settings.CONDA_SOLVER,
+                                          micromamba_version=container.settings.MICROMAMBA_VERSION,
+                                          lock=lock['digest'] if lock is not None else None).encode()
+    files['.dockerignore'] = f'Dockerfile\n.dockerignore\n{LOCK_DIR}\n'.encode()
+    return files
+
+
+async def run_build_process(container, cmd, docker_client_version, backend, env=None, stdin=None):
+    """
+    Run a build command, reading its output line by line into the container's
+    bounded build log as it is produced, and record the result in the
+    container's CompletionSpec. stdin, if given, is an iterator of byte
+    chunks fed to the process as it reads them.
+    """
+    build_start_time = time.time()
 
     try:
-        process = subprocess.Popen(cmd,
-                                   env={"DOCKER_HOST": container.DOCKER_BASE_URL},
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE,
-                                   start_new_session=True,
-                                   shell=True)
-
-        log.info(f'Starting build subprocess with PID {os.getpgid(process.pid)} \
+        process = await asyncio.create_subprocess_exec(*cmd,
+                                                       env={**os.environ,
+                                                            "DOCKER_HOST": container.DOCKER_BASE_URL,
+                                                            **(env or {})},
+                                                       stdin=subprocess.PIPE if stdin is not None else None,
+                                                       stdout=subprocess.PIPE,
+                                                       stderr=subprocess.PIPE,
+                                                       start_new_session=True)
+
+        log.info(f'Starting {backend.value} build subprocess with PID {os.getpgid(process.pid)} \
                  with timeout of {container.build_timeout} seconds')
 
-        # after lots of investigation, it looks like repo2docker only communicates on stderr
-        stdout_msg, stderr_msg = process.communicate(timeout=container.build_timeout)
-
-        # await process.wait()
+        # the process leads its own session, so its pid is also its process group
+        container.build_pid = process.pid
+        await container.save_state()
 
-        repo2docker_end_time = time.time()
+        # after lots of investigation, it looks like repo2docker only communicates on stderr
+        build_log = container.build_log
+        # the log may already hold other output, such as a base image build
+        container.build_output_start = build_log.total_lines
+        steps = [build_log.consume(process.stdout, 'stdout'),
+                 build_log.consume(process.stderr, 'stderr'),
+                 process.wait()]
+        if stdin is not None:
+            steps.append(feed_stdin(process.stdin, stdin))
+        try:
+            await asyncio.wait_for(asyncio.gather(*steps), timeout=container.build_timeout)
+        except asyncio.TimeoutError:
+            raise subprocess.TimeoutExpired(cmd, container.build_timeout)
+        except PayloadError as e:
+            await stop_process(process)
+            await container.log_error(f'streaming the build context failed: {e}')
+            return
+        except Exception:
+            # e.g. a corrupt archive or a failed read while feeding the context
+            await stop_process(process)
+            raise
+
+        build_end_time = time.time()
+
+        if build_log.dropped_lines:
+            log.info(f'build log for {container.image_name} kept the last {len(build_log.lines)} '
+                     f'of {build_log.total_lines} lines')
 
         if process.returncode != 0:
 
-            docker_err_msg = ' '.join(stderr_msg.decode().splitlines())
+            docker_err_msg = build_log.text(stream='stderr')
 
             container.completion_spec = CompletionSpec(repo2docker_return_code=process.returncode,
                                                        docker_client_version=str(docker_client_version),
-                                                       repo2docker_stderr=docker_err_msg)
+                                                       repo2docker_stderr=docker_err_msg,
+                                                       build_backend=backend)
 
             err_msg = f'Return code {process.returncode} produced while running \
-                        repo2docker for container_id: {container.container_spec.container_id}\n' \
-                      f'REPO2DOCKER returned: {docker_err_msg}'
+                        {backend.value} for container_id: {container.container_spec.container_id}\n' \
+                      f'{backend.value.upper()} returned: {docker_err_msg}'
 
-            container.log_error(err_msg)
+            await container.log_error(err_msg)
 
         else:
 
-            out_msg = ' '.join(stderr_msg.decode().splitlines())
+            out_msg = build_log.text(stream='stderr')
+            container_size = await run_in_threadpool(docker_size, container)
 
             container.completion_spec = CompletionSpec(repo2docker_return_code=process.returncode,
                                                        docker_client_version=str(docker_client_version),
-                                                       container_size=docker_size(container),
-                                                       repo2docker_stdout=out_msg)
+                                                       container_size=container_size,
+                                                       repo2docker_stdout=out_msg,
+                                                       build_backend=backend)
 
-            container_build_time = repo2docker_end_time - repo2docker_start_time
+            container_build_time = build_end_time - build_start_time
             container.completion_spec.container_build_time = container_build_time
             log.info(f'Time to build container on server: {container_build_time}s.')
 
-            log.info(f'REPO2DOCKER: {out_msg}')
+            solve_time = conda_solve_time(build_log.lines_since(container.build_output_start))
+            container.completion_spec.solve_time = solve_time
+            if solve_time is not None:
+                log.info(f'Time to solve conda environment: {solve_time}s.')
 
-            # container.update_status(BuildStatus.ready)
+            log.info(f'{backend.value.upper()}: {out_msg}')
 
             log.info('Build process complete!')
 
@@ -151,8 +378,259 @@ def repo2docker_build(container, docker_client_version):
         raise e
 
 
+async def stop_process(process):
+    """
+    Kill a build's process group and reap the process
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    await process.wait()
+
+
+async def feed_stdin(writer, chunks):
+    """
+    Write chunks to a subprocess's stdin, reading them in the threadpool.
+    A process that exits early reports its own failure, so a broken pipe
+    just stops the feed.
+    """
+    try:
+        async for chunk in iterate_in_threadpool(chunks):
+            writer.write(chunk)
+            await writer.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        log.warning('build process stopped reading its build context')
+    finally:
+        writer.close()
+
+
+def write_locked_environment(container, lock):
+    """
+    Rewrite environment.yml for repo2docker with every package pinned to
+    its locked version and build
+    """
+    env_content = container.env_from_spec(container.container_spec)
+    env_content["dependencies"] = [conda_lock_spec(line) for line in lock['conda']
+                                   if not line.startswith(('#', '@'))]
+    if lock['pip']:
+        env_content["dependencies"].append({"pip": list(lock['pip'])})
+    with open(os.path.join(container.temp_dir, 'environment.yml'), 'w') as f:
+        json.dump(env_content, f, indent=4)
+
+
+def conda_lock_spec(url):
+    """
+    'https://.../linux-64/numpy-1.21.0-py37h038b26d_0.tar.bz2#md5' -> 'numpy=1.21.0=py37h038b26d_0'
+    """
+    filename = url.split('#')[0].rsplit('/', 1)[-1]
+    for suffix in ('.tar.bz2', '.conda'):
+        if filename.endswith(suffix):
+            filename = filename[:-len(suffix)]
+    return '='.join(filename.rsplit('-', 2))
+
+
+def normalize_package_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def capture_lock(docker_client, image_name):
+    """
+    Run the built image to read back its solved environment: the explicit
+    conda package list, and a pip freeze of the packages conda does not
+    manage. Returns (conda lines, pip lines), or None if it can't be read.
+    """
+    run = docker_client.create_container(image_name, entrypoint=['/bin/bash', '-c'], command=[LOCK_SCRIPT])
+    try:
+        docker_client.start(run)
+        result = docker_client.wait(run, timeout=LOCK_TIMEOUT)
+        output = docker_client.logs(run, stdout=True, stderr=False).decode(errors='replace')
+    finally:
+        docker_client.remove_container(run, force=True)
+
+    if result.get('StatusCode') != 0 or LOCK_SEPARATOR not in output:
+        log.warning(f'could not read the solved environment of {image_name}')
+        return None
+
+    conda_part, pip_part = output.split(LOCK_SEPARATOR, 1)
+    conda_lock = [line.strip() for line in conda_part.splitlines() if line.strip()]
+    conda_names = {normalize_package_name(conda_lock_spec(line).split('=')[0])
+                   for line in conda_lock if not line.startswith(('#', '@'))}
+    pip_lock = [line.strip() for line in pip_part.splitlines()
+                if line.strip() and not line.startswith(('#', '-'))
+                and normalize_package_name(re.split(r'[=@ ]', line.strip())[0]) not in conda_names]
+    return conda_lock, pip_lock
+
+
+async def store_lock(container, docker_client, backend, lock):
+    """
+    Store the solved environment of a successful build, unless it was
+    installed from this spec's own lock. Failing to read it back does not
+    fail the build.
+    """
+    spec = container.container_spec
+    if lock is not None and lock['digest'] == spec.digest():
+        return
+    try:
+        captured = await run_in_threadpool(capture_lock, docker_client, container.image_name)
+        if captured is not None:
+            await run_in_threadpool(lock_store.record, spec, backend, *captured)
+    except Exception as e:
+        log.warning(f'could not store the solved environment of {container.image_name}: {e!r}')
+
+
+def conda_solve_time(lines):
+    """
+    Time spent solving conda environments during a build, measured between
+    the timestamps of the build log lines that start and end each solve.
+    Returns None if the log shows no solve.
+    """
+    total = None
+    start = None
+    for timestamp, _, line in lines:
+        if start is None:
+            if SOLVE_START.search(line):
+                start = timestamp
+        elif line.endswith(' CACHED'):
+            # BuildKit reused the layer, so there was no solve
+            start = None
+        elif SOLVE_END.search(line):
+            total = (total or 0) + timestamp - start
+            start = None
+    return total
+
+
+async def coalesced_build(container: Container, leader: Container):
+    """
+    Finish a build that was attached to an identical build already in flight.
+    Once the leading build is done its image is tagged with this container's
+    image name and pushed, so repo2docker only runs once for the pair.
+
+    :param Container container: The attached Container object instance
+    :param Container leader: The Container whose build was actually run
+    """
+    try:
+        # a singularity leader is still building while its SIF is converted
+        if leader.build_spec.build_status == BuildStatus.failed:
+            err_msg = f'Identical build {leader.build_spec.build_id} failed: {leader.err_msg}'
+            await container.log_error(err_msg)
+            return
+
+        await container.update_status(BuildStatus.building)
+
+        docker_client = await run_in_threadpool(docker_clients.get, container.DOCKER_BASE_URL)
+        docker_client_version = await run_in_threadpool(docker_clients.version, container.DOCKER_BASE_URL)
+        inspect = await run_in_threadpool(docker_client.inspect_image, leader.image_name)
+
+        await run_in_threadpool(retag_image, container, docker_client, docker_client_version,
+                                inspect, leader.image_name)
+        container.completion_spec.spec_digest = container.container_spec.digest()
+        container.completion_spec.coalesced_build_id = str(leader.build_spec.build_id)
+
+        await publish_image(container)
+
+    except Exception as e:
+        log.exception(e)
+        err_msg = f'Exception during coalesced build: {sys.exc_info()}'
+        await container.log_error(err_msg)
+
+    finally:
+        await container.delete_temp_dir()
+
+
+async def publish_image(container: Container):
+    """
+    Push a built image to the registry and report the build as ready. A
+    build for the singularity runtime is handed to the SIF converter
+    instead, which reports it ready once its SIF is published.
+    """
+    container_push_start_time = time.time()
+    await container.push_image()
+    container_push_end_time = time.time()
+
+    container_push_time = container_push_end_time - container_push_start_time
+    log.info(f'Time to push container to repository: {container_push_time}s.')
+    container.completion_spec.container_push_time = container_push_time
+    container.completion_spec.queue_wait_time = container.queue_wait_time
+
+    if container.container_spec.container_type == ContainerRuntime.singularity:
+        sif_converter.submit(container)
+        return
+
+    completion_response = await container.update_status(BuildStatus.ready)
+
+    log.info(f'Build process complete - finished with: {completion_response}')
+
+
+def retag_image(container, docker_client, docker_client_version, inspect, source_image):
+    """
+    Tag an existing image with this container's image name in place of a build.
+    """
+    docker_client.tag(inspect['Id'], container.image_name, tag='latest')
+
+    container.completion_spec = CompletionSpec(docker_client_version=str(docker_client_version),
+                                               container_size=inspect['VirtualSize'],
+                                               container_build_time=0,
+                                               cache_hit=True,
+                                               cached_image=source_image)
+
+
+def reuse_cached_image(container, docker_client, docker_client_version, digest):
+    """
+    Satisfy a build from the image cache by tagging a previously built image
+    with this container's image name. Returns False (and forgets the cache
+    entry) if the cached image is no longer present on the docker daemon.
+    """
+    cached = image_cache.lookup(digest)
+    if not cached:
+        return False
+
+    try:
+        inspect = docker_client.inspect_image(cached['image_id'])
+    except ImageNotFound:
+        log.info(f"cached image {cached['image_name']} for digest {digest} is gone - rebuilding")
+        image_cache.remove(digest)
+        return False
+
+    log.info(f"spec digest {digest} matches cached image {cached['image_name']} - skipping build")
+    retag_image(container, docker_client, docker_client_version, inspect, cached['image_name'])
+    return True
+
+
+def record_cached_image(container, docker_client, digest):
+    try:
+        inspect = docker_client.inspect_image(container.image_name)
+    except ImageNotFound:
+        log.error(f'built image {container.image_name} not found - not caching it')
+        return
+
+    # what building this image from scratch would have cost
+    completion_spec = container.completion_spec
+    build_time = (completion_spec.container_build_time or 0) + (completion_spec.incremental_time_saved or 0)
+    image_cache.record(digest, container.image_name, inspect['Id'], spec=container.container_spec,
+                       backend=completion_spec.build_backend, build_time=build_time)
+
+
+def find_incremental_base(container, docker_client):
+    """
+    The image cache entry of the natively built image with the most
+    packages that are all part of this container's spec, skipping (and
+    forgetting) images no longer on the docker daemon. None if there is none.
+    """
+    for digest, entry in image_cache.closest_subsets(container.container_spec, BuildBackend.docker):
+        try:
+            inspect = docker_client.inspect_image(entry['image_name'])
+        except ImageNotFound:
+            inspect = None
+        if inspect is not None and inspect['Id'] == entry['image_id']:
+            return entry
+        log.info(f"cached image {entry['image_name']} for digest {digest} is gone - forgetting it")
+        image_cache.remove(digest)
+    return None
+
+
 def docker_size(container):
-    docker_client = docker.APIClient(base_url=container.DOCKER_BASE_URL)
+    docker_client = docker_clients.get(container.DOCKER_BASE_URL)
     try:
         inspect = docker_client.inspect_image(container.image_name)
         return inspect['VirtualSize']
@@ -0,0 +1,185 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+
+READ_CHUNK_SIZE = 64 * 1024
+MAX_LINE_LENGTH = 16 * 1024
+
+log = logging.getLogger("funcx_container_service")
+
+
+class BuildLog():
+
+    """
+    Bounded, timestamped record of the output of a build. Only the most
+    recent max_lines lines are kept, so memory per build stays constant no
+    matter how much output the build process produces.
+
+    Any number of subscribers can follow the log as it grows. They read
+    straight from the shared buffer, starting with whatever it still holds.
+    Must be appended to from the event loop.
+
+    Once save_to has been called every line is also written to a file, so
+    the whole log can still be read after the buffer has moved on or the
+    build has been forgotten.
+    """
+
+    def __init__(self, max_lines):
+        self.lines = deque(maxlen=max_lines)
+        self.total_lines = 0
+        self.closed = False
+        self._new_output = None
+        self._file = None
+
+    def save_to(self, path):
+        """
+        Write the lines still held, and every line appended from now on, to
+        path as JSON lines that read_saved_log can replay
+        """
+        self._file = open(path, 'w')
+        for line_number, (timestamp, stream, line) in enumerate(self.lines, start=self.first_line):
+            self._save(line_number, timestamp, stream, line)
+
+    def append(self, line, stream='stderr', timestamp=None):
+        timestamp = timestamp or time.time()
+        self.lines.append((timestamp, stream, line))
+        if self._file is not None:
+            self._save(self.total_lines, timestamp, stream, line)
+        self.total_lines += 1
+        self._notify()
+
+    def _save(self, line_number, timestamp, stream, line):
+        try:
+            self._file.write(json.dumps({"id": line_number, "time": timestamp, "stream": stream, "line": line}) + '\n')
+        except OSError as e:
+            log.error(f'could not save build log to {self._file.name}: {e}')
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        """
+        Mark the build as finished so that subscribers stop once caught up.
+        """
+        self.closed = True
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._notify()
+
+    def _notify(self):
+        if self._new_output is not None:
+            self._new_output.set()
+            self._new_output = None
+
+    @property
+    def first_line(self):
+        """
+        Line number of the oldest line still held in the buffer
+        """
+        return self.total_lines - len(self.lines)
+
+    async def follow(self, start=0):
+        """
+        Yield (line number, timestamp, stream, line) for every line from
+        line number start onwards, waiting for new output until the log is
+        closed. Lines that have already left the buffer are skipped.
+        """
+        position = start
+        while True:
+            position = max(position, self.first_line)
+            while position < self.total_lines:
+                timestamp, stream, line = self.lines[position - self.first_line]
+                yield position, timestamp, stream, line
+                position += 1
+
+            if self.closed:
+                return
+
+            if self._new_output is None:
+                self._new_output = asyncio.Event()
+            await self._new_output.wait()
+
+    async def forward(self, target):
+        """
+        Copy every line of this log into target as it arrives, keeping its
+        timestamp and stream, until this log is closed
+        """
+        async for _, timestamp, stream, line in self.follow():
+            target.append(line, stream, timestamp)
+
+    def lines_since(self, start):
+        """
+        The (timestamp, stream, line) entries still held from line number
+        start onwards
+        """
+        return list(self.lines)[max(start - self.first_line, 0):]
+
+    @property
+    def dropped_lines(self):
+        return self.first_line
+
+    def text(self, stream=None, sep=' '):
+        return sep.join(line for _, line_stream, line in self.lines
+                        if stream is None or line_stream == stream)
+
+    async def consume(self, reader, stream):
+        """
+        Read a subprocess pipe to EOF, appending each line as it arrives.
+        Lines longer than MAX_LINE_LENGTH are split rather than buffered.
+        """
+        pending = b''
+        while True:
+            chunk = await reader.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            pending += chunk
+            *complete, pending = pending.split(b'\n')
+            for raw in complete:
+                self._append_raw(raw, stream)
+            while len(pending) > MAX_LINE_LENGTH:
+                self._append_raw(pending[:MAX_LINE_LENGTH], stream)
+                pending = pending[MAX_LINE_LENGTH:]
+        if pending:
+            self._append_raw(pending, stream)
+
+    def _append_raw(self, raw, stream):
+        for start in range(0, max(len(raw), 1), MAX_LINE_LENGTH):
+            self.append(raw[start:start + MAX_LINE_LENGTH].decode(errors='replace').rstrip('\r'), stream)
+
+
+def read_saved_log(path, start=0):
+    """
+    Yield (line number, timestamp, stream, line) for every line of a log
+    written by BuildLog.save_to, from line number start onwards
+    """
+    with open(path) as f:
+        for raw in f:
+            try:
+                entry = json.loads(raw)
+            except ValueError:
+                # the last line of a log cut short by a crash
+                return
+            if entry['id'] >= start:
+                yield entry['id'], entry['time'], entry['stream'], entry['line']
+
+
+def prune_saved_logs(log_dir, max_age):
+    """
+    Delete saved build logs last written more than max_age seconds ago.
+    Returns the number of logs deleted.
+    """
+    cutoff = time.time() - max_age
+    deleted = 0
+    for entry in os.scandir(log_dir):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                deleted += 1
+        except FileNotFoundError:
+            pass
+    if deleted:
+        log.info(f'pruned {deleted} build logs older than {max_age}s from {log_dir}')
+    return deleted
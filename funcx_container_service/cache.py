@@ -0,0 +1,415 @@
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+log = logging.getLogger("funcx_container_service")
+
+# build output lines showing a package taken from, or missing from, a cache mount
+PIP_HIT = re.compile(r'Using cached ')
+PIP_MISS = re.compile(r'\bDownloading (?!and Extracting)\S')
+# apt prints a Get line for each archive it downloads, and nothing for cached ones
+APT_MISS = re.compile(r'\bGet:\d+ \S+ \S+ \S+ \S+ \S+ \S+ \[')
+APT_INSTALLED = re.compile(r'\b(\d+) newly installed')
+
+
+class JsonIndex():
+
+    """
+    An index kept in memory and persisted as a JSON file, rewritten
+    atomically on update. Subclasses hold _lock while they read or change
+    the dict returned by _load, and call _save after changing it.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._index = None
+
+    def _load(self):
+        if self._index is None:
+            try:
+                with open(self.index_path) as f:
+                    self._index = json.load(f)
+            except FileNotFoundError:
+                self._index = {}
+            except ValueError:
+                log.error(f'index at {self.index_path} is corrupt - starting empty')
+                self._index = {}
+        return self._index
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f, indent=4)
+        os.replace(tmp_path, self.index_path)
+
+
+class ImageCache(JsonIndex):
+
+    """
+    Persistent index from a ContainerSpec digest to the docker image that was
+    built for it, so identical specs can reuse an existing image instead of
+    being rebuilt.
+
+    Images recorded with their spec also keep its package sets, so a new
+    spec can be built on top of the image of a smaller spec it extends.
+    """
+
+    def lookup(self, digest):
+        with self._lock:
+            return self._load().get(digest)
+
+    def record(self, digest, image_name, image_id, spec=None, backend=None, build_time=None):
+        entry = {"image_name": image_name,
+                 "image_id": image_id,
+                 "created": time.time()}
+        if spec is not None:
+            entry.update(packages=spec_packages(spec), backend=backend, build_time=build_time)
+        with self._lock:
+            self._load()[digest] = entry
+            self._save()
+        log.info(f'cached image {image_name} ({image_id}) for spec digest {digest}')
+
+    def closest_subsets(self, spec, backend):
+        """
+        Digests and entries of cached images built by backend whose packages
+        are all in spec, the images with the most packages first
+        """
+        wanted = {manager: set(pkgs) for manager, pkgs in spec_packages(spec).items()}
+        digest = spec.digest()
+        with self._lock:
+            candidates = [(cached_digest, entry) for cached_digest, entry in self._load().items()
+                          if cached_digest != digest and entry.get('backend') == backend
+                          and 'packages' in entry
+                          and all(set(entry['packages'][manager]) <= wanted[manager] for manager in wanted)]
+        candidates = [(d, e) for d, e in candidates if any(e['packages'].values())]
+        return sorted(candidates, key=lambda c: sum(len(pkgs) for pkgs in c[1]['packages'].values()),
+                      reverse=True)
+
+    def remove(self, digest):
+        with self._lock:
+            if self._load().pop(digest, None) is not None:
+                self._save()
+
+
+def spec_packages(spec):
+    return {"apt": sorted(spec.apt or []),
+            "conda": sorted(spec.conda or []),
+            "pip": sorted(spec.pip or [])}
+
+
+class LayerIndex(JsonIndex):
+
+    """
+    Persistent record of the Dockerfile layers (by dockerfile.layer_keys)
+    this node has built, used to estimate how many layers of a new build
+    the docker build cache will already have. Only the most recently used
+    max_entries layers are remembered.
+    """
+
+    def __init__(self, index_path, max_entries=10000):
+        super().__init__(index_path)
+        self.max_entries = max_entries
+
+    def hit_ratio(self, keys):
+        """
+        Fraction of keys already built, or None if there are no layers
+        """
+        if not keys:
+            return None
+        with self._lock:
+            index = self._load()
+            return sum(1 for key in keys if key in index) / len(keys)
+
+    def record(self, keys):
+        now = time.time()
+        with self._lock:
+            index = self._load()
+            for key in keys:
+                index[key] = now
+            if len(index) > self.max_entries:
+                for key, _ in sorted(index.items(), key=lambda item: item[1])[:len(index) - self.max_entries]:
+                    del index[key]
+            self._save()
+
+
+class PackageCache():
+
+    """
+    Node-local pip, conda and apt download caches, held in BuildKit cache
+    mounts on the docker daemon. Cache mounts are kept out of the image
+    layers by BuildKit itself. Once they grow past max_size bytes, the least
+    recently used are pruned.
+
+    Hits and misses are counted from build output: pip reports every
+    package it takes from the cache, and apt every archive it downloads.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, lines):
+        """
+        Count the cache hits and misses in a build's output, add them to the
+        running totals and return them
+        """
+        pip_hits = pip_misses = apt_installed = apt_misses = 0
+        for line in lines:
+            if PIP_HIT.search(line):
+                pip_hits += 1
+            elif PIP_MISS.search(line):
+                pip_misses += 1
+            elif APT_MISS.search(line):
+                apt_misses += 1
+            else:
+                installed = APT_INSTALLED.search(line)
+                if installed:
+                    apt_installed += int(installed.group(1))
+
+        hits = pip_hits + max(apt_installed - apt_misses, 0)
+        misses = pip_misses + apt_misses
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+        return hits, misses
+
+    def evict(self, docker_client):
+        """
+        Prune cache mounts, least recently used first, down to max_size
+        """
+        try:
+            response = docker_client.prune_builds(filters={'type': 'exec.cachemount'}, keep_storage=self.max_size)
+        except Exception as e:
+            log.warning(f'could not prune package cache: {e!r}')
+            return 0
+        reclaimed = response.get('SpaceReclaimed') or 0
+        if reclaimed:
+            log.info(f'pruned {reclaimed} bytes from the package cache')
+        return reclaimed
+
+
+class LockStore(JsonIndex):
+
+    """
+    Solved environments of successful builds - an explicit conda package
+    list and a pip freeze - stored by ContainerSpec digest, one file per
+    lock. A lock is only reused for a spec with the same digest, built by
+    the same backend: a larger spec's lock would install packages that
+    were not asked for.
+    """
+
+    def __init__(self, locks_dir):
+        super().__init__(os.path.join(locks_dir, 'index.json'))
+        self.locks_dir = locks_dir
+
+    def _lock_path(self, digest):
+        return os.path.join(self.locks_dir, f'{digest}.json')
+
+    def lookup(self, spec, backend):
+        """
+        The lock for spec, as a dict with its digest and conda and pip
+        lines. None if there is none.
+        """
+        digest = spec.digest()
+        with self._lock:
+            entry = self._load().get(digest)
+        if entry is None or entry['backend'] != backend:
+            return None
+
+        try:
+            with open(self._lock_path(digest)) as f:
+                return {"digest": digest, **json.load(f)}
+        except (FileNotFoundError, ValueError):
+            log.error(f'lock for spec digest {digest} is missing or corrupt - skipping it')
+        return None
+
+    def record(self, spec, backend, conda_lock, pip_lock):
+        digest = spec.digest()
+        with self._lock:
+            os.makedirs(self.locks_dir, exist_ok=True)
+            tmp_path = f'{self._lock_path(digest)}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({"conda": conda_lock, "pip": pip_lock}, f, indent=4)
+            os.replace(tmp_path, self._lock_path(digest))
+
+            self._load()[digest] = {"backend": backend,
+                                    "conda": sorted(spec.conda or []),
+                                    "pip": sorted(spec.pip or []),
+                                    "created": time.time()}
+            self._save()
+        log.info(f'stored solved environment for spec digest {digest}')
+
+
+class PayloadCache(JsonIndex):
+
+    """
+    Node-local, content-addressed store of downloaded payloads. Each
+    payload is kept once under its sha256, however many URLs serve it. The
+    index remembers, per URL, the payload last fetched from it along with
+    its ETag and Last-Modified, so it can be revalidated with a conditional
+    request. Once the payloads take up more than max_size bytes, the least
+    recently used are evicted.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        super().__init__(os.path.join(cache_dir, 'index.json'))
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def _load(self):
+        index = super()._load()
+        index.setdefault('urls', {})
+        index.setdefault('blobs', {})
+        return index
+
+    def blob_path(self, digest):
+        return os.path.join(self.cache_dir, 'sha256', digest)
+
+    def temp_path(self):
+        os.makedirs(os.path.join(self.cache_dir, 'tmp'), exist_ok=True)
+        return os.path.join(self.cache_dir, 'tmp', f'{os.getpid()}-{threading.get_ident()}-{time.time_ns()}')
+
+    def validators(self, url):
+        """
+        Conditional request headers for url, if its payload is still cached
+        """
+        with self._lock:
+            entry = self._load()['urls'].get(url)
+            if entry is None or not os.path.exists(self.blob_path(entry['sha256'])):
+                return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def cached_digest(self, url):
+        with self._lock:
+            entry = self._load()['urls'].get(url)
+            return entry['sha256'] if entry else None
+
+    def store(self, url, temp_path, digest, size, etag=None, last_modified=None):
+        """
+        Move a downloaded payload into the cache under its digest and
+        remember it as the current payload for url
+        """
+        with self._lock:
+            index = self._load()
+            os.makedirs(os.path.dirname(self.blob_path(digest)), exist_ok=True)
+            if os.path.exists(self.blob_path(digest)):
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, self.blob_path(digest))
+            index['blobs'][digest] = {"size": size, "last_used": time.time()}
+            index['urls'][url] = {"sha256": digest, "etag": etag, "last_modified": last_modified}
+            self._evict(keep=digest)
+            self._save()
+
+    def checkout(self, digest, dest):
+        """
+        Hard link (or, across filesystems, copy) a cached payload to dest.
+        Returns False if it is no longer cached.
+        """
+        with self._lock:
+            index = self._load()
+            if digest not in index['blobs'] or not os.path.exists(self.blob_path(digest)):
+                return False
+            try:
+                os.link(self.blob_path(digest), dest)
+            except OSError:
+                shutil.copyfile(self.blob_path(digest), dest)
+            index['blobs'][digest]['last_used'] = time.time()
+            self._save()
+            return True
+
+    def _evict(self, keep):
+        blobs = self._load()['blobs']
+        total = sum(blob['size'] for blob in blobs.values())
+        for digest, blob in sorted(blobs.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            log.info(f'evicting payload {digest} ({blob["size"]} bytes) from the payload cache')
+            try:
+                os.remove(self.blob_path(digest))
+            except FileNotFoundError:
+                pass
+            del blobs[digest]
+            total -= blob['size']
+        urls = self._load()['urls']
+        for url in [url for url, entry in urls.items() if entry['sha256'] not in blobs]:
+            del urls[url]
+
+
+class SifCache(JsonIndex):
+
+    """
+    Node-local store of Singularity images converted from built docker
+    images, one per spec digest. An entry only counts for the docker image
+    it was converted from, so a spec whose image has been rebuilt is
+    converted again. Once the SIFs take up more than max_size bytes, the
+    least recently used are evicted.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        super().__init__(os.path.join(cache_dir, 'index.json'))
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def sif_path(self, digest):
+        return os.path.join(self.cache_dir, f'{digest}.sif')
+
+    def temp_path(self, digest):
+        os.makedirs(os.path.join(self.cache_dir, 'tmp'), exist_ok=True)
+        return os.path.join(self.cache_dir, 'tmp', f'{digest}-{os.getpid()}-{time.time_ns()}.sif')
+
+    def lookup(self, digest, image_id):
+        """
+        Path of the SIF converted from image_id for digest, or None
+        """
+        with self._lock:
+            entry = self._load().get(digest)
+            if entry is None or entry['image_id'] != image_id or not os.path.exists(self.sif_path(digest)):
+                return None
+            entry['last_used'] = time.time()
+            self._save()
+            return self.sif_path(digest)
+
+    def store(self, digest, image_id, temp_path):
+        """
+        Move a freshly converted SIF into the cache and return its path
+        """
+        size = os.path.getsize(temp_path)
+        with self._lock:
+            os.replace(temp_path, self.sif_path(digest))
+            self._load()[digest] = {"image_id": image_id, "size": size, "last_used": time.time()}
+            self._evict(keep=digest)
+            self._save()
+        log.info(f'cached SIF for spec digest {digest} ({size} bytes)')
+        return self.sif_path(digest)
+
+    def _evict(self, keep):
+        index = self._load()
+        total = sum(entry['size'] for entry in index.values())
+        for digest, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            log.info(f'evicting SIF {digest} ({entry["size"]} bytes) from the SIF cache')
+            try:
+                os.remove(self.sif_path(digest))
+            except FileNotFoundError:
+                pass
+            del index[digest]
+            total -= entry['size']
@@ -1,13 +1,16 @@
+import asyncio
 import json
 import logging
+import random
 from pprint import pformat
 from urllib.parse import urljoin
 from uuid import UUID
 
 from fastapi import APIRouter
 from pydantic import BaseModel
-import requests
+import httpx
 
+from .config import Settings
 from .container import Container
 from .models import StatusUpdate
 
@@ -16,6 +19,11 @@ log = logging.getLogger("funcx_container_service")
 query_container_callback_router = APIRouter()
 build_callback_router = APIRouter()
 
+# fields sent with every delta update so the webservice can place it
+STATUS_KEY_FIELDS = ('container_id', 'build_id', 'RUN_ID', 'build_status')
+# potentially large fields that are cut down to their tail in delta updates
+STATUS_LOG_FIELDS = ('repo2docker_stdout', 'repo2docker_stderr', 'docker_push_log')
+
 
 class UUIDEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -25,6 +33,105 @@ class UUIDEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+class StatusPublisher():
+
+    """
+    Sends status updates to the webservice over one shared, keep-alive
+    connection pool. Failed sends are retried with exponential backoff and
+    full jitter. Updates for one container are sent in order, one at a
+    time. If several pile up while a send is in flight, only the newest is
+    sent next, and every caller it replaced gets that send's response.
+
+    A body may be given as a callable, which is called just before it is
+    sent, and on_sent is called with each response before the next send
+    for the same key begins.
+    """
+
+    def __init__(self, settings):
+        self.timeout = httpx.Timeout(settings.STATUS_TIMEOUT)
+        self.limits = httpx.Limits(max_connections=settings.STATUS_MAX_CONNECTIONS,
+                                   max_keepalive_connections=settings.STATUS_MAX_CONNECTIONS)
+        self.retries = settings.STATUS_RETRIES
+        self.backoff = settings.STATUS_BACKOFF
+        self.backoff_max = settings.STATUS_BACKOFF_MAX
+        self._client = None
+        self._client_loop = None
+        self._pending = {}
+        self._senders = {}
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+            self._client_loop = loop
+        return self._client
+
+    async def publish(self, key, url, body, on_sent=None):
+        """
+        Queue body to be PUT to url as the newest status for key and wait for
+        the response of the send that delivered it (None if every retry
+        failed).
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        _, waiters = self._pending.get(key, (None, []))
+        self._pending[key] = ((url, body, on_sent), waiters + [waiter])
+
+        if key not in self._senders:
+            self._senders[key] = asyncio.create_task(self._send_pending(key))
+
+        return await waiter
+
+    async def _send_pending(self, key):
+        try:
+            while key in self._pending:
+                (url, body, on_sent), waiters = self._pending.pop(key)
+                if len(waiters) > 1:
+                    log.debug(f'coalesced {len(waiters)} status updates for {key}')
+                try:
+                    response = await self._put(url, body() if callable(body) else body)
+                    if on_sent is not None:
+                        on_sent(response)
+                except Exception as e:
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                    continue
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(response)
+        finally:
+            del self._senders[key]
+
+    async def _put(self, url, body):
+        response = None
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.client().put(url,
+                                                   headers={'Content-Type': 'application/json'},
+                                                   content=body)
+                if response.status_code < 500 and response.status_code != 429:
+                    return response
+                log.warning(f'status update to {url} returned {response.status_code} (attempt {attempt + 1})')
+            except httpx.TransportError as e:
+                log.warning(f'status update to {url} failed: {e!r} (attempt {attempt + 1})')
+
+            if attempt < self.retries:
+                await asyncio.sleep(random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt)))
+
+        log.error(f'giving up on status update to {url} after {self.retries + 1} attempts')
+        return response
+
+    async def aclose(self):
+        if self._senders:
+            await asyncio.gather(*self._senders.values(), return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+status_publisher = StatusPublisher(Settings())
+
+
 class container_object_json(BaseModel):
     container_id: str
 
@@ -38,7 +145,7 @@ def updating_status(body: StatusUpdate):
     pass
 
 
-def update_status(container: Container):
+async def update_status(container: Container):
 
     if container.completion_spec:
         status_dict = dict(list(container.build_spec.dict().items())
@@ -51,18 +158,66 @@ def update_status(container: Container):
     if hasattr(container, 'err_msg'):
         status_dict['err_msg'] = container.err_msg
 
-    log.info(f'updating status for: {pformat(status_dict)}')
+    delta_updates = container.settings.STATUS_DELTA_UPDATES
+    if delta_updates:
+        truncate_logs(status_dict, container)
+
+    container_id = container.container_spec.container_id
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f'updating status for: {pformat(status_dict)}')
+    else:
+        log.info(f'updating status for container {container_id} to {container.build_spec.build_status}')
 
-    response = requests.put(urljoin(container.settings.WEBSERVICE_URL,
-                                    f"v2/internal/containers/{container.container_spec.container_id}/status"),
-                            headers={'Content-Type': 'application/json'},
-                            data=json.dumps(status_dict, cls=UUIDEncoder))
+    def status_body():
+        # computed at send time, against the last update the webservice accepted
+        if delta_updates:
+            return json.dumps(status_delta(container.acked_status, status_dict), cls=UUIDEncoder)
+        return json.dumps(status_dict, cls=UUIDEncoder)
 
-    if response.status_code != 200:
+    def status_sent(response):
+        if response is not None and response.status_code == 200:
+            container.acked_status = status_dict
+
+    response = await status_publisher.publish(container_id,
+                                              urljoin(container.settings.WEBSERVICE_URL,
+                                                      f"v2/internal/containers/{container_id}/status"),
+                                              status_body,
+                                              on_sent=status_sent)
+
+    if response is None or response.status_code != 200:
         log.error(f"Updating of container status returned {response}")
 
     return response
 
 
+def status_delta(acked_status, status_dict):
+    """
+    The fields of status_dict that differ from the last acknowledged status,
+    plus the fields that identify the build.
+    """
+    delta = {k: v for k, v in status_dict.items()
+             if k in STATUS_KEY_FIELDS or k not in acked_status or acked_status[k] != v}
+    delta['status_delta'] = True
+    return delta
+
+
+def truncate_logs(status_dict, container):
+    """
+    Cut build and push logs down to their tail and point at the full log.
+    """
+    tail = container.settings.STATUS_LOG_TAIL
+    truncated = False
+    for field in STATUS_LOG_FIELDS:
+        value = status_dict.get(field)
+        if value and len(value) > tail:
+            status_dict[field] = value[-tail:]
+            truncated = True
+
+    if truncated:
+        log_path = f"build/{container.build_spec.build_id}/logs"
+        service_url = container.settings.SERVICE_URL
+        status_dict['build_log_url'] = urljoin(service_url, log_path) if service_url else f'/{log_path}'
+
+
 def remove_build(container_id):
     pass
@@ -1,5 +1,18 @@
 from pydantic import BaseSettings, BaseModel
-from typing import Optional
+from typing import List, Optional
+
+from .dockerfile import MICROMAMBA_VERSION
+from .models import BuildBackend, CondaSolver
+
+
+class RegistryConfig(BaseModel):
+    """A registry or mirror that built images are also published to"""
+
+    url: str
+    username: str
+    password: Optional[str] = None
+    site: Optional[str] = None
+    max_concurrent_pushes: int = 2
 
 
 class Settings(BaseSettings):
@@ -9,8 +22,47 @@ class Settings(BaseSettings):
     REGISTRY_USERNAME: Optional[str] = None
     REGISTRY_PWD: Optional[str] = None
     REGISTRY_URL: Optional[str] = None
+    REGISTRY_MAX_CONCURRENT_PUSHES: int = 2
+    REGISTRY_MIRRORS: List[RegistryConfig] = []
     REPO2DOCKER_PATH: Optional[str] = None
+    BUILD_BACKEND: BuildBackend = BuildBackend.repo2docker
+    DOCKER_PATH: Optional[str] = None
+    SINGULARITY_PATH: Optional[str] = None
+    MAX_CONCURRENT_SIF_CONVERSIONS: int = 1
+    SIF_CACHE_SIZE: int = 50 * 1024 ** 3
+    USE_BASE_IMAGE: bool = True
+    BASE_IMAGE_NAME: str = 'funcx_container_base'
+    PACKAGE_CACHE: bool = True
+    PACKAGE_CACHE_SIZE: int = 20 * 1024 ** 3
+    CONDA_SOLVER: CondaSolver = CondaSolver.conda
+    MICROMAMBA_VERSION: str = MICROMAMBA_VERSION
+    REGISTRY_AUTH_TTL: int = 60 * 30
+    PUSH_PROGRESS_INTERVAL: float = 5
+    SKIP_EXISTING_PUSH: bool = True
+    REGISTRY_TIMEOUT: float = 30
+    DOCKER_HEALTH_CHECK_INTERVAL: int = 30
     BUILD_TIMEOUT: Optional[int] = 60 * 30
+    BUILD_LOG_LINES: int = 10000
+    BUILD_LOG_DIR: Optional[str] = None
+    RECENT_BUILDS: int = 20
+    MAX_CONCURRENT_BUILDS: int = 2
+    SHUTDOWN_TIMEOUT: Optional[int] = 60 * 5
+    CACHE_DIR: str = '/var/tmp/funcx_container_service'
+    BUILD_DB_URL: Optional[str] = None
+    REQUEUE_ORPHANED_BUILDS: bool = True
+    BUILD_RETENTION: int = 60 * 60 * 24 * 30
+    PAYLOAD_CACHE_SIZE: int = 10 * 1024 ** 3
+    PAYLOAD_TIMEOUT: float = 300
+    MAX_PAYLOAD_SIZE: int = 20 * 1024 ** 3
+    STREAM_BUILD_CONTEXT: bool = True
+    STATUS_TIMEOUT: float = 10
+    STATUS_RETRIES: int = 5
+    STATUS_BACKOFF: float = 0.5
+    STATUS_BACKOFF_MAX: float = 30
+    STATUS_MAX_CONNECTIONS: int = 20
+    STATUS_DELTA_UPDATES: bool = False
+    STATUS_LOG_TAIL: int = 4096
+    SERVICE_URL: Optional[str] = None
 
     class Config:
         env_prefix = ''
@@ -1,19 +1,38 @@
+import asyncio
+import hashlib
 import logging
 import json
 import os
-import requests
 import shutil
+import signal
+import time
 import traceback
 import uuid
-import zipfile
 
-import docker
+import httpx
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
 
 from . import callback_router
-from .models import BuildStatus, BuildSpec, BuildType
+from .archive import extract_archive
+from .buildlog import BuildLog
+from .cache import PayloadCache
+from .config import Settings
+from .docker_pool import docker_clients, registry_auth
+from .models import BuildBackend, BuildStatus, BuildSpec, BuildType
+from .push import (PushProgress, RegistryError, immutable_tag, push_slots, push_throughput, pushed_digest,
+                   registry_targets, tag_existing_image)
 
 log = logging.getLogger("funcx_container_service")
 
+# command line fragments that identify a stale build process left behind by a crashed server
+BUILD_PROCESS_NAMES = ('repo2docker', 'docker\x00build')
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+settings = Settings()
+
+payload_cache = PayloadCache(os.path.join(settings.CACHE_DIR, 'payloads'), settings.PAYLOAD_CACHE_SIZE)
+
 
 class Container():
 
@@ -38,31 +57,73 @@ class Container():
         self.image_name = f'funcx_{self.container_spec.container_id}'
         self.build_timeout = settings.BUILD_TIMEOUT
         self.err_msg = None
+        self.queued_time = None
+        self.start_time = None
+        self.build_pid = None
+        self.build_store = None
+        self.build_log = BuildLog(settings.BUILD_LOG_LINES)
+        self.build_output_start = 0
+        self.acked_status = {}
+        self.payload_path = None
+        self.sif_task = None
+        self._progress_update = None
+        self.payload_digest = None
+        self.payload_cache_hit = False
 
         log.info(str(self.container_spec))
-        if self.container_spec:
-            self.build_spec_to_file()
 
-    def update_build_type(self):
+    @property
+    def queue_wait_time(self):
+        """
+        Seconds spent waiting for a build slot, counting up until the build starts
+        """
+        if self.queued_time is None:
+            return None
+        return (self.start_time or time.time()) - self.queued_time
+
+    @property
+    def streams_build_context(self):
+        """
+        Whether the payload goes to docker build as a tar stream instead of
+        being extracted into the temp dir first
+        """
+        return (self.build_type == BuildType.payload
+                and self.settings.BUILD_BACKEND == BuildBackend.docker
+                and self.settings.STREAM_BUILD_CONTEXT)
+
+    async def update_build_type(self):
         if self.container_spec.payload_url is not None:
             if 'github.com' in self.container_spec.payload_url:
                 log.info('Processing logic source as a github repository...')
                 self.build_type = BuildType.github
             else:
                 self.build_type = BuildType.payload
-                self.download_payload()
+                await self.download_payload()
         else:
             self.build_type = BuildType.container
 
-    def update_status(self, status: BuildStatus):
+    async def update_status(self, status: BuildStatus):
         self.build_spec.build_status = status
-        update_result = callback_router.update_status(self)
+        await self.save_state()
+        update_result = await callback_router.update_status(self)
         return update_result
 
+    async def save_state(self):
+        """
+        Persist the build's phase, temp dir and build process so that a
+        restarted server can recover it
+        """
+        if self.build_store is not None:
+            try:
+                await run_in_threadpool(self.build_store.save, self)
+            except Exception as e:
+                log.error(f'failed to record state of build {self.build_spec.build_id}: {e}')
+
     def build_spec_to_file(self):
         """
         Write the build specifications out to a file in the temp directory that can
-        be accessed by repo2docker for the build process
+        be accessed by repo2docker for the build process. This does blocking file
+        I/O, so callers on the event loop should run it in the threadpool.
         """
         if self.container_spec.apt:
             with open(self.temp_dir + '/apt.txt', 'w') as f:
@@ -70,64 +131,96 @@ class Container():
         with open(self.temp_dir + '/environment.yml', 'w') as f:
             json.dump(self.env_from_spec(self.container_spec), f, indent=4)
 
-    def download_payload(self):
+    async def download_payload(self):
 
         if self.container_spec.payload_url:
-            payload_path = self.temp_dir + '/payload'
+            # kept outside the build directory, so extracting the payload cannot write over the cached copy
+            payload_path = self.temp_dir + '.payload'
             log.debug(f'downloading payload from {self.container_spec.payload_url} to {payload_path}')
 
             try:
-                response = requests.get(self.container_spec.payload_url, stream=True)
-
-                payload_file = open(payload_path, "wb")
-                for chunk in response.iter_content(chunk_size=1024):
-                    payload_file.write(chunk)
-
-                payload_file.close()
+                await self.fetch_payload(payload_path)
 
             except Exception:
                 err_msg = f"""Exception raised trying to download payload
-                              from {self.container_spec.payload_url}: {traceback.print_exc()}"""
-                self.log_error(err_msg)
+                              from {self.container_spec.payload_url}: {traceback.format_exc()}"""
+                await self.log_error(err_msg)
                 return False
 
             log.debug(f'Payload downloaded to {payload_path}')
+            self.payload_path = payload_path
 
-            try:
-
-                # check size vs free space
-                payload_size = os.path.getsize(payload_path)
-                free_space = shutil.disk_usage(self.temp_dir).free
+            if self.streams_build_context:
+                log.info('payload will be streamed into the build context')
+                return True
 
-                log.info(f'payload size: {payload_size}')
-                log.info(f'free space: {free_space}')
-
-                if payload_size * 10 < free_space:
-                    self.uncompress_payload(payload_path)
+            try:
+                written = await run_in_threadpool(self.uncompress_payload, payload_path)
+                log.info(f'payload extracted: {written} bytes')
 
             except Exception as e:
                 err_msg = (f'decompressing payload failed: {e}')
-                self.log_error(err_msg)
+                await self.log_error(err_msg)
                 return False
 
         return True
 
+    async def fetch_payload(self, payload_path):
+        """
+        Put the payload at payload_path, by way of the payload cache. A
+        cached payload is revalidated with a conditional request, and only
+        downloaded again if the server has a different one.
+        """
+        url = self.container_spec.payload_url
+        headers = await run_in_threadpool(payload_cache.validators, url)
+
+        # the cached copy can be evicted between revalidating and using it
+        for attempt in range(2):
+            digest = await self._download_to_cache(url, headers)
+            if await run_in_threadpool(payload_cache.checkout, digest, payload_path):
+                self.payload_digest = digest
+                return
+            headers = {}
+        raise Exception(f'payload {digest} was evicted from the payload cache before it could be used')
+
+    async def _download_to_cache(self, url, headers):
+        timeout = httpx.Timeout(self.settings.PAYLOAD_TIMEOUT)
+        async with httpx.AsyncClient(timeout=timeout, follow_redirects=True) as client:
+            async with client.stream('GET', url, headers=headers) as response:
+                if response.status_code == 304:
+                    log.info(f'payload from {url} is unchanged - using the cached copy')
+                    self.payload_cache_hit = True
+                    return await run_in_threadpool(payload_cache.cached_digest, url)
+                response.raise_for_status()
+
+                temp_path = await run_in_threadpool(payload_cache.temp_path)
+                hasher = hashlib.sha256()
+                size = 0
+                try:
+                    with open(temp_path, 'wb') as payload_file:
+                        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                            await run_in_threadpool(write_chunk, payload_file, hasher, chunk)
+                            size += len(chunk)
+                except BaseException:
+                    await run_in_threadpool(remove_file, temp_path)
+                    raise
+
+        digest = hasher.hexdigest()
+        log.info(f'downloaded {size} byte payload {digest} from {url}')
+        await run_in_threadpool(payload_cache.store, url, temp_path, digest, size,
+                                response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return digest
+
     def uncompress_payload(self, payload_path):
-        if zipfile.is_zipfile(payload_path):
-            log.debug('zipfile detected...')
-            try:
-                with zipfile.ZipFile(payload_path, 'r') as zip_obj:
-                    log.debug(f'unzipping {payload_path}')
-                    zip_obj.extractall(self.temp_dir)
-            except Exception as e:
-                err_msg = f'unzip failed: {e}'
-                self.log_error(err_msg=err_msg)
-                raise Exception(err_msg)
-        else:
-            err_msg = f"""file obtained from {self.container_spec.payload_url} is not
-                          acceptable archive format (tar or zip) - exiting"""
-            self.log_error(err_msg=err_msg)
-            raise Exception(err_msg)
+        """
+        Extract the payload into the build directory, allowing it to expand
+        to no more than MAX_PAYLOAD_SIZE or 90% of the free disk space,
+        whichever is smaller.
+        """
+        free_space = shutil.disk_usage(self.temp_dir).free
+        max_bytes = min(self.settings.MAX_PAYLOAD_SIZE, int(free_space * 0.9))
+        log.info(f'payload size: {os.path.getsize(payload_path)}, extraction limit: {max_bytes}')
+        return extract_archive(payload_path, self.temp_dir, max_bytes)
 
     def env_from_spec(self, spec):
         """
@@ -151,76 +244,243 @@ class Container():
 
         return env_content
 
-    def push_image(self):
-
-        docker_client = docker.APIClient(base_url=self.DOCKER_BASE_URL)
+    async def push_image(self):
+        """
+        Publish the image to the primary registry and every mirror at once.
+        The primary registry fills in the registry fields of the
+        CompletionSpec and reports push progress; every registry gets an
+        entry in registry_pushes and a pull command for its site. A failed
+        push to a mirror is recorded rather than failing the build.
+        """
+        docker_client = await run_in_threadpool(docker_clients.get, self.DOCKER_BASE_URL)
+        inspect = await run_in_threadpool(docker_client.inspect_image, self.image_name)
+        content_tag = immutable_tag(self.completion_spec.spec_digest or self.container_spec.digest(), inspect['Id'])
+
+        targets = registry_targets(self.settings)
+        results = await asyncio.gather(*(self.publish_to(docker_client, target, content_tag,
+                                                         report=target is targets[0])
+                                         for target in targets),
+                                       return_exceptions=True)
+
+        pushes = []
+        for target, result in zip(targets, results):
+            if isinstance(result, BaseException):
+                if target is targets[0]:
+                    raise result
+                log.error(f'push of {self.image_name} to {target.url} failed: {result!r}')
+                pushes.append({'site': target.site, 'registry_url': target.url, 'error': str(result)})
+            else:
+                pushes.append(result)
 
-        d_response = docker_client.login(username=self.settings.REGISTRY_USERNAME,
-                                         password=self.settings.REGISTRY_PWD,
-                                         registry=self.settings.REGISTRY_URL)
+        self.completion_spec.registry_pushes = pushes
+        self.completion_spec.image_pull_commands = {push['site']: push['pull_command']
+                                                    for push in pushes if 'pull_command' in push}
 
-        if d_response['Status'] == 'Login Succeeded':
+    async def publish_to(self, docker_client, target, content_tag, report=False):
+        """
+        Push the image to one registry under its content tag and latest,
+        within that registry's concurrency limit. Returns the registry's
+        entry for registry_pushes; raises RegistryError if logging in fails.
+        """
+        async with push_slots.get(target):
+            start = time.time()
+            d_response = await run_in_threadpool(registry_auth.login,
+                                                 docker_client,
+                                                 username=target.username,
+                                                 password=target.password,
+                                                 registry=target.url)
+
+            if d_response.get('Status') != 'Login Succeeded':
+                raise RegistryError(f'could not log in to {target.url} as {target.username} to push '
+                                    f'{self.image_name}: {d_response}')
 
-            push_logs = []
             tag_string = 'latest'
+            repository = target.repository(self.image_name)
 
-            docker_client.tag(self.image_name,
-                              f'{self.settings.REGISTRY_USERNAME}/{self.image_name}',
-                              tag=tag_string)
+            for tag in (content_tag, tag_string):
+                await run_in_threadpool(docker_client.tag,
+                                        self.image_name,
+                                        repository,
+                                        tag=tag)
 
-            auth_dict = {'username': self.settings.REGISTRY_USERNAME,
-                         'password': self.settings.REGISTRY_PWD}
+            # the content tag carries the image; latest then only needs its manifest written
+            digest, skipped = await self.push_tag(docker_client, target, repository, content_tag, report)
+            await self.push_tag(docker_client, target, repository, tag_string)
+            push_time = time.time() - start
 
-            for line in docker_client.push(repository=f'{self.settings.REGISTRY_USERNAME}/{self.image_name}',
-                                           stream=True,
-                                           decode=True,
-                                           tag=tag_string,
-                                           auth_config=auth_dict):
-                log.info(line)
-                push_logs.append(line)
+        log.info(f'docker image {self.image_name} sent to \
+                 {repository}:{content_tag} and {repository}:{tag_string}')
 
-            log.info(f'docker image {self.image_name} sent to \
-                     {self.settings.REGISTRY_USERNAME}/{self.image_name}:{tag_string}')
-
-            self.completion_spec.registry_url = self.settings.REGISTRY_URL
+        pull_command = f"docker pull {target.pull_reference(self.image_name)}@{digest}"
+        if report:
+            self.completion_spec.registry_url = target.url
             self.completion_spec.registry_repository = self.image_name
-            self.completion_spec.registry_user = self.settings.REGISTRY_USERNAME
+            self.completion_spec.registry_user = target.username
             self.completion_spec.image_tag = tag_string
-            registry_uri = self.settings.REGISTRY_URL.lstrip('https://').lstrip('http://')
-            self.completion_spec.image_pull_command = (f"docker pull {registry_uri}/{self.image_name}")
-            self.completion_spec.docker_push_log = str(push_logs)
+            self.completion_spec.image_immutable_tag = content_tag
+            self.completion_spec.image_digest = digest
+            self.completion_spec.image_pull_command = pull_command
+
+        return {'site': target.site,
+                'registry_url': target.url,
+                'repository': repository,
+                'digest': digest,
+                'push_time': push_time,
+                'push_skipped': skipped,
+                'pull_command': pull_command}
+
+    async def push_tag(self, docker_client, target, repository, tag, report=False):
+        """
+        Publish repository:tag, writing just the tag when the registry
+        already has the image and pushing it otherwise. Returns the manifest
+        digest and whether the push was skipped; a push that reports no
+        digest has it looked up in the registry, and fails if the registry
+        does not have the tag. With report, what the push cost or saved is recorded in the
+        CompletionSpec.
+        """
+        existing = None
+        if self.settings.SKIP_EXISTING_PUSH:
+            try:
+                existing = await tag_existing_image(docker_client, target, self.image_name, repository, tag,
+                                                    self.settings.REGISTRY_TIMEOUT)
+            except Exception as e:
+                log.warning(f'could not check the registry for {repository}:{tag}: {e!r} - pushing')
+
+        if existing is not None:
+            digest, saved = existing
+            message = f'registry already had all {saved} bytes of the image - wrote {repository}:{tag} without pushing'
+            self.build_log.append(message, stream='push')
+            if report:
+                self.completion_spec.push_skipped = True
+                self.completion_spec.push_bytes_saved = saved
+                self.completion_spec.push_time_saved = push_throughput.estimate(saved)
+                self.completion_spec.docker_push_log = message
+            return digest, True
+
+        progress = await self.stream_push(docker_client, target, repository, tag, report)
+        if report:
+            push_throughput.record(progress.summary())
+            self.completion_spec.docker_push_log = progress.text()
+            self.completion_spec.push_progress = progress.summary()
+        digest = progress.digest
+        if digest is None:
+            log.warning(f'push of {repository}:{tag} reported no digest - asking the registry')
+            digest = await pushed_digest(target, repository, tag, self.settings.REGISTRY_TIMEOUT)
+        return digest, False
+
+    async def stream_push(self, docker_client, target, repository, tag, report=True):
+        """
+        Push repository:tag, folding its output into a PushProgress and,
+        with report, reporting progress as it goes. Raises RegistryError if
+        docker reported an error during the push.
+        """
+        auth_dict = {'username': target.username,
+                     'password': target.password}
+
+        push_stream = await run_in_threadpool(docker_client.push,
+                                              repository=repository,
+                                              stream=True,
+                                              decode=True,
+                                              tag=tag,
+                                              auth_config=auth_dict)
+        progress = PushProgress()
+        async for line in iterate_in_threadpool(push_stream):
+            message = progress.update(line)
+            if message is not None:
+                self.build_log.append(message, stream='push')
+            if 'unauthorized' in str(line.get('error', '')).lower():
+                # the cached login is no longer good, log in again next time
+                registry_auth.invalidate(target.username, target.url)
+            if report and progress.due(self.settings.PUSH_PROGRESS_INTERVAL):
+                self.report_push_progress(progress)
+        progress.finish()
+        log.info(f'push of {repository}:{tag}: {progress.text()}')
+        if report and self._progress_update is not None:
+            await self._progress_update
+        if progress.errors:
+            raise RegistryError(f'push of {repository}:{tag} failed: {"; ".join(progress.errors)}')
+        return progress
+
+    def report_push_progress(self, progress):
+        """
+        Send the push progress so far with a status update, without waiting
+        for it. An update still in flight is not followed by another.
+        """
+        self.completion_spec.push_progress = progress.summary()
+        if self._progress_update is None or self._progress_update.done():
+            self._progress_update = asyncio.create_task(self.update_status(BuildStatus.building))
 
     def start_build(self, RUN_ID):
-
-        if self.build_status == BuildStatus.ready:
+        """
+        Decide whether the server identified by RUN_ID should run this build,
+        based on the phase it was last recorded in. Blocking; builds from a
+        previous server are cleaned up before returning True.
+        """
+        if self.build_spec.build_status == BuildStatus.ready:
             # nothing to do
             return False
-        elif self.build_status == BuildStatus.failed:
+        elif self.build_spec.build_status == BuildStatus.failed:
             # already failed, not going to change
             return False
-        elif (self.build_status == BuildStatus.building and self.RUN_ID == RUN_ID):
-            # build already started by this server
+        elif str(self.build_spec.RUN_ID) == str(RUN_ID):
+            # build already queued or started by this server
             return False
-        elif self.build_status == BuildStatus.building:
-            # build from a previous (crashed) server, clean up
-            # await build.remove(db, container_id)
-
-            # TODO: removed due to circular import, but what does this do?
-            # build.remove(self.container_id)
-            pass
 
-        self.build_status = BuildStatus.building
+        # build from a previous (crashed) server, clean up
+        self.remove_stale_build()
         return True
 
-    def delete_temp_dir(self):
+    def remove_stale_build(self):
+        """
+        Kill the process group of a build left behind by a crashed server and
+        remove its temp dir. The pid is only trusted if it still belongs to a
+        build process, since it may have been reused after a reboot.
+        """
+        if self.build_pid and self._is_build_process(self.build_pid):
+            log.info(f'killing stale build process group {self.build_pid}')
+            try:
+                os.killpg(self.build_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        if self.temp_dir and os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            log.info(f'stale temp dir {self.temp_dir} removed.')
+        if self.temp_dir:
+            remove_file(self.temp_dir + '.payload')
+
+    @staticmethod
+    def _is_build_process(pid):
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                cmdline = f.read().decode(errors='replace')
+        except OSError:
+            return False
+        return any(name in cmdline for name in BUILD_PROCESS_NAMES)
+
+    async def delete_temp_dir(self):
         try:
-            shutil.rmtree(self.temp_dir)
+            if self.payload_path is not None:
+                await run_in_threadpool(remove_file, self.payload_path)
+            await run_in_threadpool(shutil.rmtree, self.temp_dir)
             log.info(f'{self.temp_dir} removed.')
         except Exception:
             deletion_message = f'Exception during deletion of temp_dir at {self.temp_dir}!'
-            self.log_error(deletion_message)
+            await self.log_error(deletion_message)
 
-    def log_error(self, err_msg):
+    async def log_error(self, err_msg):
         log.error(err_msg)
         self.err_msg = err_msg
-        self.update_status(BuildStatus.failed)
+        await self.update_status(BuildStatus.failed)
+
+
+def write_chunk(payload_file, hasher, chunk):
+    payload_file.write(chunk)
+    hasher.update(chunk)
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
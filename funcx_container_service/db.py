@@ -0,0 +1,102 @@
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import Column, Float, Integer, String, Text, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from .models import BuildStatus
+
+log = logging.getLogger("funcx_container_service")
+
+Base = declarative_base()
+
+
+class BuildRecord(Base):
+    __tablename__ = 'builds'
+
+    build_id = Column(String, primary_key=True)
+    container_id = Column(String, index=True)
+    RUN_ID = Column(String, index=True)
+    container_spec = Column(Text)
+    phase = Column(String, index=True)
+    temp_dir = Column(String)
+    pid = Column(Integer)
+    created = Column(Float)
+    updated = Column(Float)
+
+
+class BuildStore():
+
+    """
+    SQLite-backed record of every build this node has accepted and the phase
+    it last reached, so a restarted server can find builds that were queued
+    or running under a previous RUN_ID. Calls are blocking; callers on the
+    event loop should run them in the threadpool.
+    """
+
+    def __init__(self, db_url):
+        self.db_url = db_url
+        self._lock = threading.Lock()
+        self._sessionmaker = None
+
+    def _session(self):
+        with self._lock:
+            if self._sessionmaker is None:
+                if self.db_url.startswith('sqlite:///'):
+                    db_dir = os.path.dirname(self.db_url[len('sqlite:///'):])
+                    if db_dir:
+                        os.makedirs(db_dir, exist_ok=True)
+                engine = create_engine(self.db_url, connect_args={'check_same_thread': False})
+                Base.metadata.create_all(engine)
+                self._sessionmaker = sessionmaker(bind=engine, expire_on_commit=False)
+        return self._sessionmaker()
+
+    def save(self, container):
+        now = time.time()
+        with self._session() as session:
+            record = session.get(BuildRecord, str(container.build_spec.build_id))
+            if record is None:
+                record = BuildRecord(build_id=str(container.build_spec.build_id), created=now)
+                session.add(record)
+            record.container_id = str(container.container_spec.container_id)
+            record.RUN_ID = str(container.build_spec.RUN_ID)
+            record.container_spec = container.container_spec.json()
+            record.phase = container.build_spec.build_status and BuildStatus(container.build_spec.build_status).value
+            record.temp_dir = container.temp_dir
+            record.pid = container.build_pid
+            record.updated = now
+            session.commit()
+
+    def get(self, build_id):
+        with self._session() as session:
+            return session.get(BuildRecord, str(build_id))
+
+    def orphaned(self, RUN_ID):
+        """
+        Builds left queued or building by a server other than RUN_ID.
+        """
+        with self._session() as session:
+            return (session.query(BuildRecord)
+                    .filter(BuildRecord.RUN_ID != str(RUN_ID))
+                    .filter(BuildRecord.phase.in_([BuildStatus.queued.value, BuildStatus.building.value]))
+                    .order_by(BuildRecord.created)
+                    .all())
+
+    def prune(self, max_age):
+        """
+        Delete finished builds last updated more than max_age seconds ago.
+        Queued and running builds are kept however old they are. Returns
+        the number of builds deleted.
+        """
+        cutoff = time.time() - max_age
+        with self._session() as session:
+            deleted = (session.query(BuildRecord)
+                       .filter(BuildRecord.phase.in_([BuildStatus.ready.value, BuildStatus.failed.value]))
+                       .filter(BuildRecord.updated < cutoff)
+                       .delete(synchronize_session=False))
+            session.commit()
+        if deleted:
+            log.info(f'pruned {deleted} finished builds older than {max_age}s from the build store')
+        return deleted
@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+
+import docker
+
+from .config import Settings
+
+log = logging.getLogger("funcx_container_service")
+
+
+class DockerClientPool():
+
+    """
+    Process-wide docker API clients, one per daemon URL. Each client connects
+    (and negotiates its API version) once and is shared by every build. A
+    client that has been idle for longer than health_check_interval seconds
+    is pinged before it is handed out, and replaced if the ping fails.
+    docker.APIClient pools its connections, so sharing it across threads is
+    safe.
+    """
+
+    def __init__(self, health_check_interval):
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._versions = {}
+        self._last_used = {}
+
+    def get(self, base_url):
+        # only bookkeeping happens under the lock, so a slow or hung daemon
+        # holds up callers for that daemon alone
+        with self._lock:
+            client = self._clients.get(base_url)
+            now = time.time()
+            check = client is not None and now - self._last_used[base_url] > self.health_check_interval
+            if client is not None:
+                self._last_used[base_url] = now
+
+        if check:
+            try:
+                client.ping()
+            except Exception as e:
+                log.warning(f'docker client for {base_url} failed health check ({e!r}) - reconnecting')
+                with self._lock:
+                    if self._clients.get(base_url) is client:
+                        self._discard(base_url)
+                close_client(client)
+                client = None
+
+        if client is None:
+            created = docker.APIClient(base_url=base_url)
+            with self._lock:
+                client = self._clients.setdefault(base_url, created)
+                self._last_used[base_url] = time.time()
+            if client is not created:
+                # another caller connected first
+                close_client(created)
+        return client
+
+    def version(self, base_url):
+        """
+        The daemon's version information, fetched once per client
+        """
+        client = self.get(base_url)
+        with self._lock:
+            if self._clients.get(base_url) is client and base_url in self._versions:
+                return self._versions[base_url]
+        version = client.version()
+        with self._lock:
+            if self._clients.get(base_url) is client:
+                self._versions[base_url] = version
+        return version
+
+    def _discard(self, base_url):
+        self._versions.pop(base_url, None)
+        return self._clients.pop(base_url, None)
+
+    def reset(self):
+        with self._lock:
+            clients = [self._discard(base_url) for base_url in list(self._clients)]
+        for client in clients:
+            close_client(client)
+
+
+def close_client(client):
+    try:
+        client.close()
+    except Exception:
+        pass
+
+
+class RegistryAuthCache():
+
+    """
+    Remembers successful registry logins for ttl seconds so a push does not
+    have to log in to the registry every time.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._logins = {}
+
+    def login(self, docker_client, username, password, registry):
+        key = (registry, username)
+        with self._lock:
+            cached = self._logins.get(key)
+            if cached is not None and time.time() - cached[0] < self.ttl:
+                return cached[1]
+
+        response = docker_client.login(username=username, password=password, registry=registry)
+        if response.get('Status') == 'Login Succeeded':
+            with self._lock:
+                self._logins[key] = (time.time(), response)
+        return response
+
+    def invalidate(self, username, registry):
+        with self._lock:
+            self._logins.pop((registry, username), None)
+
+
+def cli_docker_host(base_url):
+    """
+    docker-py accepts 'unix://var/run/docker.sock', but the docker CLI needs
+    an absolute socket path
+    """
+    if base_url.startswith('unix://') and not base_url.startswith('unix:///'):
+        return 'unix:///' + base_url[len('unix://'):]
+    return base_url
+
+
+settings = Settings()
+
+docker_clients = DockerClientPool(settings.DOCKER_HEALTH_CHECK_INTERVAL)
+registry_auth = RegistryAuthCache(settings.REGISTRY_AUTH_TTL)
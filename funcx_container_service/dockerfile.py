@@ -1,5 +1,9 @@
+import hashlib
+import re
 import shlex
 
+from .models import CondaSolver
+
 # flake8: noqa E501
 
 HEADER = r"""
@@ -339,12 +343,89 @@ RUN ${{KERNEL_PYTHON_PREFIX}}/bin/pip install --no-cache-dir {}
 CONDA = r"""USER root
 RUN chown -R ${{NB_USER}}:${{NB_USER}} ${{REPO_DIR}}
 USER ${{NB_USER}}
-RUN conda install -p ${{NB_PYTHON_PREFIX}} {} && \
+RUN {install} -p ${{NB_PYTHON_PREFIX}} {pkgs} && \
 conda clean --all -f -y && \
 conda list -p ${{NB_PYTHON_PREFIX}}
 
 """
 
+# The same installs with BuildKit cache mounts holding the downloaded
+# packages. Mounts are not part of the image, so nothing needs cleaning up.
+# apt archives live outside /var/cache/apt, which the base image's
+# docker-clean hook empties after every install.
+APT_CACHED = r"""
+RUN --mount=type=cache,id=funcx-apt-archives,target=/tmp/apt-archives,sharing=locked \
+    --mount=type=cache,id=funcx-apt-lists,target=/var/lib/apt/lists,sharing=locked \
+apt-get -qq update && \
+apt-get install --yes --no-install-recommends -o Dir::Cache::Archives=/tmp/apt-archives {}
+
+"""
+
+PIP_CACHED = r"""
+USER ${{NB_USER}}
+RUN --mount=type=cache,id=funcx-pip,target=/tmp/pip-cache,uid=1000,gid=1000 \
+PIP_CACHE_DIR=/tmp/pip-cache ${{KERNEL_PYTHON_PREFIX}}/bin/pip install {}
+
+"""
+
+CONDA_CACHED = r"""USER root
+RUN chown -R ${{NB_USER}}:${{NB_USER}} ${{REPO_DIR}}
+USER ${{NB_USER}}
+RUN --mount=type=cache,id=funcx-conda,target=/tmp/conda-pkgs,uid=1000,gid=1000 \
+CONDA_PKGS_DIRS=/tmp/conda-pkgs {install} -p ${{NB_PYTHON_PREFIX}} {pkgs} && \
+conda list -p ${{NB_PYTHON_PREFIX}}
+
+"""
+
+# Installs from a stored lock, bind-mounted from the LOCK_CONTEXT named
+# build context, which the build points at LOCK_DIR. The lock is kept out of
+# the main context so that COPY . never puts it in the image. The conda
+# lock is an explicit package list, which conda and micromamba install
+# without solving.
+LOCK_DIR = '.funcx-lock'
+LOCK_CONTEXT = 'funcx-lock'
+
+CONDA_LOCKED = r"""# lock {lock}
+USER root
+RUN chown -R ${{NB_USER}}:${{NB_USER}} ${{REPO_DIR}}
+USER ${{NB_USER}}
+RUN --mount=type=bind,from=funcx-lock,target=/tmp/funcx-lock{mounts} \
+{env}{install} -p ${{NB_PYTHON_PREFIX}} --file /tmp/funcx-lock/conda.txt{clean}
+
+"""
+
+PIP_LOCKED = r"""# lock {lock}
+USER ${{NB_USER}}
+RUN --mount=type=bind,from=funcx-lock,target=/tmp/funcx-lock{mounts} \
+{env}${{KERNEL_PYTHON_PREFIX}}/bin/pip install --no-deps -r /tmp/funcx-lock/pip.txt
+
+"""
+
+CONDA_INSTALL = {
+    CondaSolver.conda: 'conda install --yes',
+    CondaSolver.micromamba: 'micromamba install --yes --root-prefix ${{CONDA_DIR}} -c conda-forge',
+}
+
+# micromamba is a single static binary, added ahead of the first conda layer.
+# The version is pinned, so builds are reproducible and a new version
+# changes the layer text (and with it the layer keys).
+MICROMAMBA_VERSION = '1.5.10'
+
+MICROMAMBA = r"""
+USER root
+RUN wget -qO- https://micro.mamba.pm/api/micromamba/linux-64/{version} | tar -xj -C /usr/local bin/micromamba
+
+"""
+
+# cache mounts need the dockerfile frontend to be selected explicitly
+SYNTAX = '# syntax=docker/dockerfile:1\n'
+
+COPY_CONTEXT = r"""
+USER root
+COPY --chown=${NB_USER}:${NB_USER} . ${REPO_DIR}
+
+"""
+
 FOOTER = r"""
 # Container image Labels!
 # Put these at the end, since we don't want to rebuild everything
@@ -379,23 +460,144 @@ CMD ["jupyter", "notebook", "--ip", "0.0.0.0"]
 """
 
 
-def emit_apt(apt_pkgs):
+# content-addressed version of the image built from HEADER alone
+BASE_IMAGE_VERSION = hashlib.sha256(HEADER.encode()).hexdigest()[:16]
+
+# widely used packages get a layer of their own ahead of everything else, so
+# that specs asking for them share that layer
+POPULAR_PACKAGES = {
+    'apt': {'build-essential', 'curl', 'g++', 'gcc', 'git', 'gfortran', 'libgl1', 'make', 'wget', 'unzip'},
+    'conda': {'matplotlib', 'numpy', 'pandas', 'pip', 'python', 'requests', 'scikit-learn', 'scipy'},
+    'pip': {'beautifulsoup4', 'matplotlib', 'numpy', 'pandas', 'pyyaml', 'requests', 'scikit-learn', 'scipy',
+            'six', 'torch', 'tqdm'},
+}
+
+# layer order within each package manager, most widely shared first
+TIERS = ('popular', 'pinned', 'tail')
+
+
+def emit_apt(apt_pkgs, cache_mounts=False):
     if not apt_pkgs:
         return ''
-    return APT.format(' '.join([shlex.quote(x) for x in apt_pkgs]))
+    return (APT_CACHED if cache_mounts else APT).format(' '.join([shlex.quote(x) for x in apt_pkgs]))
 
 
-def emit_conda(conda_pkgs):
+def emit_conda(conda_pkgs, cache_mounts=False, solver=CondaSolver.conda):
     if not conda_pkgs:
         return ''
-    return CONDA.format(' '.join([shlex.quote(x) for x in conda_pkgs]))
+    template = CONDA_CACHED if cache_mounts else CONDA
+    return template.format(install=CONDA_INSTALL[solver].format(),
+                           pkgs=' '.join([shlex.quote(x) for x in conda_pkgs]))
 
 
-def emit_pip(pip_pkgs):
+def emit_pip(pip_pkgs, cache_mounts=False):
     if not pip_pkgs:
         return ''
-    return PIP.format(' '.join([shlex.quote(x) for x in pip_pkgs]))
-
-
-def emit_dockerfile(apt_pkgs, conda_pkgs, pip_pkgs):
-    return HEADER + emit_apt(apt_pkgs or []) + emit_conda(conda_pkgs or []) + emit_pip(pip_pkgs or []) + FOOTER
+    return (PIP_CACHED if cache_mounts else PIP).format(' '.join([shlex.quote(x) for x in pip_pkgs]))
+
+
+def emit_locked(manager, lock, cache_mounts=False, solver=CondaSolver.conda):
+    if manager == 'conda':
+        if cache_mounts:
+            return CONDA_LOCKED.format(lock=lock, install=CONDA_INSTALL[solver].format(),
+                                       mounts=' --mount=type=cache,id=funcx-conda,target=/tmp/conda-pkgs,uid=1000,gid=1000',
+                                       env='CONDA_PKGS_DIRS=/tmp/conda-pkgs ', clean='')
+        return CONDA_LOCKED.format(lock=lock, install=CONDA_INSTALL[solver].format(),
+                                   mounts='', env='', clean=' && \\\nconda clean --all -f -y')
+    if cache_mounts:
+        return PIP_LOCKED.format(lock=lock,
+                                 mounts=' --mount=type=cache,id=funcx-pip,target=/tmp/pip-cache,uid=1000,gid=1000',
+                                 env='PIP_CACHE_DIR=/tmp/pip-cache ')
+    return PIP_LOCKED.format(lock=lock, mounts='', env='')
+
+
+EMITTERS = {'apt': emit_apt, 'conda': emit_conda, 'pip': emit_pip}
+
+
+def package_name(pkg):
+    return re.split(r'[=<>!~\[;@ ]', pkg, maxsplit=1)[0].lower()
+
+
+def package_tier(manager, pkg):
+    if package_name(pkg) in POPULAR_PACKAGES[manager]:
+        return 'popular'
+    if '=' in pkg:
+        return 'pinned'
+    return 'tail'
+
+
+def plan_layers(apt_pkgs, conda_pkgs, pip_pkgs):
+    """
+    Split the packages of each package manager into tiers - popular
+    packages, then other pinned packages, then the long tail - and sort
+    each tier, so the layers of specs that share packages come out
+    identical regardless of the order the packages were requested in.
+    Returns a list of (package manager, tier, packages), one per layer.
+    """
+    plan = []
+    for manager, pkgs in (('apt', apt_pkgs), ('conda', conda_pkgs), ('pip', pip_pkgs)):
+        tiers = {tier: [] for tier in TIERS}
+        for pkg in sorted(set(pkgs or []), key=lambda p: (package_name(p), p)):
+            tiers[package_tier(manager, pkg)].append(pkg)
+        plan.extend((manager, tier, tiers[tier]) for tier in TIERS if tiers[tier])
+    return plan
+
+
+def layer_texts(plan, cache_mounts=False, conda_solver=CondaSolver.conda, lock=None,
+                micromamba_version=MICROMAMBA_VERSION):
+    """
+    The Dockerfile text of each layer of a plan. With a lock, the conda and
+    pip tiers are replaced by a single install from the lock each.
+    """
+    texts = []
+    needs_micromamba = conda_solver == CondaSolver.micromamba
+    locked = set()
+    for manager, _, pkgs in plan:
+        if lock and manager in ('conda', 'pip'):
+            if manager in locked:
+                continue
+            locked.add(manager)
+            text = emit_locked(manager, lock, cache_mounts, conda_solver)
+        elif manager == 'conda':
+            text = emit_conda(pkgs, cache_mounts, conda_solver)
+        else:
+            text = EMITTERS[manager](pkgs, cache_mounts)
+        if manager == 'conda' and needs_micromamba:
+            text = MICROMAMBA.format(version=micromamba_version) + text
+            needs_micromamba = False
+        texts.append(text)
+    return texts
+
+
+def emit_layers(plan, cache_mounts=False, conda_solver=CondaSolver.conda, lock=None,
+                micromamba_version=MICROMAMBA_VERSION):
+    return ''.join(layer_texts(plan, cache_mounts, conda_solver, lock, micromamba_version))
+
+
+def layer_keys(plan, base, cache_mounts=False, conda_solver=CondaSolver.conda, lock=None,
+               micromamba_version=MICROMAMBA_VERSION):
+    """
+    Identify each layer of a plan by a digest of its instructions and
+    everything beneath it, as the docker build cache does.
+    """
+    keys = []
+    key = base
+    for text in layer_texts(plan, cache_mounts, conda_solver, lock, micromamba_version):
+        key = hashlib.sha256((key + text).encode()).hexdigest()
+        keys.append(key)
+    return keys
+
+
+def emit_base():
+    return HEADER
+
+
+def emit_dockerfile(apt_pkgs, conda_pkgs, pip_pkgs, copy_context=False, base_image=None, cache_mounts=False,
+                    conda_solver=CondaSolver.conda, lock=None, micromamba_version=MICROMAMBA_VERSION):
+    # a prebuilt base image already holds everything HEADER sets up
+    header = f'FROM {base_image}\nUSER root\n' if base_image else HEADER
+    if cache_mounts or lock:
+        header = SYNTAX + header
+    copy = COPY_CONTEXT if copy_context else ''
+    plan = plan_layers(apt_pkgs, conda_pkgs, pip_pkgs)
+    return header + emit_layers(plan, cache_mounts, conda_solver, lock, micromamba_version) + copy + FOOTER
@@ -23,6 +23,22 @@ class BuildType(str, Enum):
     container = 'container'
 
 
+class CondaSolver(str, Enum):
+    """
+    Tool used to solve and install conda packages in native builds
+    """
+    conda = 'conda'
+    micromamba = 'micromamba'
+
+
+class BuildBackend(str, Enum):
+    """
+    Tool used to turn a spec into a docker image
+    """
+    repo2docker = 'repo2docker'
+    docker = 'docker'
+
+
 class ContainerSpec(BaseModel):
     """Software specification for a container.
 
@@ -33,6 +49,7 @@ class ContainerSpec(BaseModel):
     - `apt`: optional list of package names to be installed via apt-get
     - `pip`: optional list of pip requirements (name and optional version specifier)
     - `conda`: optional list of conda requirements (name and optional version specifier)
+    - `force_solve`: solve the environment afresh instead of installing a stored lock
 
     To specify the version of Python to use, include it in the
     `conda` package list.
@@ -46,11 +63,17 @@ class ContainerSpec(BaseModel):
     apt: Optional[List[constr(regex=r'^[a-z0-9.+-]+$')]]  # noqa: F722
     pip: Optional[List[str]]
     conda: Optional[List[str]]
+    force_solve: bool = False
 
     def digest(self):
-        tmp = self.dict()
+        """
+        Canonical hash of the software in the spec. The container_id and
+        force_solve are left out so that identical specs submitted under
+        different ids share a digest.
+        """
+        tmp = self.dict(exclude={'container_id', 'force_solve'})
         for k, v in tmp.items():
-            if v:
+            if isinstance(v, list):
                 v.sort()
         canonical = json.dumps(tmp, sort_keys=True)
         return hashlib.sha256(canonical.encode()).hexdigest()
@@ -79,10 +102,41 @@ class CompletionSpec(BaseModel):
     registry_repository: str = None
     registry_user: str = None
     docker_push_log: str = None
+    push_progress: dict = None
+    push_skipped: bool = False
+    push_bytes_saved: int = None
+    push_time_saved: float = None
     image_tag: str = None
+    image_immutable_tag: str = None
+    image_digest: str = None
     image_pull_command: str = None
+    image_pull_commands: dict = None
+    registry_pushes: list = None
     container_build_time: float = None
     container_push_time: float = None
+    build_backend: BuildBackend = None
+    base_image: str = None
+    layer_cache_hit_ratio: float = None
+    package_cache_hits: int = None
+    package_cache_misses: int = None
+    conda_solver: CondaSolver = None
+    solve_time: float = None
+    lockfile_digest: str = None
+    incremental_base_image: str = None
+    incremental_time_saved: float = None
+    payload_digest: str = None
+    payload_cache_hit: bool = False
+    sif_cache_hit: bool = False
+    sif_size: int = None
+    sif_conversion_time: float = None
+    sif_push_time: float = None
+    sif_uri: str = None
+    sif_pull_command: str = None
+    queue_wait_time: float = None
+    spec_digest: str = None
+    cache_hit: bool = False
+    cached_image: str = None
+    coalesced_build_id: str = None
 
 
 class StatusUpdate(BaseModel):
@@ -0,0 +1,424 @@
+import asyncio
+import base64
+import json
+import logging
+import re
+import time
+
+import httpx
+from fastapi.concurrency import run_in_threadpool
+
+log = logging.getLogger("funcx_container_service")
+
+# push output for a layer the registry did not need uploaded
+EXISTING_LAYER_STATUSES = ('Layer already exists', 'Mounted from')
+# errors kept in a push summary
+MAX_PUSH_ERRORS = 5
+
+DOCKER_HUB = 'registry-1.docker.io'
+MANIFEST_TYPES = ('application/vnd.docker.distribution.manifest.v2+json',
+                  'application/vnd.oci.image.manifest.v1+json')
+INDEX_TYPES = ('application/vnd.docker.distribution.manifest.list.v2+json',
+               'application/vnd.oci.image.index.v1+json')
+
+
+class PushProgress():
+
+    """
+    Running summary of the output of docker push, kept per layer instead of
+    per line: each layer's last status and bytes uploaded, plus the pushed
+    manifest digest and any errors. Memory stays proportional to the number
+    of layers however many progress lines the push produces.
+    """
+
+    def __init__(self):
+        self.layers = {}
+        self.errors = []
+        self.digest = None
+        self.start_time = time.time()
+        self.end_time = None
+        self.reported_time = self.start_time
+
+    def update(self, line):
+        """
+        Fold one decoded line of push output into the summary. Returns a
+        short message when a layer changes state or the push reports an
+        error, and None for progress ticks.
+        """
+        if 'error' in line:
+            message = (line.get('errorDetail') or {}).get('message') or line['error']
+            self.errors = (self.errors + [message])[-MAX_PUSH_ERRORS:]
+            return f'error: {message}'
+
+        aux = line.get('aux')
+        if aux and aux.get('Digest'):
+            self.digest = aux['Digest']
+            return None
+
+        layer_id = line.get('id')
+        status = line.get('status')
+        if not layer_id or not status:
+            return None
+
+        layer = self.layers.setdefault(layer_id, {'status': None, 'current': 0, 'total': None})
+        detail = line.get('progressDetail') or {}
+        if detail.get('current') is not None:
+            layer['current'] = detail['current']
+        if detail.get('total'):
+            layer['total'] = detail['total']
+        if status == 'Pushed' and layer['total']:
+            layer['current'] = layer['total']
+
+        if layer['status'] == status:
+            return None
+        layer['status'] = status
+        return f'{layer_id}: {status}'
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def due(self, interval):
+        """
+        Whether interval seconds have passed since progress was last reported
+        """
+        now = time.time()
+        if now - self.reported_time < interval:
+            return False
+        self.reported_time = now
+        return True
+
+    def summary(self):
+        statuses = [layer['status'] for layer in self.layers.values()]
+        bytes_pushed = sum(layer['current'] for layer in self.layers.values()
+                           if not layer['status'].startswith(EXISTING_LAYER_STATUSES))
+        elapsed = (self.end_time or time.time()) - self.start_time
+        return {'layers': len(self.layers),
+                'layers_pushed': statuses.count('Pushed'),
+                'layers_existing': sum(status.startswith(EXISTING_LAYER_STATUSES) for status in statuses),
+                'bytes_pushed': bytes_pushed,
+                'push_seconds': round(elapsed, 3),
+                'throughput': round(bytes_pushed / elapsed) if elapsed > 0 else None,
+                'digest': self.digest,
+                'errors': list(self.errors),
+                'done': self.end_time is not None}
+
+    def text(self):
+        summary = self.summary()
+        text = (f"pushed {summary['layers_pushed']} of {summary['layers']} layers "
+                f"({summary['layers_existing']} already in the registry), "
+                f"{summary['bytes_pushed']} bytes in {summary['push_seconds']}s")
+        if summary['digest']:
+            text += f", digest {summary['digest']}"
+        if summary['errors']:
+            text += f"; errors: {'; '.join(summary['errors'])}"
+        return text
+
+
+class PushThroughput():
+
+    """
+    Moving average of the upload rate of recent pushes on this node, used
+    to estimate how long a push that was skipped would have taken
+    """
+
+    def __init__(self, weight=0.3):
+        self.weight = weight
+        self.rate = None
+
+    def record(self, summary):
+        if not summary['throughput'] or summary['bytes_pushed'] <= 0:
+            return
+        if self.rate is None:
+            self.rate = summary['throughput']
+        else:
+            self.rate = self.weight * summary['throughput'] + (1 - self.weight) * self.rate
+
+    def estimate(self, size):
+        return round(size / self.rate, 3) if self.rate else None
+
+
+push_throughput = PushThroughput()
+
+
+class RegistryError(Exception):
+    pass
+
+
+def immutable_tag(spec_digest, image_id):
+    """
+    A tag that only ever names one image, made from the digest of the spec
+    it was built for and the image's own ID
+    """
+    return f"{spec_digest[:16]}-{image_id.split(':')[-1][:16]}"
+
+
+def registry_host(settings):
+    """
+    Host part of REGISTRY_URL, which may be given as a URL, defaulting to
+    Docker Hub
+    """
+    return url_host(settings.REGISTRY_URL)
+
+
+def url_host(url):
+    url = re.sub(r'^https?://', '', url or 'docker.io')
+    return url.split('/')[0]
+
+
+class RegistryTarget():
+
+    """
+    A registry that built images are published to. The primary registry
+    (REGISTRY_URL) keeps its images under <username>/<image>, as docker
+    names them for Docker Hub; mirrors qualify them with their host.
+    """
+
+    def __init__(self, url, username, password, site=None, max_concurrent_pushes=2, qualified=True):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.host = url_host(url)
+        self.site = site or self.host
+        self.max_concurrent_pushes = max_concurrent_pushes
+        self.qualified = qualified
+
+    def repository(self, image_name):
+        if self.qualified:
+            return f'{self.host}/{self.username}/{image_name}'
+        return f'{self.username}/{image_name}'
+
+    def pull_reference(self, image_name):
+        return f'{self.host}/{self.username}/{image_name}'
+
+
+def registry_targets(settings):
+    """
+    The registries to publish to: the primary registry followed by each of
+    REGISTRY_MIRRORS
+    """
+    targets = [RegistryTarget(settings.REGISTRY_URL, settings.REGISTRY_USERNAME, settings.REGISTRY_PWD,
+                              max_concurrent_pushes=settings.REGISTRY_MAX_CONCURRENT_PUSHES, qualified=False)]
+    for mirror in settings.REGISTRY_MIRRORS:
+        targets.append(RegistryTarget(mirror.url, mirror.username, mirror.password, mirror.site,
+                                      mirror.max_concurrent_pushes))
+    return targets
+
+
+class PushSlots():
+
+    """
+    Semaphores limiting concurrent pushes to each registry, shared by every
+    build on this node. A registry is identified by its whole configuration
+    - URL, user and limit - so a target whose limit differs from another's
+    for the same registry and user gets a semaphore of its own rather than
+    silently sharing the first one created.
+    """
+
+    def __init__(self):
+        self._slots = {}
+
+    def get(self, target):
+        key = (target.url, target.username, target.max_concurrent_pushes)
+        if key not in self._slots:
+            self._slots[key] = asyncio.Semaphore(target.max_concurrent_pushes)
+        return self._slots[key]
+
+    def reset(self):
+        self._slots.clear()
+
+
+push_slots = PushSlots()
+
+
+def split_repository(name):
+    """
+    Registry host and repository path of a docker image name, resolved the
+    way docker resolves them
+    """
+    first, _, rest = name.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        host, path = first, rest
+    else:
+        host, path = DOCKER_HUB, name if rest else f'library/{name}'
+    if host in ('docker.io', 'index.docker.io'):
+        host = DOCKER_HUB
+    return host, path
+
+
+class RegistryClient():
+
+    """
+    Just enough of the registry HTTP API (v2) to look up manifests and
+    blobs, mount blobs from one repository into another and write tags.
+    Answers a basic or bearer token challenge once per client, asking for
+    the given scopes.
+    """
+
+    def __init__(self, host, username, password, scopes, timeout):
+        scheme = 'http' if host.split(':')[0] in ('localhost', '127.0.0.1') else 'https'
+        self.base_url = f'{scheme}://{host}/v2/'
+        self.auth = (username, password or '') if username else None
+        self.scopes = scopes
+        self._authorization = None
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(timeout), follow_redirects=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._client.aclose()
+
+    async def _request(self, method, path, headers=None, **kwargs):
+        headers = dict(headers or {})
+        if self._authorization:
+            headers['Authorization'] = self._authorization
+        response = await self._client.request(method, self.base_url + path, headers=headers, **kwargs)
+        if response.status_code == 401 and self._authorization is None:
+            self._authorization = await self._authorize(response.headers.get('WWW-Authenticate', ''))
+            headers['Authorization'] = self._authorization
+            response = await self._client.request(method, self.base_url + path, headers=headers, **kwargs)
+        return response
+
+    async def _authorize(self, challenge):
+        scheme, _, params = challenge.partition(' ')
+        if scheme.lower() == 'basic' and self.auth is not None:
+            return 'Basic ' + base64.b64encode(':'.join(self.auth).encode()).decode()
+        if scheme.lower() != 'bearer':
+            raise RegistryError(f'unsupported registry authentication challenge: {challenge!r}')
+
+        fields = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        query = [('service', fields['service'])] if 'service' in fields else []
+        query += [('scope', scope) for scope in self.scopes]
+        response = await self._client.get(fields['realm'], params=query, auth=self.auth)
+        if response.status_code != 200:
+            raise RegistryError(f'registry token request returned {response.status_code}')
+        body = response.json()
+        return f"Bearer {body.get('token') or body.get('access_token')}"
+
+    async def manifest_digest(self, repository, reference):
+        """
+        Digest of the manifest repository has under reference, or None
+        """
+        response = await self._request('HEAD', f'{repository}/manifests/{reference}',
+                                       headers={'Accept': ', '.join(MANIFEST_TYPES + INDEX_TYPES)})
+        if response.status_code == 404:
+            return None
+        self._check(response, 200)
+        return response.headers.get('Docker-Content-Digest')
+
+    async def manifest(self, repository, digest):
+        response = await self._request('GET', f'{repository}/manifests/{digest}',
+                                       headers={'Accept': ', '.join(MANIFEST_TYPES + INDEX_TYPES)})
+        self._check(response, 200)
+        return response.content, response.headers.get('Content-Type', '').split(';')[0]
+
+    async def has_blob(self, repository, digest):
+        response = await self._request('HEAD', f'{repository}/blobs/{digest}')
+        if response.status_code == 404:
+            return False
+        self._check(response, 200)
+        return True
+
+    async def mount_blob(self, repository, digest, source):
+        """
+        Link a blob of source into repository without uploading it. Returns
+        False if the registry would not mount it.
+        """
+        response = await self._request('POST', f'{repository}/blobs/uploads/',
+                                       params={'mount': digest, 'from': source})
+        if response.status_code == 201:
+            return True
+        if response.status_code == 202 and response.headers.get('Location'):
+            # the registry started an upload instead - abandon it
+            await self._client.delete(httpx.URL(self.base_url).join(response.headers['Location']),
+                                      headers={'Authorization': self._authorization or ''})
+        return False
+
+    async def put_manifest(self, repository, tag, content, media_type):
+        response = await self._request('PUT', f'{repository}/manifests/{tag}',
+                                       headers={'Content-Type': media_type}, content=content)
+        self._check(response, 201)
+
+    def _check(self, response, expected):
+        if response.status_code != expected:
+            raise RegistryError(f'{response.request.method} {response.request.url} returned {response.status_code}')
+
+
+async def pushed_digest(registry_target, repository, tag, timeout):
+    """
+    Digest of the manifest the registry holds for repository:tag, asked of
+    the registry itself. Raises RegistryError if it has none.
+    """
+    host, path = split_repository(repository)
+    async with RegistryClient(host, registry_target.username, registry_target.password,
+                              [f'repository:{path}:pull'], timeout) as registry:
+        digest = await registry.manifest_digest(path, tag)
+    if digest is None:
+        raise RegistryError(f'{repository}:{tag} is not in the registry after pushing it')
+    return digest
+
+
+async def tag_existing_image(docker_client, registry_target, image_name, repository, tag, timeout):
+    """
+    Write repository:tag straight into the registry when the registry
+    already has the content of the local image, either in repository or in
+    another repository the image was pushed to before (its RepoDigests).
+    Missing blobs are mounted across from that repository and the manifest
+    is written under the new tag, so no layer is uploaded. The registry is
+    accessed with registry_target's credentials. Returns the manifest
+    digest and the bytes the registry already had, or None if the image has
+    to be pushed.
+    """
+    inspect = await run_in_threadpool(docker_client.inspect_image, image_name)
+    host, target = split_repository(repository)
+    candidates = []
+    for repo_digest in inspect.get('RepoDigests') or []:
+        name, _, digest = repo_digest.partition('@')
+        source_host, source = split_repository(name)
+        if source_host == host:
+            candidates.append((source, digest))
+    if not candidates:
+        return None
+    # the target repository itself needs no mounts
+    candidates.sort(key=lambda candidate: candidate[0] != target)
+
+    scopes = [f'repository:{target}:pull,push'] + [f'repository:{source}:pull'
+                                                   for source, _ in candidates if source != target]
+    async with RegistryClient(host, registry_target.username, registry_target.password, scopes,
+                              timeout) as registry:
+        for source, digest in candidates:
+            try:
+                size = await copy_manifest(registry, source, digest, target, tag)
+            except (httpx.HTTPError, RegistryError, ValueError, KeyError) as e:
+                log.info(f'could not reuse {source}@{digest} for {repository}:{tag}: {e}')
+                continue
+            if size is not None:
+                log.info(f'{repository}:{tag} written from {source}@{digest} without pushing {size} bytes')
+                return digest, size
+    return None
+
+
+async def copy_manifest(registry, source, digest, target, tag):
+    if await registry.manifest_digest(source, digest) is None:
+        return None
+    content, media_type = await registry.manifest(source, digest)
+    if media_type in INDEX_TYPES:
+        # the platform manifests of an index cannot be mounted
+        if source != target:
+            return None
+        blobs = []
+    elif media_type in MANIFEST_TYPES:
+        manifest = json.loads(content)
+        blobs = [manifest['config']] + manifest['layers']
+    else:
+        return None
+
+    if source != target:
+        for blob in blobs:
+            if not await registry.has_blob(target, blob['digest']) and \
+                    not await registry.mount_blob(target, blob['digest'], source):
+                return None
+
+    if await registry.manifest_digest(target, tag) != digest:
+        await registry.put_manifest(target, tag, content, media_type)
+    return sum(blob.get('size', 0) for blob in blobs)
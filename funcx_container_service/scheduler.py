@@ -0,0 +1,288 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+
+from fastapi.concurrency import run_in_threadpool
+
+from .build import background_build, coalesced_build
+from .buildlog import prune_saved_logs
+from .container import Container
+from .models import BuildStatus, ContainerSpec
+
+log = logging.getLogger("funcx_container_service")
+
+# finished builds kept in memory so their logs can still be followed
+RECENT_BUILDS = 20
+
+
+class SchedulerClosed(Exception):
+    pass
+
+
+class BuildScheduler():
+
+    """
+    Runs container builds on a fixed number of build slots, with a FIFO
+    queue in front of them. Builds waiting for a slot keep their place in
+    the queue so their position and wait time can be reported.
+
+    A build whose spec digest matches a build that is already queued or
+    running is attached to that build instead of being queued, unless it
+    asks for a forced solve. When the
+    leading build finishes, each attached build reuses its image.
+
+    When given a BuildStore, every submitted build is recorded in it so that
+    builds orphaned by a crash can be recovered on the next startup.
+
+    The last recent_builds finished builds are kept in memory. When given a
+    log_dir, the log of every build is also saved there under its build ID,
+    so that it outlives both the in-memory log and the server.
+    """
+
+    def __init__(self, max_concurrent_builds, shutdown_timeout, build_store=None,
+                 log_dir=None, recent_builds=RECENT_BUILDS):
+        self.max_concurrent_builds = max_concurrent_builds
+        self.shutdown_timeout = shutdown_timeout
+        self.build_store = build_store
+        self.log_dir = log_dir
+        self.recent_builds = recent_builds
+        self._queue = asyncio.Queue()
+        self._pending = OrderedDict()
+        self._running = {}
+        self._inflight = {}
+        self._attached = {}
+        self._forwarders = {}
+        self._attached_tasks = set()
+        self._finished = OrderedDict()
+        self._workers = []
+        self._accepting = True
+
+    def start(self):
+        log.info(f'Starting build scheduler with {self.max_concurrent_builds} build slots')
+        self._workers = [asyncio.create_task(self._worker(slot))
+                         for slot in range(self.max_concurrent_builds)]
+
+    async def submit(self, container: Container):
+        """
+        Add a build to the back of the queue and return its queue position
+        (1 being the next build to start). A build identical to one already
+        in flight shares that build's position instead.
+        """
+        if not self._accepting:
+            raise SchedulerClosed('build scheduler is shutting down')
+
+        container.queued_time = time.time()
+        build_id = str(container.build_spec.build_id)
+        if self.build_store is not None:
+            container.build_store = self.build_store
+            await container.save_state()
+        if self.log_dir is not None:
+            await run_in_threadpool(self._save_log, build_id, container)
+
+        # builds with a payload are not fully described by their digest
+        if container.container_spec.payload_url is None:
+            digest = container.container_spec.digest()
+            leader = self._inflight.get(digest)
+            # a forced solve must not take the lock of a build that is not solving afresh
+            if leader is not None and not container.container_spec.force_solve:
+                leader_id = str(leader.build_spec.build_id)
+                log.info(f'build {build_id} attached to identical build {leader_id}')
+                self._attached[build_id] = (container, leader)
+                self._forwarders[build_id] = asyncio.create_task(leader.build_log.forward(container.build_log))
+                return self.queue_position(leader_id) or 0
+            if leader is None:
+                self._inflight[digest] = container
+
+        self._pending[build_id] = container
+        self._queue.put_nowait(container)
+        return len(self._pending)
+
+    async def recover(self, RUN_ID, settings, DOCKER_BASE_URL):
+        """
+        Find builds left queued or building by a previous server, clean up
+        their processes and temp dirs, and either queue them again or report
+        them as failed. Finished builds older than BUILD_RETENTION are
+        pruned from the build store, and their saved logs removed, first.
+        """
+        if self.log_dir is not None and os.path.isdir(self.log_dir):
+            await run_in_threadpool(prune_saved_logs, self.log_dir, settings.BUILD_RETENTION)
+        if self.build_store is None:
+            return
+
+        await run_in_threadpool(self.build_store.prune, settings.BUILD_RETENTION)
+        records = await run_in_threadpool(self.build_store.orphaned, RUN_ID)
+        for record in records:
+            container = Container(container_spec=ContainerSpec.parse_raw(record.container_spec),
+                                  RUN_ID=record.RUN_ID,
+                                  settings=settings,
+                                  temp_dir=record.temp_dir,
+                                  DOCKER_BASE_URL=DOCKER_BASE_URL)
+            container.build_spec.build_id = record.build_id
+            container.build_spec.build_status = BuildStatus(record.phase)
+            container.build_pid = record.pid
+            container.build_store = self.build_store
+
+            if not await run_in_threadpool(container.start_build, RUN_ID):
+                continue
+
+            log.info(f'recovering build {record.build_id} orphaned by server {record.RUN_ID}')
+            container.build_spec.RUN_ID = RUN_ID
+            container.build_pid = None
+
+            if not settings.REQUEUE_ORPHANED_BUILDS:
+                await container.log_error('build interrupted by a restart of the container service')
+                continue
+
+            container.temp_dir = await run_in_threadpool(tempfile.mkdtemp)
+            await run_in_threadpool(container.build_spec_to_file)
+            await container.update_status(BuildStatus.queued)
+            await self.submit(container)
+
+    def queue_position(self, build_id):
+        for position, pending_id in enumerate(self._pending, start=1):
+            if pending_id == build_id:
+                return position
+        return None
+
+    def build_log(self, build_id):
+        """
+        The log of a queued, running or recently finished build. Builds that
+        are attached to an identical build get the leading build's output
+        copied into their own log, ahead of their own retag and push.
+        """
+        container = (self._pending.get(build_id) or self._running.get(build_id)
+                     or self._attached.get(build_id, (None, None))[0] or self._finished.get(build_id))
+        return container.build_log if container is not None else None
+
+    def log_path(self, build_id):
+        """
+        Where the log of a build is saved, or None if logs are not saved or
+        build_id is not a build ID
+        """
+        if self.log_dir is None:
+            return None
+        try:
+            build_id = str(uuid.UUID(build_id))
+        except ValueError:
+            return None
+        return os.path.join(self.log_dir, f'{build_id}.log')
+
+    def _save_log(self, build_id, container):
+        try:
+            os.makedirs(self.log_dir, exist_ok=True)
+            container.build_log.save_to(self.log_path(build_id))
+        except OSError as e:
+            log.error(f'could not save the log of build {build_id}: {e}')
+
+    def _finish(self, build_id, container):
+        # a singularity build writes its SIF conversion to the log after the docker build is done
+        if container.sif_task is not None and not container.sif_task.done():
+            container.sif_task.add_done_callback(lambda task: container.build_log.close())
+        else:
+            container.build_log.close()
+        self._finished[build_id] = container
+        while len(self._finished) > self.recent_builds:
+            self._finished.popitem(last=False)
+
+    def build_info(self, build_id):
+        """
+        Report the scheduling state of a queued or running build, or None if
+        this scheduler does not know about it.
+        """
+        leader_id = None
+        container = self._pending.get(build_id) or self._running.get(build_id)
+        if container is None and build_id in self._attached:
+            container, leader = self._attached[build_id]
+            leader_id = str(leader.build_spec.build_id)
+        if container is None:
+            return None
+
+        return {"build_id": build_id,
+                "container_id": str(container.container_spec.container_id),
+                "build_status": container.build_spec.build_status,
+                "queue_position": self.queue_position(leader_id or build_id),
+                "queue_wait_time": container.queue_wait_time,
+                "coalesced_build_id": leader_id}
+
+    async def _worker(self, slot):
+        while True:
+            container = await self._queue.get()
+            build_id = str(container.build_spec.build_id)
+            self._pending.pop(build_id, None)
+            self._running[build_id] = container
+            container.start_time = time.time()
+            log.info(f'build slot {slot} starting build {build_id} after '
+                     f'{container.queue_wait_time:.1f}s in queue')
+            try:
+                await background_build(container)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                self._running.pop(build_id, None)
+                self._finish(build_id, container)
+                self._release_attached(container)
+                self._queue.task_done()
+
+    def _release_attached(self, leader):
+        """
+        Hand the result of a finished build to every build attached to it.
+        """
+        if self._inflight.get(leader.container_spec.digest()) is leader:
+            del self._inflight[leader.container_spec.digest()]
+
+        for build_id, (container, attached_to) in list(self._attached.items()):
+            if attached_to is not leader:
+                continue
+            container.start_time = time.time()
+            task = asyncio.create_task(self._run_attached(build_id, container, leader))
+            self._attached_tasks.add(task)
+            task.add_done_callback(self._attached_tasks.discard)
+
+    async def _run_attached(self, build_id, container, leader):
+        forwarder = self._forwarders.pop(build_id, None)
+        try:
+            if forwarder is not None and leader.build_log.closed:
+                # let the rest of the leader's output in ahead of this build's own
+                await forwarder
+            await coalesced_build(container, leader)
+        except Exception as e:
+            log.exception(e)
+        finally:
+            if forwarder is not None:
+                forwarder.cancel()
+            self._attached.pop(build_id, None)
+            self._finish(build_id, container)
+
+    async def shutdown(self):
+        """
+        Stop accepting builds and let queued and running builds drain for up
+        to shutdown_timeout seconds before cancelling whatever is left.
+        """
+        self._accepting = False
+        log.info(f'Draining build scheduler: {len(self._running)} running, {len(self._pending)} queued, '
+                 f'{len(self._attached)} attached')
+
+        try:
+            await asyncio.wait_for(self._drain(), timeout=self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            log.error(f'Build scheduler did not drain within {self.shutdown_timeout}s - '
+                      f'abandoning {len(self._running)} running and {len(self._pending)} queued builds')
+            waiting = list(self._pending.values()) + [c for c, _ in self._attached.values()]
+            for container in waiting:
+                if container.build_spec.build_status == BuildStatus.queued:
+                    await container.log_error('container service shut down before the build started')
+
+        tasks = self._workers + list(self._attached_tasks) + list(self._forwarders.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+
+    async def _drain(self):
+        await self._queue.join()
+        while self._attached_tasks:
+            await asyncio.gather(*self._attached_tasks, return_exceptions=True)
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import time
+
+from fastapi.concurrency import run_in_threadpool
+
+from .cache import SifCache
+from .config import Settings
+from .container import remove_file
+from .docker_pool import docker_clients, cli_docker_host
+from .models import BuildStatus
+from .push import registry_host
+
+log = logging.getLogger("funcx_container_service")
+
+settings = Settings()
+
+SINGULARITY_CMD = [settings.SINGULARITY_PATH or 'singularity']
+SIF_TAG = 'sif'
+
+sif_cache = SifCache(os.path.join(settings.CACHE_DIR, 'sif'), settings.SIF_CACHE_SIZE)
+
+
+class SifError(Exception):
+    pass
+
+
+class SifConverter():
+
+    """
+    Converts built docker images to Singularity images (SIFs) for specs
+    with container_type singularity, then publishes them to the registry as
+    ORAS artifacts next to the docker image and reports the build as ready.
+
+    Conversions run as tasks of their own, at most max_concurrent at a time,
+    so a build slot is free for the next docker build as soon as the image
+    is pushed. The task is kept on the container as sif_task, so its build
+    log stays open until the conversion is done. SIFs are cached by spec digest, and a conversion of a digest
+    that is already being converted waits for it and reuses the result.
+    """
+
+    def __init__(self, max_concurrent):
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._digest_locks = {}
+        self._tasks = set()
+
+    def submit(self, container):
+        task = asyncio.create_task(self._run(container))
+        container.sif_task = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, container):
+        try:
+            await self.publish(container)
+            completion_response = await container.update_status(BuildStatus.ready)
+            log.info(f'SIF build process complete - finished with: {completion_response}')
+        except Exception as e:
+            log.exception(e)
+            await container.log_error(f'Singularity conversion of {container.image_name} failed: {e}')
+
+    async def publish(self, container):
+        digest = container.completion_spec.spec_digest
+        docker_client = await run_in_threadpool(docker_clients.get, container.DOCKER_BASE_URL)
+        inspect = await run_in_threadpool(docker_client.inspect_image, container.image_name)
+
+        # a lock and the number of conversions using it, dropped once none are
+        digest_lock = self._digest_locks.setdefault(digest, [asyncio.Lock(), 0])
+        digest_lock[1] += 1
+        try:
+            async with digest_lock[0]:
+                sif_path = await run_in_threadpool(sif_cache.lookup, digest, inspect['Id'])
+                if sif_path is not None:
+                    log.info(f'reusing cached SIF for spec digest {digest}')
+                    container.completion_spec.sif_cache_hit = True
+                else:
+                    async with self._slots:
+                        sif_path = await self.convert(container, digest, inspect['Id'])
+        finally:
+            digest_lock[1] -= 1
+            if digest_lock[1] == 0:
+                del self._digest_locks[digest]
+
+        container.completion_spec.sif_size = await run_in_threadpool(os.path.getsize, sif_path)
+        if container.settings.REGISTRY_USERNAME:
+            async with self._slots:
+                await self.push(container, sif_path)
+
+    async def convert(self, container, digest, image_id):
+        """
+        Build a SIF straight from the image on the docker daemon and move it
+        into the SIF cache
+        """
+        temp_path = await run_in_threadpool(sif_cache.temp_path, digest)
+        cmd = SINGULARITY_CMD + ['build', '--force', temp_path, f'docker-daemon://{container.image_name}:latest']
+        start = time.time()
+        try:
+            await run_singularity(container, cmd, {"DOCKER_HOST": cli_docker_host(container.DOCKER_BASE_URL)})
+        except BaseException:
+            await run_in_threadpool(remove_file, temp_path)
+            raise
+        container.completion_spec.sif_conversion_time = time.time() - start
+        log.info(f'converted {container.image_name} to a SIF in {container.completion_spec.sif_conversion_time}s')
+        return await run_in_threadpool(sif_cache.store, digest, image_id, temp_path)
+
+    async def push(self, container, sif_path):
+        uri = f'oras://{registry_host(container.settings)}/{container.settings.REGISTRY_USERNAME}/' \
+              f'{container.image_name}:{SIF_TAG}'
+        credentials = {}
+        for prefix in ('SINGULARITY', 'APPTAINER'):
+            credentials[f'{prefix}_DOCKER_USERNAME'] = container.settings.REGISTRY_USERNAME
+            credentials[f'{prefix}_DOCKER_PASSWORD'] = container.settings.REGISTRY_PWD or ''
+
+        start = time.time()
+        await run_singularity(container, SINGULARITY_CMD + ['push', sif_path, uri], credentials)
+        container.completion_spec.sif_push_time = time.time() - start
+        container.completion_spec.sif_uri = uri
+        container.completion_spec.sif_pull_command = f'singularity pull {uri}'
+        log.info(f'SIF for {container.image_name} published to {uri}')
+
+    async def drain(self, timeout):
+        """
+        Let running conversions finish for up to timeout seconds, then cancel
+        whatever is left
+        """
+        if not self._tasks:
+            return
+        log.info(f'waiting for {len(self._tasks)} Singularity conversions')
+        tasks = list(self._tasks)
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def run_singularity(container, cmd, env):
+    process = await asyncio.create_subprocess_exec(*cmd,
+                                                   env={**os.environ, **env},
+                                                   stdout=subprocess.PIPE,
+                                                   stderr=subprocess.PIPE,
+                                                   start_new_session=True)
+    build_log = container.build_log
+    try:
+        await asyncio.wait_for(asyncio.gather(build_log.consume(process.stdout, 'sif'),
+                                              build_log.consume(process.stderr, 'sif'),
+                                              process.wait()),
+                               timeout=container.build_timeout)
+    except asyncio.TimeoutError:
+        os.killpg(process.pid, signal.SIGTERM)
+        raise SifError(f'{cmd[1]} timed out after {container.build_timeout}s')
+
+    if process.returncode != 0:
+        raise SifError(f'{cmd[1]} exited with return code {process.returncode}: '
+                       f'{build_log.text(stream="sif")[-2000:]}')
+
+
+sif_converter = SifConverter(settings.MAX_CONCURRENT_SIF_CONVERSIONS)
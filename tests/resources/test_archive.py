@@ -0,0 +1,154 @@
+import io
+import os
+import tarfile
+import tempfile
+import zipfile
+
+import pytest
+import zstandard
+
+from funcx_container_service.archive import PayloadError, context_stream, extract_archive
+
+
+def add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+@pytest.mark.parametrize('mode', ['w', 'w:gz', 'w:bz2', 'w:xz'])
+def test_extract_tar(mode):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        archive = os.path.join(temp_dir, 'payload')
+        with tarfile.open(archive, mode) as tar:
+            add_member(tar, 'model/weights.bin', b'x' * 1000)
+            add_member(tar, 'requirements.txt', b'numpy\n')
+
+        dest = os.path.join(temp_dir, 'build')
+        os.mkdir(dest)
+        assert extract_archive(archive, dest, max_bytes=10000) == 1006
+        with open(os.path.join(dest, 'model', 'weights.bin'), 'rb') as f:
+            assert f.read() == b'x' * 1000
+
+
+def test_extract_refuses_protected_paths():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        archive = os.path.join(temp_dir, 'payload')
+        with tarfile.open(archive, 'w') as tar:
+            add_member(tar, 'payload', b'overwrite')
+        size = os.path.getsize(archive)
+
+        with pytest.raises(PayloadError, match='would overwrite'):
+            extract_archive(archive, temp_dir, max_bytes=10000)
+        assert os.path.getsize(archive) == size
+
+
+def test_extract_zip_bomb_rejected_before_writing():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        archive = os.path.join(temp_dir, 'payload')
+        with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED) as zip_obj:
+            zip_obj.writestr('small.txt', b'hello')
+            zip_obj.writestr('bomb.bin', b'\0' * 1024 ** 2)
+        assert os.path.getsize(archive) < 10000
+
+        dest = os.path.join(temp_dir, 'build')
+        os.mkdir(dest)
+        with pytest.raises(PayloadError, match='expands to more than'):
+            extract_archive(archive, dest, max_bytes=100000)
+        assert os.listdir(dest) == []
+
+
+def test_extract_tar_stops_at_limit():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        archive = os.path.join(temp_dir, 'payload')
+        with tarfile.open(archive, 'w:gz') as tar:
+            add_member(tar, 'first.bin', b'\0' * 6000)
+            add_member(tar, 'second.bin', b'\0' * 6000)
+            add_member(tar, 'third.bin', b'\0' * 6000)
+
+        dest = os.path.join(temp_dir, 'build')
+        os.mkdir(dest)
+        with pytest.raises(PayloadError):
+            extract_archive(archive, dest, max_bytes=10000)
+        assert sorted(os.listdir(dest)) == ['first.bin']
+
+
+@pytest.mark.parametrize('name', ['../escape.txt', '/etc/escape.txt'])
+def test_extract_rejects_path_traversal(name):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        archive = os.path.join(temp_dir, 'payload')
+        with tarfile.open(archive, 'w') as tar:
+            add_member(tar, name, b'oops')
+
+        dest = os.path.join(temp_dir, 'build')
+        os.mkdir(dest)
+        with pytest.raises(PayloadError, match='outside the build directory'):
+            extract_archive(archive, dest, max_bytes=10000)
+        assert not os.path.exists(os.path.join(temp_dir, 'escape.txt'))
+
+
+def test_extract_rejects_symlink_out_of_dest():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        archive = os.path.join(temp_dir, 'payload')
+        with tarfile.open(archive, 'w') as tar:
+            link = tarfile.TarInfo('data')
+            link.type = tarfile.SYMTYPE
+            link.linkname = '../../etc'
+            tar.addfile(link)
+
+        dest = os.path.join(temp_dir, 'build')
+        os.mkdir(dest)
+        with pytest.raises(PayloadError):
+            extract_archive(archive, dest, max_bytes=10000)
+        assert not os.path.lexists(os.path.join(dest, 'data'))
+
+
+def test_extract_unknown_format():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        archive = os.path.join(temp_dir, 'payload')
+        with open(archive, 'wb') as f:
+            f.write(b'just some text')
+
+        with pytest.raises(PayloadError, match='not an acceptable archive format'):
+            extract_archive(archive, temp_dir, max_bytes=10000)
+
+
+def test_extract_tar_zst():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        raw = io.BytesIO()
+        with tarfile.open(fileobj=raw, mode='w') as tar:
+            add_member(tar, 'test.txt', b'hello')
+        archive = os.path.join(temp_dir, 'payload')
+        with open(archive, 'wb') as f:
+            f.write(zstandard.ZstdCompressor().compress(raw.getvalue()))
+
+        dest = os.path.join(temp_dir, 'build')
+        os.mkdir(dest)
+        assert extract_archive(archive, dest, max_bytes=10000) == 5
+        assert os.path.exists(os.path.join(dest, 'test.txt'))
+
+
+def test_context_stream():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        archive = os.path.join(temp_dir, 'payload')
+        with tarfile.open(archive, 'w:gz') as tar:
+            add_member(tar, 'app/main.py', b'print(1)\n' * 100)
+            add_member(tar, 'Dockerfile', b'FROM scratch\n')
+
+        files = {'Dockerfile': b'FROM python\n', '.funcx-lock/pip.txt': b'numpy==1.0\n'}
+        context = io.BytesIO(b''.join(context_stream(archive, files, max_bytes=10000)))
+        with tarfile.open(fileobj=context) as tar:
+            assert tar.getnames() == ['app/main.py', 'Dockerfile', '.funcx-lock/pip.txt']
+            assert tar.extractfile('app/main.py').read() == b'print(1)\n' * 100
+            assert tar.extractfile('Dockerfile').read() == b'FROM python\n'
+        assert os.listdir(temp_dir) == ['payload']
+
+
+def test_context_stream_enforces_limit():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        archive = os.path.join(temp_dir, 'payload')
+        with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED) as zip_obj:
+            zip_obj.writestr('bomb.bin', b'\0' * 1024 ** 2)
+
+        with pytest.raises(PayloadError):
+            b''.join(context_stream(archive, {'Dockerfile': b''}, max_bytes=10000))
@@ -0,0 +1,92 @@
+import asyncio
+import tempfile
+import uuid
+
+import pytest
+from docker.errors import ImageNotFound, NotFound
+
+from funcx_container_service import DOCKER_BASE_URL
+from funcx_container_service.base_image import BaseImages, BaseImageError
+from funcx_container_service.config import Settings
+from funcx_container_service.container import Container
+from funcx_container_service.dockerfile import BASE_IMAGE_VERSION, emit_dockerfile
+from funcx_container_service.models import ContainerSpec
+
+
+@pytest.fixture
+def settings_fixture():
+    settings = Settings()
+    settings.REGISTRY_USERNAME = 'funcx'
+    settings.REGISTRY_PWD = 'pwd'
+    settings.REGISTRY_URL = 'https://registry.example.com'
+    return settings
+
+
+@pytest.fixture
+def container_fixture(settings_fixture):
+    spec = ContainerSpec(container_type="docker", container_id=uuid.uuid4(), pip=['numpy'])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        yield Container(spec, str(uuid.uuid4()), settings_fixture, temp_dir, DOCKER_BASE_URL)
+
+
+@pytest.fixture
+def docker_client(mocker):
+    client = mocker.MagicMock()
+    mocker.patch('funcx_container_service.base_image.docker_clients.get', return_value=client)
+    return client
+
+
+def test_dockerfile_from_base_image():
+    dockerfile = emit_dockerfile([], [], ['numpy'], base_image=f'funcx_container_base:{BASE_IMAGE_VERSION}')
+
+    assert dockerfile.startswith(f'FROM funcx_container_base:{BASE_IMAGE_VERSION}\n')
+    assert 'buildpack-deps' not in dockerfile
+    assert 'numpy' in dockerfile
+
+
+async def test_local_base_image_is_used(container_fixture, docker_client, fp):
+    base_images = BaseImages()
+
+    name = await base_images.ensure(container_fixture)
+    await base_images.ensure(container_fixture)
+
+    assert name == f'funcx/funcx_container_base:{BASE_IMAGE_VERSION}'
+    docker_client.inspect_image.assert_called_once_with(name)
+    docker_client.pull.assert_not_called()
+    assert fp.call_count([fp.any()]) == 0
+
+
+async def test_base_image_pulled_from_registry(container_fixture, docker_client, fp):
+    docker_client.inspect_image.side_effect = [ImageNotFound('missing'), {'Id': 'sha256:abc'}]
+
+    await BaseImages().ensure(container_fixture)
+
+    docker_client.pull.assert_called_once()
+    assert fp.call_count([fp.any()]) == 0
+
+
+async def test_base_image_built_once_and_pushed(container_fixture, docker_client, mocker, fp):
+    docker_client.inspect_image.side_effect = ImageNotFound('missing')
+    docker_client.pull.side_effect = NotFound('missing')
+    docker_client.login.return_value = {'Status': 'Login Succeeded'}
+    docker_client.push.return_value = iter([{'status': 'Pushed'}])
+    mocker.patch('funcx_container_service.base_image.registry_auth.login',
+                 return_value={'Status': 'Login Succeeded'})
+    fp.register(['docker', 'build', fp.any()], stderr=['#1 [internal] load build definition'])
+    base_images = BaseImages()
+
+    names = await asyncio.gather(base_images.ensure(container_fixture), base_images.ensure(container_fixture))
+
+    assert names[0] == names[1]
+    assert fp.call_count(['docker', 'build', fp.any()]) == 1
+    docker_client.push.assert_called_once()
+
+
+async def test_failed_base_image_build_raises(container_fixture, docker_client, fp):
+    container_fixture.settings.REGISTRY_USERNAME = None
+    docker_client.inspect_image.side_effect = ImageNotFound('missing')
+    fp.register(['docker', 'build', fp.any()], returncode=1)
+
+    with pytest.raises(BaseImageError):
+        await BaseImages().ensure(container_fixture)
+    docker_client.pull.assert_not_called()
@@ -1,16 +1,23 @@
+import io
 import pytest
 import subprocess
+import tarfile
 import tempfile
 import uuid
 import os
+import zipfile
 
 import docker
+from docker.errors import ImageNotFound
 
 from funcx_container_service import Settings
+from funcx_container_service.cache import ImageCache, LayerIndex, LockStore
+from funcx_container_service.docker_pool import docker_clients
 from funcx_container_service.container import Container
-from funcx_container_service.models import ContainerSpec, BuildType, BuildStatus
+from funcx_container_service.models import ContainerSpec, BuildBackend, BuildType, BuildStatus, CompletionSpec
 from funcx_container_service import DOCKER_BASE_URL
-from funcx_container_service.build import repo2docker_build, background_build
+from funcx_container_service.build import (repo2docker_build, background_build, coalesced_build,
+                                           docker_build, conda_solve_time, find_incremental_base, run_build_process)
 
 
 def timeout_callback_function(process):
@@ -20,6 +27,13 @@ def timeout_callback_function(process):
 
 # Fixtures
 
+@pytest.fixture(autouse=True)
+def reset_docker_clients():
+    docker_clients.reset()
+    yield
+    docker_clients.reset()
+
+
 @pytest.fixture
 def settings_fixture():
     settings = Settings()
@@ -41,7 +55,7 @@ def container_spec_fixture():
 
 # Tests
 @pytest.mark.skip()
-def test_repo2docker_build_success(container_spec_fixture, settings_fixture, fp, mocker):
+async def test_repo2docker_build_success(container_spec_fixture, settings_fixture, fp, mocker):
     with tempfile.TemporaryDirectory() as temp_dir:
         run_id = str(uuid.uuid4())
         c = Container(container_spec_fixture,
@@ -55,12 +69,12 @@ def test_repo2docker_build_success(container_spec_fixture, settings_fixture, fp,
         fp.register([fp.any(), ])
         mocker.patch('funcx_container_service.callback_router.update_status')
         mocker.patch('funcx_container_service.build.docker_size', return_value=1234)
-        repo2docker_build(c, '1.0')
+        await repo2docker_build(c, '1.0')
 
         assert c.build_spec.build_status == BuildStatus.ready
 
 
-def test_repo2docker_build_fail(container_spec_fixture, settings_fixture, fp, mocker):
+async def test_repo2docker_build_fail(container_spec_fixture, settings_fixture, fp, mocker):
     with tempfile.TemporaryDirectory() as temp_dir:
         deleteme = os.path.join(temp_dir, "deleteme")
         os.mkdir(deleteme)
@@ -77,12 +91,12 @@ def test_repo2docker_build_fail(container_spec_fixture, settings_fixture, fp, mo
         mocker.patch('funcx_container_service.callback_router.update_status')
         mocker.patch('funcx_container_service.build.docker_size', return_value=1234)
         mocker.patch('os.getpgid', returnvalue=1)
-        repo2docker_build(c, '1.0')
+        await repo2docker_build(c, '1.0')
 
         assert c.build_spec.build_status == BuildStatus.failed
 
 
-def test_background_build(container_spec_fixture, settings_fixture, mocker, fp):
+async def test_background_build(container_spec_fixture, settings_fixture, mocker, fp):
     with tempfile.TemporaryDirectory() as temp_dir:
         deleteme = os.path.join(temp_dir, "deleteme")
         os.mkdir(deleteme)
@@ -101,12 +115,12 @@ def test_background_build(container_spec_fixture, settings_fixture, mocker, fp):
         mocker.patch('funcx_container_service.callback_router.update_status')
         mocker.patch('os.getpgid', returnvalue=1)
 
-        background_build(c)
+        await background_build(c)
 
         assert c.build_spec.build_status == BuildStatus.ready
 
 
-def test_repo2docker_build_timeout_exception(container_spec_fixture, settings_fixture, mocker, fp):
+async def test_repo2docker_build_timeout_exception(container_spec_fixture, settings_fixture, mocker, fp):
 
     with tempfile.TemporaryDirectory() as temp_dir:
         run_id = str(uuid.uuid4())
@@ -125,10 +139,71 @@ def test_repo2docker_build_timeout_exception(container_spec_fixture, settings_fi
         mocker.patch('os.killpg')
 
         with pytest.raises(subprocess.TimeoutExpired):
-            repo2docker_build(c, '1.0')
+            await repo2docker_build(c, '1.0')
+
+
+async def test_repo2docker_build_kills_on_timeout(container_spec_fixture, settings_fixture, mocker, fp):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        c = Container(container_spec_fixture,
+                      str(uuid.uuid4()),
+                      settings_fixture,
+                      temp_dir,
+                      DOCKER_BASE_URL)
+        c.build_type = BuildType.container
+        c.build_timeout = 0.1
+
+        fp.register([fp.any()], wait=0.5)
+        mocker.patch('os.getpgid', return_value=1)
+        killpg = mocker.patch('os.killpg')
+
+        with pytest.raises(subprocess.TimeoutExpired):
+            await repo2docker_build(c, '1.0')
+        killpg.assert_called_once()
+
+
+async def test_repo2docker_build_collects_output(container_spec_fixture, settings_fixture, mocker, fp):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        c = Container(container_spec_fixture,
+                      str(uuid.uuid4()),
+                      settings_fixture,
+                      temp_dir,
+                      DOCKER_BASE_URL)
+        c.build_type = BuildType.container
+
+        fp.register([fp.any()], stderr=['Picked Local repo', 'Successfully built 1234'], returncode=0)
+        mocker.patch('funcx_container_service.build.docker_size', return_value=1234)
+        mocker.patch('os.getpgid', return_value=1)
+        await repo2docker_build(c, '1.0')
+
+        assert c.completion_spec.repo2docker_stdout == 'Picked Local repo Successfully built 1234'
+        assert c.build_log.total_lines == 2
+
+
+async def test_solve_time_ignores_earlier_output(container_spec_fixture, settings_fixture, mocker, fp):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        c = Container(container_spec_fixture,
+                      str(uuid.uuid4()),
+                      settings_fixture,
+                      temp_dir,
+                      DOCKER_BASE_URL)
+        # a base image build that ran first on this daemon
+        c.build_log.append('#5 RUN conda env create -p ${NB_PYTHON_PREFIX} -f /tmp/environment.yml')
+        c.build_log.append('#5 1.0 Collecting package metadata (repodata.json): ...working... done')
+        c.build_log.append('#5 90.0 Solving environment: ...working... done')
+
+        fp.register([fp.any()], stderr=['#7 RUN pip install --no-cache-dir numpy', '#7 DONE 3.0s'], returncode=0)
+        mocker.patch('funcx_container_service.build.docker_size', return_value=1234)
+        mocker.patch('os.getpgid', return_value=1)
+        await run_build_process(c, ['docker', 'build', '-'], '1.0', BuildBackend.docker)
 
+        assert c.build_output_start == 3
+        assert c.completion_spec.solve_time is None
 
-def test_repo2docker_docker_exception(container_spec_fixture, settings_fixture, mocker, fp):
+
+async def test_repo2docker_docker_exception(container_spec_fixture, settings_fixture, mocker, fp):
 
     with tempfile.TemporaryDirectory() as temp_dir:
         run_id = str(uuid.uuid4())
@@ -147,10 +222,10 @@ def test_repo2docker_docker_exception(container_spec_fixture, settings_fixture,
 
         with pytest.raises(docker.errors.DockerException):
 
-            repo2docker_build(c, '1.0')
+            await repo2docker_build(c, '1.0')
 
 
-def test_background_build_docker_exception(container_spec_fixture, settings_fixture, mocker, fp):
+async def test_background_build_docker_exception(container_spec_fixture, settings_fixture, mocker, fp):
 
     with tempfile.TemporaryDirectory() as temp_dir:
         deleteme = os.path.join(temp_dir, "deleteme")
@@ -168,12 +243,12 @@ def test_background_build_docker_exception(container_spec_fixture, settings_fixt
         mocker.patch('funcx_container_service.build.docker_size', return_value=1234)
         mocker.patch("funcx_container_service.container.Container.push_image")
         mocker.patch('funcx_container_service.callback_router.update_status')
-        background_build(container)
+        await background_build(container)
 
         assert container.build_spec.build_status == BuildStatus.failed
 
 
-def test_background_build_timeout_exception(container_spec_fixture, settings_fixture, mocker, fp):
+async def test_background_build_timeout_exception(container_spec_fixture, settings_fixture, mocker, fp):
 
     with tempfile.TemporaryDirectory() as temp_dir:
         deleteme = os.path.join(temp_dir, "deleteme")
@@ -193,6 +268,411 @@ def test_background_build_timeout_exception(container_spec_fixture, settings_fix
         mocker.patch('funcx_container_service.build.docker_size', return_value=1234)
         mocker.patch('os.getpgid', returnvalue=1)
         mocker.patch('os.killpg')
-        background_build(container)
+        await background_build(container)
 
         assert container.build_spec.build_status == BuildStatus.failed
+
+
+async def test_background_build_cache_hit(container_spec_fixture, settings_fixture, mocker):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        deleteme = os.path.join(temp_dir, "deleteme")
+        os.mkdir(deleteme)
+
+        container_spec_fixture.payload_url = None
+        container = Container(container_spec_fixture,
+                              str(uuid.uuid4()),
+                              settings_fixture,
+                              deleteme,
+                              DOCKER_BASE_URL)
+
+        cache = ImageCache(os.path.join(temp_dir, 'image_index.json'))
+        cache.record(container_spec_fixture.digest(), 'funcx_previous', 'sha256:1234')
+        mocker.patch('funcx_container_service.build.image_cache', cache)
+
+        docker_client = mocker.MagicMock()
+        docker_client.inspect_image.return_value = {'Id': 'sha256:1234', 'VirtualSize': 1234}
+        mocker.patch('docker.APIClient', return_value=docker_client)
+        r2d = mocker.patch('funcx_container_service.build.repo2docker_build')
+        mocker.patch("funcx_container_service.container.Container.push_image")
+        mocker.patch('funcx_container_service.callback_router.update_status')
+
+        await background_build(container)
+
+        r2d.assert_not_called()
+        docker_client.tag.assert_called_with('sha256:1234', container.image_name, tag='latest')
+        assert container.build_spec.build_status == BuildStatus.ready
+        assert container.completion_spec.cache_hit
+        assert container.completion_spec.cached_image == 'funcx_previous'
+
+
+async def test_coalesced_build_reuses_leader_image(container_spec_fixture, settings_fixture, mocker):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        leader = Container(container_spec_fixture, str(uuid.uuid4()), settings_fixture,
+                           temp_dir, DOCKER_BASE_URL)
+        leader.build_spec.build_status = BuildStatus.ready
+
+        deleteme = os.path.join(temp_dir, "deleteme")
+        os.mkdir(deleteme)
+        container = Container(container_spec_fixture.copy(update={'container_id': uuid.uuid4()}),
+                              str(uuid.uuid4()), settings_fixture, deleteme, DOCKER_BASE_URL)
+
+        docker_client = mocker.MagicMock()
+        docker_client.inspect_image.return_value = {'Id': 'sha256:1234', 'VirtualSize': 1234}
+        mocker.patch('docker.APIClient', return_value=docker_client)
+        mocker.patch("funcx_container_service.container.Container.push_image")
+        mocker.patch('funcx_container_service.callback_router.update_status')
+
+        await coalesced_build(container, leader)
+
+        docker_client.tag.assert_called_with('sha256:1234', container.image_name, tag='latest')
+        assert container.build_spec.build_status == BuildStatus.ready
+        assert container.completion_spec.coalesced_build_id == str(leader.build_spec.build_id)
+
+
+async def test_coalesced_build_leader_failed(container_spec_fixture, settings_fixture, mocker):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        leader = Container(container_spec_fixture, str(uuid.uuid4()), settings_fixture,
+                           temp_dir, DOCKER_BASE_URL)
+        leader.build_spec.build_status = BuildStatus.failed
+        leader.err_msg = 'repo2docker failed'
+
+        deleteme = os.path.join(temp_dir, "deleteme")
+        os.mkdir(deleteme)
+        container = Container(container_spec_fixture, str(uuid.uuid4()), settings_fixture,
+                              deleteme, DOCKER_BASE_URL)
+        mocker.patch('funcx_container_service.callback_router.update_status')
+
+        await coalesced_build(container, leader)
+
+        assert container.build_spec.build_status == BuildStatus.failed
+        assert 'repo2docker failed' in container.err_msg
+
+
+async def test_docker_build_success(container_spec_fixture, settings_fixture, mocker, fp):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        c = Container(container_spec_fixture,
+                      str(uuid.uuid4()),
+                      settings_fixture,
+                      temp_dir,
+                      DOCKER_BASE_URL)
+        c.build_type = BuildType.container
+
+        fp.register(['docker', 'build', fp.any()], stderr=['#1 [internal] load build definition'])
+        fp.keep_last_process(True)
+        docker_client = mocker.patch('docker.APIClient').return_value
+        docker_client.prune_builds.return_value = {'SpaceReclaimed': 0}
+        mocker.patch('funcx_container_service.build.docker_size', return_value=1234)
+        mocker.patch('funcx_container_service.build.base_images.ensure', return_value='funcx_container_base:abc')
+        mocker.patch('funcx_container_service.build.layer_index', LayerIndex(os.path.join(temp_dir, 'layers.json')))
+        mocker.patch('os.getpgid', return_value=1)
+        await docker_build(c, '1.0')
+
+        with open(os.path.join(temp_dir, 'Dockerfile')) as f:
+            dockerfile = f.read()
+        assert '\nFROM funcx_container_base:abc\n' in dockerfile
+        assert 'beautifulsoup4' in dockerfile
+        assert 'COPY --chown' not in dockerfile
+        assert '--mount=type=cache' in dockerfile
+        assert c.completion_spec.build_backend == BuildBackend.docker
+        assert c.completion_spec.container_size == 1234
+        assert c.completion_spec.base_image == 'funcx_container_base:abc'
+        assert c.completion_spec.layer_cache_hit_ratio == 0
+        assert c.completion_spec.package_cache_hits == 0
+        docker_client.prune_builds.assert_called_once_with(filters={'type': 'exec.cachemount'},
+                                                           keep_storage=settings_fixture.PACKAGE_CACHE_SIZE)
+
+        c.build_spec.build_status = BuildStatus.building
+        await docker_build(c, '1.0')
+        assert c.completion_spec.layer_cache_hit_ratio == 1
+
+
+async def test_docker_build_counts_own_package_cache_lines(container_spec_fixture, settings_fixture, mocker, fp):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        c = Container(container_spec_fixture,
+                      str(uuid.uuid4()),
+                      settings_fixture,
+                      temp_dir,
+                      DOCKER_BASE_URL)
+        c.build_type = BuildType.container
+
+        def build_base_image(*args, **kwargs):
+            c.build_log.append('Downloading numpy-1.26.0.whl (18.2 MB)', 'stderr')
+            c.build_log.append('Get:1 http://deb.debian.org/debian bookworm/main amd64 curl 7.88 [315 kB]', 'stderr')
+            return 'funcx_container_base:abc'
+
+        fp.register(['docker', 'build', fp.any()], stderr=['#5 Using cached beautifulsoup4-4.12.2.whl'])
+        docker_client = mocker.patch('docker.APIClient').return_value
+        docker_client.prune_builds.return_value = {'SpaceReclaimed': 0}
+        mocker.patch('funcx_container_service.build.docker_size', return_value=1234)
+        mocker.patch('funcx_container_service.build.base_images.ensure', side_effect=build_base_image)
+        mocker.patch('funcx_container_service.build.layer_index', LayerIndex(os.path.join(temp_dir, 'layers.json')))
+        mocker.patch('os.getpgid', return_value=1)
+        await docker_build(c, '1.0')
+
+        assert c.completion_spec.package_cache_hits == 1
+        assert c.completion_spec.package_cache_misses == 0
+
+
+async def test_background_build_selects_docker_backend(container_spec_fixture, settings_fixture, mocker):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        deleteme = os.path.join(temp_dir, "deleteme")
+        os.mkdir(deleteme)
+
+        settings_fixture.BUILD_BACKEND = BuildBackend.docker
+        container_spec_fixture.payload_url = None
+        container = Container(container_spec_fixture,
+                              str(uuid.uuid4()),
+                              settings_fixture,
+                              deleteme,
+                              DOCKER_BASE_URL)
+
+        mocker.patch('funcx_container_service.build.image_cache', ImageCache(os.path.join(temp_dir, 'index.json')))
+        mocker.patch('funcx_container_service.build.lock_store', LockStore(os.path.join(temp_dir, 'locks')))
+        mocker.patch('docker.APIClient')
+        r2d = mocker.patch('funcx_container_service.build.repo2docker_build')
+        native = mocker.patch('funcx_container_service.build.docker_build')
+        mocker.patch('funcx_container_service.build.record_cached_image')
+        mocker.patch('funcx_container_service.build.publish_image')
+        mocker.patch('funcx_container_service.callback_router.update_status')
+
+        await background_build(container)
+
+        r2d.assert_not_called()
+        native.assert_called_once()
+
+
+async def fake_docker_build(container, docker_client_version, lock=None, incremental=None):
+    container.completion_spec = CompletionSpec(docker_client_version=str(docker_client_version))
+
+
+LOCK_OUTPUT = b"""# This file may be used to create an environment using:
+@EXPLICIT
+https://conda.anaconda.org/conda-forge/linux-64/pandas-1.3.0-py37h219a48f_0.tar.bz2#8a3b1c
+https://conda.anaconda.org/conda-forge/noarch/python-dateutil-2.8.1-py_0.tar.bz2
+----- pip freeze -----
+pandas==1.3.0
+python_dateutil==2.8.1
+beautifulsoup4==4.9.3
+soupsieve==2.2.1
+"""
+
+
+async def test_background_build_installs_from_lock(container_spec_fixture, settings_fixture, mocker):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        settings_fixture.BUILD_BACKEND = BuildBackend.docker
+        container_spec_fixture.payload_url = None
+
+        mocker.patch('funcx_container_service.build.image_cache', ImageCache(os.path.join(temp_dir, 'index.json')))
+        mocker.patch('funcx_container_service.build.lock_store', LockStore(os.path.join(temp_dir, 'locks')))
+        docker_client = mocker.patch('docker.APIClient').return_value
+        docker_client.wait.return_value = {'StatusCode': 0}
+        docker_client.logs.return_value = LOCK_OUTPUT
+        native = mocker.patch('funcx_container_service.build.docker_build', side_effect=fake_docker_build)
+        mocker.patch('funcx_container_service.build.record_cached_image')
+        mocker.patch('funcx_container_service.build.publish_image')
+        mocker.patch('funcx_container_service.callback_router.update_status')
+
+        for force_solve in (False, False, True):
+            deleteme = tempfile.mkdtemp(dir=temp_dir)
+            spec = container_spec_fixture.copy(update={'force_solve': force_solve})
+            await background_build(Container(spec, str(uuid.uuid4()), settings_fixture, deleteme, DOCKER_BASE_URL))
+
+        first, second, forced = [c.args[2] for c in native.call_args_list]
+        assert first is None
+        assert second['digest'] == container_spec_fixture.digest()
+        assert second['conda'][1:] == ['@EXPLICIT',
+                                       'https://conda.anaconda.org/conda-forge/linux-64/'
+                                       'pandas-1.3.0-py37h219a48f_0.tar.bz2#8a3b1c',
+                                       'https://conda.anaconda.org/conda-forge/noarch/'
+                                       'python-dateutil-2.8.1-py_0.tar.bz2']
+        assert second['pip'] == ['beautifulsoup4==4.9.3', 'soupsieve==2.2.1']
+        assert forced is None
+        # the image is only run to read its environment after a fresh solve
+        assert docker_client.create_container.call_count == 2
+
+
+async def test_background_build_stores_lock_after_publishing(container_spec_fixture, settings_fixture, mocker):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        settings_fixture.BUILD_BACKEND = BuildBackend.docker
+        container_spec_fixture.payload_url = None
+        deleteme = os.path.join(temp_dir, "deleteme")
+        os.mkdir(deleteme)
+        container = Container(container_spec_fixture, str(uuid.uuid4()), settings_fixture, deleteme, DOCKER_BASE_URL)
+
+        mocker.patch('funcx_container_service.build.image_cache', ImageCache(os.path.join(temp_dir, 'index.json')))
+        mocker.patch('funcx_container_service.build.lock_store', LockStore(os.path.join(temp_dir, 'locks')))
+        docker_client = mocker.patch('docker.APIClient').return_value
+        docker_client.wait.return_value = {'StatusCode': 0}
+        docker_client.logs.return_value = LOCK_OUTPUT
+        mocker.patch('funcx_container_service.build.docker_build', side_effect=fake_docker_build)
+        mocker.patch('funcx_container_service.build.record_cached_image')
+        publish = mocker.patch('funcx_container_service.build.publish_image')
+        mocker.patch('funcx_container_service.callback_router.update_status')
+        order = mocker.Mock()
+        order.attach_mock(publish, 'publish_image')
+        order.attach_mock(docker_client.create_container, 'create_container')
+
+        await background_build(container)
+
+        assert [c[0] for c in order.mock_calls] == ['publish_image', 'create_container']
+
+
+def test_conda_solve_time():
+    lines = [(10.0, 'stderr', '#8 [4/9] RUN conda install --yes -p ${NB_PYTHON_PREFIX} pandas'),
+             (11.0, 'stderr', '#8 1.0 Collecting package metadata (current_repodata.json): ...working... done'),
+             (15.0, 'stderr', '#8 5.0 Solving environment: ...working... failed with initial frozen solve.'),
+             (16.0, 'stderr', '#8 6.0 Collecting package metadata (repodata.json): ...working... done'),
+             (19.5, 'stderr', '#8 9.5 Solving environment: ...working... done'),
+             (30.0, 'stderr', '#9 [5/9] RUN micromamba install --yes -p ${NB_PYTHON_PREFIX} xarray'),
+             (30.1, 'stderr', '#9 CACHED'),
+             (40.0, 'stderr', '#10 [6/9] RUN micromamba install --yes -p ${NB_PYTHON_PREFIX} dask'),
+             (42.0, 'stderr', '#10 2.0 Transaction'),
+             (43.0, 'stderr', '#10 3.0 Transaction starting')]
+
+    assert conda_solve_time(lines) == 10.5
+    assert conda_solve_time(lines[:1]) is None
+
+
+async def test_docker_build_from_incremental_base(container_spec_fixture, settings_fixture, mocker, fp):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        container_spec_fixture.payload_url = None
+        container_spec_fixture.conda = ['pandas']
+        container_spec_fixture.pip = ['beautifulsoup4', 'rich']
+        c = Container(container_spec_fixture, str(uuid.uuid4()), settings_fixture, temp_dir, DOCKER_BASE_URL)
+        c.build_type = BuildType.container
+
+        cache = ImageCache(os.path.join(temp_dir, 'index.json'))
+        base_spec = container_spec_fixture.copy(update={'pip': ['beautifulsoup4']})
+        cache.record(base_spec.digest(), 'funcx_base', 'sha256:abc', spec=base_spec, backend='docker',
+                     build_time=300)
+        mocker.patch('funcx_container_service.build.image_cache', cache)
+        mocker.patch('funcx_container_service.build.layer_index', LayerIndex(os.path.join(temp_dir, 'layers.json')))
+        docker_client = mocker.patch('docker.APIClient').return_value
+        docker_client.inspect_image.return_value = {'Id': 'sha256:abc'}
+        docker_client.prune_builds.return_value = {}
+        mocker.patch('funcx_container_service.build.docker_size', return_value=1234)
+        ensure = mocker.patch('funcx_container_service.build.base_images.ensure')
+        mocker.patch('os.getpgid', return_value=1)
+        fp.register(['docker', 'build', fp.any()])
+
+        incremental = find_incremental_base(c, docker_client)
+        await docker_build(c, '1.0', incremental=incremental)
+
+        with open(os.path.join(temp_dir, 'Dockerfile')) as f:
+            dockerfile = f.read()
+        assert '\nFROM funcx_base\nUSER root\n' in dockerfile
+        assert 'rich' in dockerfile
+        assert 'pandas' not in dockerfile and 'beautifulsoup4' not in dockerfile
+        ensure.assert_not_called()
+        assert c.completion_spec.incremental_base_image == 'funcx_base'
+        assert c.completion_spec.incremental_time_saved == 300
+
+
+def test_incremental_base_forgets_missing_images(container_spec_fixture, settings_fixture, mocker):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        c = Container(container_spec_fixture, str(uuid.uuid4()), settings_fixture, temp_dir, DOCKER_BASE_URL)
+        cache = ImageCache(os.path.join(temp_dir, 'index.json'))
+        base_spec = container_spec_fixture.copy(update={'pip': []})
+        cache.record('gone', 'funcx_gone', 'sha256:abc', spec=base_spec, backend='docker', build_time=300)
+        mocker.patch('funcx_container_service.build.image_cache', cache)
+        docker_client = mocker.MagicMock()
+        docker_client.inspect_image.side_effect = ImageNotFound('gone')
+
+        assert find_incremental_base(c, docker_client) is None
+        assert cache.lookup('gone') is None
+
+
+async def test_docker_build_streams_payload_context(container_spec_fixture, settings_fixture, mocker):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        settings_fixture.BUILD_BACKEND = BuildBackend.docker
+        settings_fixture.PACKAGE_CACHE = False
+        c = Container(container_spec_fixture,
+                      str(uuid.uuid4()),
+                      settings_fixture,
+                      temp_dir,
+                      DOCKER_BASE_URL)
+        c.build_type = BuildType.payload
+        c.payload_path = os.path.join(temp_dir, 'payload')
+        with zipfile.ZipFile(c.payload_path, 'w') as zip_obj:
+            zip_obj.writestr('model/weights.bin', b'x' * 5000)
+            zip_obj.writestr('Dockerfile', b'FROM scratch\n')
+
+        mocker.patch('funcx_container_service.build.base_images.ensure', return_value='funcx_container_base:abc')
+        mocker.patch('funcx_container_service.build.layer_index', LayerIndex(os.path.join(temp_dir, 'layers.json')))
+        run = mocker.patch('funcx_container_service.build.run_build_process')
+        await docker_build(c, '1.0')
+
+        cmd = run.call_args.args[1]
+        assert cmd[-1] == '-'
+        context = io.BytesIO(b''.join(run.call_args.kwargs['stdin']))
+        with tarfile.open(fileobj=context) as tar:
+            assert tar.getnames() == ['model/weights.bin', 'Dockerfile', '.dockerignore']
+            assert tar.extractfile('model/weights.bin').read() == b'x' * 5000
+            dockerfile = tar.extractfile('Dockerfile').read().decode()
+        assert dockerfile.startswith('FROM funcx_container_base:abc\n')
+        assert 'COPY --chown' in dockerfile
+        assert sorted(os.listdir(temp_dir)) == ['layers.json', 'payload']
+
+
+async def test_docker_build_mounts_lock_outside_context(container_spec_fixture, settings_fixture, mocker):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        settings_fixture.BUILD_BACKEND = BuildBackend.docker
+        settings_fixture.PACKAGE_CACHE = False
+        c = Container(container_spec_fixture,
+                      str(uuid.uuid4()),
+                      settings_fixture,
+                      temp_dir,
+                      DOCKER_BASE_URL)
+        c.build_type = BuildType.payload
+        c.payload_path = os.path.join(temp_dir, 'payload')
+        with zipfile.ZipFile(c.payload_path, 'w') as zip_obj:
+            zip_obj.writestr('app.py', b'print(1)\n')
+        lock = {'digest': 'abc', 'conda': ['@EXPLICIT', 'https://example.com/pandas.tar.bz2'],
+                'pip': ['soupsieve==2.2.1']}
+
+        mocker.patch('funcx_container_service.build.base_images.ensure', return_value='funcx_container_base:abc')
+        mocker.patch('funcx_container_service.build.layer_index', LayerIndex(os.path.join(temp_dir, 'layers.json')))
+        run = mocker.patch('funcx_container_service.build.run_build_process')
+        await docker_build(c, '1.0', lock)
+
+        cmd = run.call_args.args[1]
+        lock_dir = os.path.join(temp_dir, '.funcx-lock')
+        assert cmd[cmd.index('--build-context') + 1] == f'funcx-lock={lock_dir}'
+        with open(os.path.join(lock_dir, 'pip.txt')) as f:
+            assert f.read() == 'soupsieve==2.2.1\n'
+        context = io.BytesIO(b''.join(run.call_args.kwargs['stdin']))
+        with tarfile.open(fileobj=context) as tar:
+            assert tar.getnames() == ['app.py', 'Dockerfile', '.dockerignore']
+            assert '.funcx-lock' in tar.extractfile('.dockerignore').read().decode().split()
+            assert 'from=funcx-lock' in tar.extractfile('Dockerfile').read().decode()
+
+
+async def test_build_process_killed_when_context_feed_fails(container_spec_fixture, settings_fixture, mocker, fp):
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        c = Container(container_spec_fixture,
+                      str(uuid.uuid4()),
+                      settings_fixture,
+                      temp_dir,
+                      DOCKER_BASE_URL)
+
+        fp.register([fp.any()], wait=0.5)
+        mocker.patch('os.getpgid', return_value=1)
+        mocker.patch('funcx_container_service.build.feed_stdin', side_effect=zipfile.BadZipFile('truncated archive'))
+        killpg = mocker.patch('os.killpg')
+
+        with pytest.raises(zipfile.BadZipFile):
+            await run_build_process(c, ['docker', 'build', '-'], '1.0', BuildBackend.docker, stdin=iter([b'x']))
+        killpg.assert_called_once()
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import time
+
+from funcx_container_service.buildlog import BuildLog, MAX_LINE_LENGTH, prune_saved_logs, read_saved_log
+
+
+def test_build_log_is_bounded():
+    build_log = BuildLog(max_lines=3)
+    for n in range(5):
+        build_log.append(f'line {n}')
+
+    assert build_log.text() == 'line 2 line 3 line 4'
+    assert build_log.total_lines == 5
+    assert build_log.dropped_lines == 2
+    assert all(timestamp > 0 for timestamp, _, _ in build_log.lines)
+
+
+async def test_build_log_consume_splits_lines():
+    reader = asyncio.StreamReader()
+    reader.feed_data(b'Step 1/3\nStep 2')
+    reader.feed_data(b'/3\r\n' + b'x' * (MAX_LINE_LENGTH + 10) + b'\nlast')
+    reader.feed_eof()
+
+    build_log = BuildLog(max_lines=10)
+    await build_log.consume(reader, 'stderr')
+
+    lines = [line for _, _, line in build_log.lines]
+    assert lines[:2] == ['Step 1/3', 'Step 2/3']
+    assert lines[2] == 'x' * MAX_LINE_LENGTH
+    assert lines[3:] == ['x' * 10, 'last']
+    assert build_log.text(stream='stdout') == ''
+
+
+async def test_build_log_follow_replays_and_waits():
+    build_log = BuildLog(max_lines=10)
+    build_log.append('first')
+
+    received = []
+
+    async def subscriber():
+        async for line_number, _, _, line in build_log.follow():
+            received.append((line_number, line))
+
+    followers = [asyncio.create_task(subscriber()) for _ in range(2)]
+    await asyncio.sleep(0)
+    build_log.append('second')
+    await asyncio.sleep(0)
+    build_log.append('third')
+    build_log.close()
+    await asyncio.gather(*followers)
+
+    assert received == [(0, 'first'), (0, 'first'), (1, 'second'), (1, 'second'), (2, 'third'), (2, 'third')]
+
+
+async def test_build_log_follow_skips_dropped_lines():
+    build_log = BuildLog(max_lines=2)
+    for n in range(5):
+        build_log.append(f'line {n}')
+    build_log.close()
+
+    lines = [(line_number, line) async for line_number, _, _, line in build_log.follow(start=1)]
+    assert lines == [(3, 'line 3'), (4, 'line 4')]
+
+
+def test_build_log_lines_since():
+    build_log = BuildLog(max_lines=3)
+    for n in range(5):
+        build_log.append(f'line {n}')
+
+    assert [line for _, _, line in build_log.lines_since(3)] == ['line 3', 'line 4']
+    assert [line for _, _, line in build_log.lines_since(0)] == ['line 2', 'line 3', 'line 4']
+    assert build_log.lines_since(5) == []
+
+
+def test_build_log_save_to_keeps_every_line(tmp_path):
+    path = str(tmp_path / 'build.log')
+    build_log = BuildLog(max_lines=2)
+    build_log.append('line 0')
+    build_log.save_to(path)
+    for n in range(1, 5):
+        build_log.append(f'line {n}', stream='stdout')
+    build_log.close()
+
+    assert build_log.text() == 'line 3 line 4'
+    saved = [(line_number, stream, line) for line_number, _, stream, line in read_saved_log(path)]
+    assert saved[0] == (0, 'stderr', 'line 0')
+    assert saved[1:] == [(n, 'stdout', f'line {n}') for n in range(1, 5)]
+    assert [line for _, _, _, line in read_saved_log(path, start=3)] == ['line 3', 'line 4']
+
+
+def test_prune_saved_logs(tmp_path):
+    old = tmp_path / 'old.log'
+    new = tmp_path / 'new.log'
+    old.write_text('')
+    new.write_text('')
+    an_hour_ago = time.time() - 3600
+    os.utime(old, (an_hour_ago, an_hour_ago))
+
+    assert prune_saved_logs(str(tmp_path), max_age=60) == 1
+    assert os.listdir(tmp_path) == ['new.log']
@@ -0,0 +1,157 @@
+import os
+import tempfile
+import uuid
+
+from funcx_container_service.cache import ImageCache, LayerIndex, LockStore, PackageCache, PayloadCache, SifCache
+from funcx_container_service.models import ContainerSpec
+
+
+def test_digest_ignores_container_id_and_order():
+    first = ContainerSpec(container_type="docker",
+                          container_id=uuid.uuid4(),
+                          conda=['pandas', 'numpy'],
+                          pip=['flask==2.0.1'])
+    second = ContainerSpec(container_type="docker",
+                           container_id=uuid.uuid4(),
+                           conda=['numpy', 'pandas'],
+                           pip=['flask==2.0.1'])
+    third = ContainerSpec(container_type="docker",
+                          container_id=uuid.uuid4(),
+                          conda=['numpy'],
+                          pip=['flask==2.0.1'])
+
+    assert first.digest() == second.digest()
+    assert first.digest() != third.digest()
+
+
+def test_image_cache_persists():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_path = os.path.join(temp_dir, 'cache', 'image_index.json')
+        cache = ImageCache(index_path)
+        assert cache.lookup('abc') is None
+
+        cache.record('abc', 'funcx_1234', 'sha256:5678')
+
+        reloaded = ImageCache(index_path)
+        assert reloaded.lookup('abc')['image_id'] == 'sha256:5678'
+
+        reloaded.remove('abc')
+        assert ImageCache(index_path).lookup('abc') is None
+
+
+def test_indexes_start_empty_when_corrupt():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_path = os.path.join(temp_dir, 'index.json')
+        with open(index_path, 'w') as f:
+            f.write('{not json')
+
+        assert ImageCache(index_path).lookup('abc') is None
+        index = LayerIndex(index_path)
+        assert index.hit_ratio(['a']) == 0
+        assert not isinstance(index, ImageCache)
+        index.record(['a'])
+        assert LayerIndex(index_path).hit_ratio(['a']) == 1
+
+
+def test_layer_index_hit_ratio():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_path = os.path.join(temp_dir, 'layer_index.json')
+        index = LayerIndex(index_path, max_entries=3)
+
+        assert index.hit_ratio([]) is None
+        assert index.hit_ratio(['a', 'b']) == 0
+        index.record(['a', 'b'])
+        assert LayerIndex(index_path).hit_ratio(['a', 'b', 'c', 'd']) == 0.5
+
+        index.record(['c', 'd'])
+        assert index.hit_ratio(['a', 'b', 'c', 'd']) == 0.75
+
+
+def test_package_cache_counts_hits_and_misses():
+    cache = PackageCache(max_size=1024)
+    lines = ['#9 3.1 Collecting numpy',
+             '#9 3.2   Using cached numpy-1.21.0-cp37-cp37m-manylinux1_x86_64.whl (13.7 MB)',
+             '#9 3.4 Collecting rich',
+             '#9 3.5   Downloading rich-10.0.0-py3-none-any.whl (200 kB)',
+             '#7 1.0 0 upgraded, 2 newly installed, 0 to remove and 0 not upgraded.',
+             '#7 1.1 Get:1 http://archive.ubuntu.com/ubuntu bionic/main amd64 libxml2 amd64 2.9.4 [663 kB]',
+             '#7 0.5 Get:2 http://archive.ubuntu.com/ubuntu bionic/universe amd64 Packages [11.3 MB]',
+             '#8 9.0 Downloading and Extracting Packages']
+
+    assert cache.count(lines) == (2, 2)
+    assert cache.count(lines[:2]) == (1, 0)
+    assert (cache.hits, cache.misses) == (3, 2)
+
+
+def test_lock_store_matches_exact_specs():
+    def spec(conda=None, pip=None, force_solve=False):
+        return ContainerSpec(container_type="docker", container_id=uuid.uuid4(), conda=conda, pip=pip,
+                             force_solve=force_solve)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = LockStore(os.path.join(temp_dir, 'locks'))
+        store.record(spec(['numpy', 'pandas'], ['flask']), 'docker', ['@EXPLICIT', 'big'], ['flask==2.0.1'])
+        store.record(spec(['numpy']), 'docker', ['@EXPLICIT', 'small'], [])
+
+        assert store.lookup(spec(['numpy'], force_solve=True), 'docker')['conda'] == ['@EXPLICIT', 'small']
+        assert store.lookup(spec(['pandas', 'numpy'], ['flask']), 'docker')['conda'] == ['@EXPLICIT', 'big']
+        # a spec covered by a larger lock still gets solved for itself
+        assert store.lookup(spec(['pandas']), 'docker') is None
+        assert store.lookup(spec(['numpy']), 'repo2docker') is None
+
+
+def test_image_cache_closest_subsets():
+    def spec(conda=None, pip=None):
+        return ContainerSpec(container_type="docker", container_id=uuid.uuid4(), conda=conda, pip=pip)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache = ImageCache(os.path.join(temp_dir, 'image_index.json'))
+        cache.record('small', 'funcx_small', 'sha256:1', spec=spec(['numpy']), backend='docker', build_time=60)
+        cache.record('large', 'funcx_large', 'sha256:2', spec=spec(['numpy'], ['rich']), backend='docker',
+                     build_time=90)
+        cache.record('other', 'funcx_other', 'sha256:3', spec=spec(['numpy'], ['flask']), backend='docker')
+        cache.record('r2d', 'funcx_r2d', 'sha256:4', spec=spec(['numpy'], ['rich']), backend='repo2docker')
+        cache.record('bare', 'funcx_bare', 'sha256:5')
+
+        new_spec = spec(['numpy'], ['rich', 'tqdm'])
+        assert [d for d, _ in cache.closest_subsets(new_spec, 'docker')] == ['large', 'small']
+        assert cache.closest_subsets(spec(['scipy']), 'docker') == []
+
+
+def test_payload_cache_is_content_addressed_and_bounded():
+    def download(cache, content):
+        path = cache.temp_path()
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache = PayloadCache(os.path.join(temp_dir, 'payloads'), max_size=10)
+
+        cache.store('http://a', download(cache, b'123456'), 'one', 6, etag='"a"')
+        cache.store('http://b', download(cache, b'123456'), 'one', 6)
+        assert cache.validators('http://a') == {'If-None-Match': '"a"'}
+        assert os.listdir(os.path.join(temp_dir, 'payloads', 'sha256')) == ['one']
+
+        cache.store('http://c', download(cache, b'abcdef'), 'two', 6, last_modified='Mon, 01 Jan 2024 00:00:00 GMT')
+        assert cache.validators('http://a') == {}
+        assert cache.cached_digest('http://b') is None
+        assert not cache.checkout('one', os.path.join(temp_dir, 'one'))
+        assert cache.checkout('two', os.path.join(temp_dir, 'two'))
+        with open(os.path.join(temp_dir, 'two'), 'rb') as f:
+            assert f.read() == b'abcdef'
+
+
+def test_sif_cache_matches_image_and_evicts():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = SifCache(cache_dir, max_size=150)
+        for digest in ('first', 'second'):
+            temp_path = cache.temp_path(digest)
+            with open(temp_path, 'wb') as f:
+                f.write(b'x' * 100)
+            cache.store(digest, f'sha256:{digest}', temp_path)
+
+        assert cache.lookup('second', 'sha256:second') == cache.sif_path('second')
+        assert cache.lookup('second', 'sha256:rebuilt') is None
+        assert cache.lookup('first', 'sha256:first') is None
+        assert not os.path.exists(cache.sif_path('first'))
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import tempfile
+import uuid
+
+import httpx
+import pytest
+from pytest_httpx import HTTPXMock
+
+from funcx_container_service import Settings
+from funcx_container_service.callback_router import StatusPublisher, update_status
+from funcx_container_service.container import Container
+from funcx_container_service.models import BuildStatus, CompletionSpec, ContainerSpec
+from funcx_container_service import DOCKER_BASE_URL
+
+
+# Fixtures
+
+@pytest.fixture
+def publisher_fixture():
+    settings = Settings()
+    settings.STATUS_RETRIES = 2
+    settings.STATUS_BACKOFF = 0.001
+    return StatusPublisher(settings)
+
+
+@pytest.fixture
+def delta_container_fixture():
+    settings = Settings()
+    settings.WEBSERVICE_URL = 'http://webservice/'
+    settings.STATUS_DELTA_UPDATES = True
+    settings.STATUS_LOG_TAIL = 10
+    spec = ContainerSpec(container_type="docker",
+                         container_id=uuid.uuid4(),
+                         pip=['flask'])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        yield Container(spec, str(uuid.uuid4()), settings, temp_dir, DOCKER_BASE_URL)
+
+
+# Tests
+async def test_publish_retries_server_errors(publisher_fixture, httpx_mock: HTTPXMock):
+    httpx_mock.add_response(status_code=503)
+    httpx_mock.add_response(status_code=200)
+
+    response = await publisher_fixture.publish('abc', 'http://webservice/status', '{}')
+
+    assert response.status_code == 200
+    assert len(httpx_mock.get_requests()) == 2
+    await publisher_fixture.aclose()
+
+
+async def test_publish_gives_up_after_retries(publisher_fixture, httpx_mock: HTTPXMock):
+    for _ in range(3):
+        httpx_mock.add_exception(httpx.ConnectError('webservice down'))
+
+    response = await publisher_fixture.publish('abc', 'http://webservice/status', '{}')
+
+    assert response is None
+    assert len(httpx_mock.get_requests()) == 3
+    await publisher_fixture.aclose()
+
+
+async def test_publish_coalesces_pending_updates(publisher_fixture, httpx_mock: HTTPXMock):
+    httpx_mock.add_response(status_code=200)
+
+    first = asyncio.create_task(publisher_fixture.publish('abc', 'http://webservice/status', '"queued"'))
+    await asyncio.sleep(0)
+    later = [asyncio.create_task(publisher_fixture.publish('abc', 'http://webservice/status', body))
+             for body in ('"building"', '"ready"')]
+    responses = await asyncio.gather(first, *later)
+
+    bodies = [request.content for request in httpx_mock.get_requests()]
+    assert bodies == [b'"queued"', b'"ready"']
+    assert all(response.status_code == 200 for response in responses)
+    await publisher_fixture.aclose()
+
+
+async def test_delta_updates_send_changed_fields(delta_container_fixture, httpx_mock: HTTPXMock):
+    httpx_mock.add_response(status_code=200)
+    container = delta_container_fixture
+
+    await container.update_status(BuildStatus.queued)
+    await container.update_status(BuildStatus.building)
+    container.completion_spec = CompletionSpec(docker_client_version='1.0',
+                                               repo2docker_stdout='x' * 100 + 'tail-of-log')
+    await container.update_status(BuildStatus.ready)
+
+    first, second, third = [json.loads(request.content) for request in httpx_mock.get_requests()]
+    assert first['pip'] == ['flask']
+    assert set(second) == {'container_id', 'build_id', 'RUN_ID', 'build_status', 'status_delta'}
+    assert second['build_status'] == 'building'
+    assert 'pip' not in third
+    assert third['repo2docker_stdout'] == 'ail-of-log'
+    assert third['build_log_url'] == f'/build/{container.build_spec.build_id}/logs'
+
+
+async def test_delta_updates_resend_after_failure(delta_container_fixture, httpx_mock: HTTPXMock):
+    container = delta_container_fixture
+    httpx_mock.add_response(status_code=400)
+    httpx_mock.add_response(status_code=200)
+
+    await update_status(container)
+    await update_status(container)
+
+    first, second = [json.loads(request.content) for request in httpx_mock.get_requests()]
+    assert first['pip'] == second['pip'] == ['flask']
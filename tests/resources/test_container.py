@@ -1,21 +1,35 @@
+import hashlib
+import io
 import os
 from pathlib import Path
 import pytest
 import tempfile
-from unittest import mock
 import shutil
+import tarfile
 import uuid
 
+import docker
 from pytest_httpx import HTTPXMock, IteratorStream
 
 from funcx_container_service import Settings
+from funcx_container_service.config import RegistryConfig
+from funcx_container_service.cache import PayloadCache
 from funcx_container_service.container import Container
-from funcx_container_service.models import ContainerSpec, BuildType
+from funcx_container_service.models import CompletionSpec, ContainerSpec, BuildType, BuildStatus
+from funcx_container_service.push import RegistryError, push_slots
 from funcx_container_service import DOCKER_BASE_URL
 
 
 # Fixtures
 
+@pytest.fixture(autouse=True)
+def reset_push_slots():
+    # the slots are semaphores bound to the event loop of the test that first waited on them
+    push_slots.reset()
+    yield
+    push_slots.reset()
+
+
 @pytest.fixture
 def settings_fixture():
     settings = Settings()
@@ -93,7 +107,7 @@ def test_uncompress_non_zip(container_spec_fixture, settings_fixture, mocker):
             c.uncompress_payload(f'{temp_dir}/data.txt.zip')
 
 
-def test_update_build_type_github(container_spec_fixture, settings_fixture):
+async def test_update_build_type_github(container_spec_fixture, settings_fixture):
     with tempfile.TemporaryDirectory() as temp_dir:
         deleteme = os.path.join(temp_dir, "deleteme")
         os.mkdir(deleteme)
@@ -106,11 +120,11 @@ def test_update_build_type_github(container_spec_fixture, settings_fixture):
                       deleteme,
                       DOCKER_BASE_URL)
 
-        c.update_build_type()
+        await c.update_build_type()
         assert c.build_type == BuildType.github
 
 
-def test_update_build_type_payload(container_spec_test_url_fixture, settings_fixture, mocker):
+async def test_update_build_type_payload(container_spec_test_url_fixture, settings_fixture, mocker):
     with tempfile.TemporaryDirectory() as temp_dir:
         shutil.copyfile("tests/resources/data.txt.zip", f'{temp_dir}/data.txt.zip')
         run_id = str(uuid.uuid4())
@@ -120,11 +134,11 @@ def test_update_build_type_payload(container_spec_test_url_fixture, settings_fix
                       temp_dir,
                       DOCKER_BASE_URL)
         mocker.patch("funcx_container_service.container.Container.download_payload", return_value=True)
-        c.update_build_type()
+        await c.update_build_type()
         assert c.build_type == BuildType.payload
 
 
-def test_update_build_type_container(container_spec_fixture, settings_fixture):
+async def test_update_build_type_container(container_spec_fixture, settings_fixture):
     with tempfile.TemporaryDirectory() as temp_dir:
         shutil.copyfile("tests/resources/data.txt.zip", f'{temp_dir}/data.txt.zip')
         run_id = str(uuid.uuid4())
@@ -135,11 +149,11 @@ def test_update_build_type_container(container_spec_fixture, settings_fixture):
                       DOCKER_BASE_URL)
         c.container_spec.payload_url = None
 
-        c.update_build_type()
+        await c.update_build_type()
         assert c.build_type == BuildType.container
 
 
-def test_delete_temp_dir(container_spec_fixture, settings_fixture):
+async def test_delete_temp_dir(container_spec_fixture, settings_fixture):
     with tempfile.TemporaryDirectory() as test_dir:
         temp_dir = f"{test_dir}/build_dir"
         os.mkdir(temp_dir)
@@ -153,7 +167,7 @@ def test_delete_temp_dir(container_spec_fixture, settings_fixture):
                       DOCKER_BASE_URL)
         print(f'does tempdir {temp_dir} exist?: {os.path.exists(temp_dir)}')
 
-        c.delete_temp_dir()
+        await c.delete_temp_dir()
         assert not Path(temp_dir).exists()
 
 
@@ -175,10 +189,10 @@ def test_uncompress_payload(container_spec_fixture, settings_fixture, mocker):
         assert Path(f'{temp_dir}/test.txt').exists()
 
 
-@pytest.mark.skip(reason="having issues distinguishing tar vs gz - getting 'untar failed: truncated header' error")
 def test_uncompress_tar(container_spec_fixture, settings_fixture):
     with tempfile.TemporaryDirectory() as temp_dir:
-        shutil.copyfile("tests/resources/test.tar.gz", f'{temp_dir}/test.tar.gz')
+        with tarfile.open(f'{temp_dir}/test.tar.gz', 'w:gz') as tar:
+            tar.add("tests/resources/test.txt", arcname='test.txt')
         run_id = str(uuid.uuid4())
         c = Container(container_spec_fixture,
                       run_id,
@@ -208,38 +222,279 @@ def test_uncompress_fail(container_spec_fixture, settings_fixture):
     assert e.value.code == 1
 
 
-# @pytest.mark.parameterize("input, expected", [(3, 'You won!'), (4, 'You lost')])
-@pytest.mark.skip(reason="can't access request docs to figure out proper handling")
-@mock.patch('funcx_container_service.container.requests.get')
-def test_mocking_download(mock_requests_get, settings_fixture, container_spec_fixture):
-    mock_response = mock.Mock(IteratorStream(open("tests/resources/data.txt.zip", "rb")))
-    mock_requests_get.return_value = mock_response
-    print(f'cwd: {os. getcwd()}')
-    with tempfile.TemporaryDirectory() as temp_dir:
+@pytest.fixture
+def payload_cache_fixture(mocker):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = PayloadCache(cache_dir, max_size=1024 ** 2)
+        mocker.patch('funcx_container_service.container.payload_cache', cache)
+        yield cache
 
-        c = Container(container_spec_fixture,
+
+async def test_download_payload(settings_fixture, container_spec_test_url_fixture, payload_cache_fixture,
+                                httpx_mock: HTTPXMock):
+    with open("tests/resources/data.txt.zip", "rb") as f:
+        payload = f.read()
+    httpx_mock.add_response(stream=IteratorStream([payload[:100], payload[100:]]), headers={'ETag': '"v1"'})
+
+    with tempfile.TemporaryDirectory() as test_dir:
+        temp_dir = f"{test_dir}/build_dir"
+        os.mkdir(temp_dir)
+        c = Container(container_spec_test_url_fixture,
                       uuid.uuid4(),
                       settings_fixture,
                       temp_dir,
                       DOCKER_BASE_URL)
 
-        download_result = c.download_payload()
+        assert await c.download_payload()
 
-        assert download_result
+        assert c.payload_path == f'{temp_dir}.payload'
+        assert os.path.isfile(c.payload_path)
+        assert 'payload' not in os.listdir(temp_dir)
+        assert os.path.isfile(os.path.join(temp_dir, 'test.txt'))
+        assert c.payload_digest == hashlib.sha256(payload).hexdigest()
+        assert not c.payload_cache_hit
+        assert os.path.isfile(payload_cache_fixture.blob_path(c.payload_digest))
 
+        await c.delete_temp_dir()
+        assert not os.path.exists(c.payload_path)
 
-@pytest.mark.skip(reason="no longer using httpx - keeping to replicate pattern in sync approach")
-@pytest.mark.asyncio
-async def test_download_2(settings_fixture, container_spec_fixture, httpx_mock: HTTPXMock):
-    httpx_mock.add_response(stream=IteratorStream(open("tests/resources/data.txt.zip", "rb")))
-    with tempfile.TemporaryDirectory() as temp_dir:
 
+async def test_download_payload_revalidates(settings_fixture, container_spec_test_url_fixture, payload_cache_fixture,
+                                            httpx_mock: HTTPXMock):
+    with open("tests/resources/data.txt.zip", "rb") as f:
+        payload = f.read()
+    httpx_mock.add_response(content=payload, headers={'ETag': '"v1"'})
+    httpx_mock.add_response(status_code=304, match_headers={'If-None-Match': '"v1"'})
+
+    for _ in range(2):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            c = Container(container_spec_test_url_fixture,
+                          uuid.uuid4(),
+                          settings_fixture,
+                          temp_dir,
+                          DOCKER_BASE_URL)
+            assert await c.download_payload()
+            assert os.path.isfile(os.path.join(temp_dir, 'test.txt'))
+
+    assert c.payload_cache_hit
+    assert c.payload_digest == hashlib.sha256(payload).hexdigest()
+
+
+async def test_payload_member_cannot_overwrite_cache(settings_fixture, container_spec_test_url_fixture,
+                                                     payload_cache_fixture, httpx_mock: HTTPXMock):
+    payload_file = io.BytesIO()
+    with tarfile.open(fileobj=payload_file, mode='w:gz') as tar:
+        info = tarfile.TarInfo('payload')
+        info.size = 9
+        tar.addfile(info, io.BytesIO(b'overwrite'))
+    payload = payload_file.getvalue()
+    digest = hashlib.sha256(payload).hexdigest()
+    httpx_mock.add_response(content=payload, headers={'ETag': '"v1"'})
+    httpx_mock.add_response(status_code=304, match_headers={'If-None-Match': '"v1"'})
+
+    for _ in range(2):
+        with tempfile.TemporaryDirectory() as test_dir:
+            temp_dir = f"{test_dir}/build_dir"
+            os.mkdir(temp_dir)
+            c = Container(container_spec_test_url_fixture,
+                          uuid.uuid4(),
+                          settings_fixture,
+                          temp_dir,
+                          DOCKER_BASE_URL)
+            assert await c.download_payload()
+            assert c.payload_digest == digest
+            with open(os.path.join(temp_dir, 'payload'), 'rb') as f:
+                assert f.read() == b'overwrite'
+            with open(payload_cache_fixture.blob_path(digest), 'rb') as f:
+                assert hashlib.sha256(f.read()).hexdigest() == digest
+            await c.delete_temp_dir()
+
+    assert c.payload_cache_hit
+
+
+def test_start_build_decisions(container_spec_fixture, settings_fixture, mocker):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        run_id = str(uuid.uuid4())
         c = Container(container_spec_fixture,
-                      uuid.uuid4(),
+                      run_id,
                       settings_fixture,
                       temp_dir,
                       DOCKER_BASE_URL)
+        remove = mocker.patch("funcx_container_service.container.Container.remove_stale_build")
+
+        c.build_spec.build_status = BuildStatus.ready
+        assert not c.start_build(str(uuid.uuid4()))
+
+        c.build_spec.build_status = BuildStatus.building
+        assert not c.start_build(run_id)
+        remove.assert_not_called()
+
+        assert c.start_build(str(uuid.uuid4()))
+        remove.assert_called_once()
+
+
+async def test_push_image_summarizes_progress(container_spec_fixture, settings_fixture, mocker):
+    settings_fixture.REGISTRY_USERNAME = 'funcx'
+    settings_fixture.REGISTRY_URL = 'https://registry.example.com'
+    settings_fixture.PUSH_PROGRESS_INTERVAL = 0
+    docker_client = mocker.MagicMock()
+    docker_client.login.return_value = {'Status': 'Login Succeeded'}
+    docker_client.inspect_image.return_value = {'Id': 'sha256:' + 'b' * 64, 'RepoDigests': []}
+    docker_client.push.side_effect = [iter(
+        [{'status': 'Preparing', 'progressDetail': {}, 'id': 'aaa'}]
+        + [{'status': 'Pushing', 'progressDetail': {'current': n, 'total': 10000}, 'id': 'aaa'}
+           for n in range(100, 10001, 100)]
+        + [{'status': 'Pushed', 'progressDetail': {}, 'id': 'aaa'},
+           {'progressDetail': {}, 'aux': {'Tag': 'x', 'Digest': 'sha256:def', 'Size': 1234}}]),
+        iter([{'status': 'Layer already exists', 'progressDetail': {}, 'id': 'aaa'},
+              {'progressDetail': {}, 'aux': {'Tag': 'latest', 'Digest': 'sha256:def', 'Size': 1234}}])]
+    mocker.patch('funcx_container_service.container.docker_clients.get', return_value=docker_client)
+    mocker.patch('funcx_container_service.container.registry_auth.login', return_value={'Status': 'Login Succeeded'})
 
-        await c.download_payload()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        c = Container(container_spec_fixture, str(uuid.uuid4()), settings_fixture, temp_dir, DOCKER_BASE_URL)
+        c.completion_spec = CompletionSpec(docker_client_version='1.0')
+        update_status = mocker.patch.object(c, 'update_status')
+        await c.push_image()
+
+    content_tag = f'{container_spec_fixture.digest()[:16]}-{"b" * 16}'
+    assert [call.kwargs['tag'] for call in docker_client.push.call_args_list] == [content_tag, 'latest']
+    push_log = c.build_log.text(stream='push', sep='\n')
+    assert push_log == 'aaa: Preparing\naaa: Pushing\naaa: Pushed\naaa: Layer already exists'
+    assert c.completion_spec.image_tag == 'latest'
+    assert c.completion_spec.image_immutable_tag == content_tag
+    assert c.completion_spec.image_digest == 'sha256:def'
+    assert c.completion_spec.image_pull_command == f'docker pull registry.example.com/funcx/{c.image_name}@sha256:def'
+    assert c.completion_spec.push_progress['bytes_pushed'] == 10000
+    assert c.completion_spec.push_progress['done'] is True
+    assert c.completion_spec.docker_push_log.startswith('pushed 1 of 1 layers')
+    update_status.assert_called_with(BuildStatus.building)
+
+
+async def test_push_image_skipped_when_registry_has_image(container_spec_fixture, settings_fixture, mocker):
+    settings_fixture.REGISTRY_USERNAME = 'funcx'
+    settings_fixture.REGISTRY_URL = 'https://registry.example.com'
+    docker_client = mocker.MagicMock()
+    docker_client.inspect_image.return_value = {'Id': 'sha256:' + 'b' * 64}
+    mocker.patch('funcx_container_service.container.docker_clients.get', return_value=docker_client)
+    mocker.patch('funcx_container_service.container.registry_auth.login', return_value={'Status': 'Login Succeeded'})
+    tag_existing = mocker.patch('funcx_container_service.container.tag_existing_image',
+                                return_value=('sha256:m', 46000))
+    mocker.patch('funcx_container_service.container.push_throughput.rate', 1000)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        c = Container(container_spec_fixture, str(uuid.uuid4()), settings_fixture, temp_dir, DOCKER_BASE_URL)
+        c.completion_spec = CompletionSpec(docker_client_version='1.0')
+        await c.push_image()
+
+    assert [call.args[4] for call in tag_existing.call_args_list] == [c.completion_spec.image_immutable_tag, 'latest']
+    docker_client.push.assert_not_called()
+    assert c.completion_spec.image_pull_command.endswith(f'funcx/{c.image_name}@sha256:m')
+    assert c.completion_spec.push_skipped is True
+    assert c.completion_spec.push_bytes_saved == 46000
+    assert c.completion_spec.push_time_saved == 46
+
+
+async def test_push_image_to_mirrors(container_spec_fixture, settings_fixture, mocker):
+    settings_fixture.REGISTRY_USERNAME = 'funcx'
+    settings_fixture.REGISTRY_URL = 'https://registry.example.com'
+    settings_fixture.SKIP_EXISTING_PUSH = False
+    settings_fixture.REGISTRY_MIRRORS = [
+        RegistryConfig(url='https://mirror.site-a.org', username='funcx-a', password='a', site='site-a'),
+        RegistryConfig(url='https://mirror.site-b.org', username='funcx-b', password='b', site='site-b')]
+    docker_client = mocker.MagicMock()
+    docker_client.inspect_image.return_value = {'Id': 'sha256:' + 'b' * 64}
+
+    def push(repository, tag, auth_config, **kwargs):
+        if repository.startswith('mirror.site-b.org/'):
+            raise docker.errors.APIError('connection refused')
+        return iter([{'progressDetail': {}, 'aux': {'Tag': tag, 'Digest': f'sha256:{auth_config["username"]}'}}])
+
+    docker_client.push.side_effect = push
+    mocker.patch('funcx_container_service.container.docker_clients.get', return_value=docker_client)
+    login = mocker.patch('funcx_container_service.container.registry_auth.login',
+                         return_value={'Status': 'Login Succeeded'})
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        c = Container(container_spec_fixture, str(uuid.uuid4()), settings_fixture, temp_dir, DOCKER_BASE_URL)
+        c.completion_spec = CompletionSpec(docker_client_version='1.0')
+        await c.push_image()
+
+    assert sorted(call.kwargs['registry'] for call in login.call_args_list) == [
+        'https://mirror.site-a.org', 'https://mirror.site-b.org', 'https://registry.example.com']
+    assert c.completion_spec.image_pull_command == f'docker pull registry.example.com/funcx/{c.image_name}@sha256:funcx'
+    assert c.completion_spec.image_pull_commands == {
+        'registry.example.com': f'docker pull registry.example.com/funcx/{c.image_name}@sha256:funcx',
+        'site-a': f'docker pull mirror.site-a.org/funcx-a/{c.image_name}@sha256:funcx-a'}
+    pushes = {push['site']: push for push in c.completion_spec.registry_pushes}
+    assert pushes['site-a']['repository'] == f'mirror.site-a.org/funcx-a/{c.image_name}'
+    assert pushes['site-a']['push_time'] >= 0
+    assert 'connection refused' in pushes['site-b']['error']
+
+
+async def test_push_image_errors_in_push_output(container_spec_fixture, settings_fixture, mocker):
+    settings_fixture.REGISTRY_USERNAME = 'funcx'
+    settings_fixture.REGISTRY_URL = 'https://registry.example.com'
+    settings_fixture.SKIP_EXISTING_PUSH = False
+    settings_fixture.REGISTRY_MIRRORS = [
+        RegistryConfig(url='https://mirror.site-a.org', username='funcx-a', password='a', site='site-a')]
+    docker_client = mocker.MagicMock()
+    docker_client.inspect_image.return_value = {'Id': 'sha256:' + 'b' * 64}
+    failing = {'mirror.site-a.org/'}
+
+    def push(repository, tag, auth_config, **kwargs):
+        if any(repository.startswith(prefix) for prefix in failing):
+            return iter([{'status': 'Preparing', 'progressDetail': {}, 'id': 'aaa'},
+                         {'errorDetail': {'message': 'denied: quota exceeded'}, 'error': 'denied: quota exceeded'}])
+        return iter([{'progressDetail': {}, 'aux': {'Tag': tag, 'Digest': 'sha256:abc'}}])
+
+    docker_client.push.side_effect = push
+    mocker.patch('funcx_container_service.container.docker_clients.get', return_value=docker_client)
+    mocker.patch('funcx_container_service.container.registry_auth.login', return_value={'Status': 'Login Succeeded'})
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        c = Container(container_spec_fixture, str(uuid.uuid4()), settings_fixture, temp_dir, DOCKER_BASE_URL)
+        c.completion_spec = CompletionSpec(docker_client_version='1.0')
+        await c.push_image()
+
+        pushes = {push['site']: push for push in c.completion_spec.registry_pushes}
+        assert 'quota exceeded' in pushes['site-a']['error']
+        assert 'pull_command' not in pushes['site-a']
+        assert list(c.completion_spec.image_pull_commands) == ['registry.example.com']
+
+        # the same failure on the primary registry fails the push
+        failing.add('funcx/')
+        c.completion_spec = CompletionSpec(docker_client_version='1.0')
+        with pytest.raises(RegistryError, match='quota exceeded'):
+            await c.push_image()
+
+
+async def test_push_image_login_failure(container_spec_fixture, settings_fixture, mocker):
+    settings_fixture.REGISTRY_USERNAME = 'funcx'
+    settings_fixture.REGISTRY_URL = 'https://registry.example.com'
+    settings_fixture.SKIP_EXISTING_PUSH = False
+    settings_fixture.REGISTRY_MIRRORS = [
+        RegistryConfig(url='https://mirror.site-a.org', username='funcx-a', password='a', site='site-a')]
+    docker_client = mocker.MagicMock()
+    docker_client.inspect_image.return_value = {'Id': 'sha256:' + 'b' * 64}
+    docker_client.push.side_effect = lambda repository, tag, **kwargs: iter(
+        [{'progressDetail': {}, 'aux': {'Tag': tag, 'Digest': 'sha256:abc'}}])
+    mocker.patch('funcx_container_service.container.docker_clients.get', return_value=docker_client)
+    refused = {'https://mirror.site-a.org'}
+    mocker.patch('funcx_container_service.container.registry_auth.login',
+                 side_effect=lambda client, username, password, registry: {
+                     'Status': 'Login Failed' if registry in refused else 'Login Succeeded'})
 
-        assert os.path.isfile(temp_dir + 'payload')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        c = Container(container_spec_fixture, str(uuid.uuid4()), settings_fixture, temp_dir, DOCKER_BASE_URL)
+        c.completion_spec = CompletionSpec(docker_client_version='1.0')
+        await c.push_image()
+
+        pushes = {push['site']: push for push in c.completion_spec.registry_pushes}
+        assert 'could not log in to https://mirror.site-a.org' in pushes['site-a']['error']
+        assert c.completion_spec.image_pull_command.endswith('@sha256:abc')
+
+        refused.add('https://registry.example.com')
+        c.completion_spec = CompletionSpec(docker_client_version='1.0')
+        with pytest.raises(RegistryError, match='could not log in to https://registry.example.com'):
+            await c.push_image()
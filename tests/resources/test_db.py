@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import uuid
+
+import pytest
+
+from funcx_container_service import Settings
+from funcx_container_service.container import Container
+from funcx_container_service.db import BuildStore
+from funcx_container_service.models import ContainerSpec, BuildStatus
+from funcx_container_service.scheduler import BuildScheduler
+from funcx_container_service import DOCKER_BASE_URL
+
+
+# Fixtures
+
+@pytest.fixture
+def settings_fixture():
+    settings = Settings()
+    settings.app_name = 'mocked_settings_app'
+    settings.admin_email = 'testing_admin@example.com'
+    return settings
+
+
+@pytest.fixture
+def container_spec_fixture():
+    mock_spec = ContainerSpec(container_type="docker",
+                              container_id=uuid.uuid4(),
+                              conda=['pandas'],
+                              pip=['beautifulsoup4', 'flask==2.0.1', 'scikit-learn']
+                              )
+    return mock_spec
+
+
+# Tests
+def test_build_store_orphaned(container_spec_fixture, settings_fixture):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = BuildStore(f"sqlite:///{os.path.join(temp_dir, 'db', 'builds.db')}")
+        old_run_id, new_run_id = str(uuid.uuid4()), str(uuid.uuid4())
+
+        building = Container(container_spec_fixture, old_run_id, settings_fixture, temp_dir, DOCKER_BASE_URL)
+        building.build_spec.build_status = BuildStatus.building
+        building.build_pid = 4321
+        store.save(building)
+
+        finished = Container(container_spec_fixture, old_run_id, settings_fixture, temp_dir, DOCKER_BASE_URL)
+        finished.build_spec.build_status = BuildStatus.ready
+        store.save(finished)
+
+        current = Container(container_spec_fixture, new_run_id, settings_fixture, temp_dir, DOCKER_BASE_URL)
+        current.build_spec.build_status = BuildStatus.queued
+        store.save(current)
+
+        orphans = store.orphaned(new_run_id)
+        assert [o.build_id for o in orphans] == [str(building.build_spec.build_id)]
+        assert orphans[0].pid == 4321
+        assert orphans[0].phase == 'building'
+
+
+def test_build_store_prunes_old_finished_builds(container_spec_fixture, settings_fixture, mocker):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = BuildStore(f"sqlite:///{os.path.join(temp_dir, 'builds.db')}")
+        run_id = str(uuid.uuid4())
+        builds = {}
+        mocker.patch('funcx_container_service.db.time.time', return_value=1000)
+        for status in (BuildStatus.ready, BuildStatus.failed, BuildStatus.building):
+            builds[status] = Container(container_spec_fixture, run_id, settings_fixture, temp_dir, DOCKER_BASE_URL)
+            builds[status].build_spec.build_status = status
+            store.save(builds[status])
+        mocker.patch('funcx_container_service.db.time.time', return_value=5000)
+        recent = Container(container_spec_fixture, run_id, settings_fixture, temp_dir, DOCKER_BASE_URL)
+        recent.build_spec.build_status = BuildStatus.ready
+        store.save(recent)
+
+        assert store.prune(max_age=3000) == 2
+        assert store.get(builds[BuildStatus.ready].build_spec.build_id) is None
+        assert store.get(builds[BuildStatus.failed].build_spec.build_id) is None
+        assert store.get(builds[BuildStatus.building].build_spec.build_id) is not None
+        assert store.get(recent.build_spec.build_id) is not None
+
+
+async def test_recover_requeues_orphaned_build(container_spec_fixture, settings_fixture, mocker):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = BuildStore(f"sqlite:///{os.path.join(temp_dir, 'builds.db')}")
+        old_run_id, new_run_id = str(uuid.uuid4()), str(uuid.uuid4())
+
+        stale_dir = os.path.join(temp_dir, 'stale')
+        os.mkdir(stale_dir)
+        orphan = Container(container_spec_fixture, old_run_id, settings_fixture, stale_dir, DOCKER_BASE_URL)
+        orphan.build_spec.build_status = BuildStatus.building
+        store.save(orphan)
+
+        mocker.patch('funcx_container_service.callback_router.update_status')
+        scheduler = BuildScheduler(max_concurrent_builds=1, shutdown_timeout=5, build_store=store)
+        await scheduler.recover(new_run_id, settings_fixture, DOCKER_BASE_URL)
+
+        assert not os.path.exists(stale_dir)
+        info = scheduler.build_info(str(orphan.build_spec.build_id))
+        assert info['queue_position'] == 1
+
+        record = store.get(orphan.build_spec.build_id)
+        assert record.RUN_ID == new_run_id
+        assert record.phase == 'queued'
+        assert os.path.exists(os.path.join(record.temp_dir, 'environment.yml'))
+        shutil.rmtree(record.temp_dir)
+
+
+async def test_recover_fails_orphans_when_not_requeueing(container_spec_fixture, settings_fixture, mocker):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = BuildStore(f"sqlite:///{os.path.join(temp_dir, 'builds.db')}")
+        orphan = Container(container_spec_fixture, str(uuid.uuid4()), settings_fixture, temp_dir, DOCKER_BASE_URL)
+        orphan.build_spec.build_status = BuildStatus.queued
+        orphan.temp_dir = os.path.join(temp_dir, 'stale')
+        store.save(orphan)
+
+        settings_fixture.REQUEUE_ORPHANED_BUILDS = False
+        mocker.patch('funcx_container_service.callback_router.update_status')
+        scheduler = BuildScheduler(max_concurrent_builds=1, shutdown_timeout=5, build_store=store)
+        await scheduler.recover(str(uuid.uuid4()), settings_fixture, DOCKER_BASE_URL)
+
+        assert scheduler.build_info(str(orphan.build_spec.build_id)) is None
+        assert store.get(orphan.build_spec.build_id).phase == 'failed'
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from funcx_container_service.docker_pool import DockerClientPool, RegistryAuthCache
+from funcx_container_service import DOCKER_BASE_URL
+
+
+def test_pool_reuses_client(mocker):
+    api_client = mocker.patch('docker.APIClient')
+    pool = DockerClientPool(health_check_interval=60)
+
+    first = pool.get(DOCKER_BASE_URL)
+    second = pool.get(DOCKER_BASE_URL)
+    pool.version(DOCKER_BASE_URL)
+    pool.version(DOCKER_BASE_URL)
+
+    assert first is second
+    api_client.assert_called_once_with(base_url=DOCKER_BASE_URL)
+    first.version.assert_called_once()
+    first.ping.assert_not_called()
+
+
+def test_pool_replaces_unhealthy_client(mocker):
+    stale, fresh = mocker.MagicMock(), mocker.MagicMock()
+    stale.ping.side_effect = Exception('daemon restarted')
+    mocker.patch('docker.APIClient', side_effect=[stale, fresh])
+    pool = DockerClientPool(health_check_interval=-1)
+
+    assert pool.get(DOCKER_BASE_URL) is stale
+    assert pool.get(DOCKER_BASE_URL) is fresh
+    stale.close.assert_called_once()
+
+
+def test_hung_daemon_does_not_block_other_daemons(mocker):
+    release = threading.Event()
+    hung, other = mocker.MagicMock(), mocker.MagicMock()
+    hung.ping.side_effect = lambda: release.wait(5)
+    mocker.patch('docker.APIClient', side_effect=[hung, other])
+    pool = DockerClientPool(health_check_interval=-1)
+    pool.get('tcp://hung:2375')
+
+    pinging = threading.Thread(target=pool.get, args=('tcp://hung:2375',))
+    pinging.start()
+    try:
+        start = time.time()
+        assert pool.get('tcp://other:2375') is other
+        assert time.time() - start < 1
+    finally:
+        release.set()
+        pinging.join()
+
+
+def test_registry_login_is_cached(mocker):
+    docker_client = mocker.MagicMock()
+    docker_client.login.return_value = {'Status': 'Login Succeeded'}
+    auth = RegistryAuthCache(ttl=60)
+
+    for _ in range(3):
+        assert auth.login(docker_client, 'user', 'pwd', 'registry')['Status'] == 'Login Succeeded'
+    docker_client.login.assert_called_once()
+
+    auth.invalidate('user', 'registry')
+    auth.login(docker_client, 'user', 'pwd', 'registry')
+    assert docker_client.login.call_count == 2
+
+
+def test_registry_login_failure_is_not_cached(mocker):
+    docker_client = mocker.MagicMock()
+    docker_client.login.return_value = {'Status': 'Login Failed'}
+    auth = RegistryAuthCache(ttl=60)
+
+    auth.login(docker_client, 'user', 'pwd', 'registry')
+    auth.login(docker_client, 'user', 'pwd', 'registry')
+    assert docker_client.login.call_count == 2
@@ -0,0 +1,64 @@
+from funcx_container_service.dockerfile import emit_dockerfile, emit_layers, layer_keys, plan_layers
+from funcx_container_service.models import CondaSolver
+
+
+def test_plan_layers_tiers():
+    plan = plan_layers(['git', 'libxml2-dev'], None, ['zzz-tool', 'requests', 'flask==2.0.1', 'numpy==1.21.0'])
+
+    assert plan == [('apt', 'popular', ['git']),
+                    ('apt', 'tail', ['libxml2-dev']),
+                    ('pip', 'popular', ['numpy==1.21.0', 'requests']),
+                    ('pip', 'pinned', ['flask==2.0.1']),
+                    ('pip', 'tail', ['zzz-tool'])]
+
+
+def test_layers_independent_of_request_order():
+    first = emit_dockerfile(None, ['scipy', 'xarray'], ['tqdm', 'rich', 'requests'])
+    second = emit_dockerfile(None, ['xarray', 'scipy', 'scipy'], ['requests', 'rich', 'tqdm'])
+
+    assert first == second
+
+
+def test_shared_prefix_shares_layer_keys():
+    common = layer_keys(plan_layers(None, None, ['numpy', 'rich']), 'base')
+    longer = layer_keys(plan_layers(None, None, ['numpy', 'rich', 'flask==2.0.1']), 'base')
+    other_base = layer_keys(plan_layers(None, None, ['numpy', 'rich']), 'other')
+
+    assert longer[:1] == common[:1]
+    assert common[1] != longer[1]
+    assert not set(common) & set(other_base)
+
+
+def test_cache_mounts_stay_out_of_the_image():
+    dockerfile = emit_dockerfile(['libxml2-dev'], ['xarray'], ['rich'], cache_mounts=True)
+
+    assert dockerfile.startswith('# syntax=docker/dockerfile:1\n')
+    assert dockerfile.count('--mount=type=cache') == 4
+    assert '--no-cache-dir' not in dockerfile
+    assert 'conda clean' not in dockerfile.split('xarray')[1]
+
+
+def test_micromamba_solver():
+    layers = emit_layers(plan_layers(None, ['numpy', 'xarray'], None), conda_solver=CondaSolver.micromamba)
+
+    assert layers.count('micro.mamba.pm/api/micromamba/linux-64/1.5.10 ') == 1
+    assert layers.count('micromamba install --yes --root-prefix ${CONDA_DIR}') == 2
+    assert 'conda install' not in layers
+
+
+def test_locked_layers_skip_the_solver():
+    layers = emit_layers(plan_layers(['git'], ['numpy', 'xarray'], ['rich', 'requests']), lock='abc123')
+
+    assert layers.count('--file /tmp/funcx-lock/conda.txt') == 1
+    assert layers.count('pip install --no-deps -r /tmp/funcx-lock/pip.txt') == 1
+    assert 'xarray' not in layers and 'rich' not in layers
+    assert 'apt-get install --yes --no-install-recommends git' in layers
+
+
+def test_micromamba_version_in_layer_keys():
+    plan = plan_layers(None, ['numpy'], None)
+    pinned = layer_keys(plan, 'base', conda_solver=CondaSolver.micromamba)
+    newer = layer_keys(plan, 'base', conda_solver=CondaSolver.micromamba, micromamba_version='2.0.5')
+
+    assert pinned != newer
+    assert '/linux-64/2.0.5 ' in emit_layers(plan, conda_solver=CondaSolver.micromamba, micromamba_version='2.0.5')
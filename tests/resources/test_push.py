@@ -0,0 +1,186 @@
+import json
+import re
+
+import pytest
+from pytest_httpx import HTTPXMock
+
+from funcx_container_service.config import Settings
+from funcx_container_service.push import (PushProgress, PushSlots, PushThroughput, RegistryError, RegistryTarget,
+                                          immutable_tag, pushed_digest, registry_host, registry_targets,
+                                          split_repository, tag_existing_image)
+
+HUB = 'https://registry-1.docker.io/v2'
+MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+MANIFEST = json.dumps({'schemaVersion': 2,
+                       'mediaType': MANIFEST_V2,
+                       'config': {'digest': 'sha256:cfg', 'size': 1000},
+                       'layers': [{'digest': 'sha256:l1', 'size': 40000},
+                                  {'digest': 'sha256:l2', 'size': 5000}]}).encode()
+
+PUSH_OUTPUT = [
+    {'status': 'The push refers to repository [docker.io/funcx/funcx_abc]'},
+    {'status': 'Preparing', 'progressDetail': {}, 'id': 'aaa'},
+    {'status': 'Preparing', 'progressDetail': {}, 'id': 'bbb'},
+    {'status': 'Preparing', 'progressDetail': {}, 'id': 'ccc'},
+    {'status': 'Layer already exists', 'progressDetail': {}, 'id': 'ccc'},
+    {'status': 'Mounted from library/python', 'progressDetail': {}, 'id': 'bbb'},
+] + [
+    {'status': 'Pushing', 'progressDetail': {'current': current, 'total': 4000}, 'id': 'aaa'}
+    for current in range(500, 4001, 500)
+] + [
+    {'status': 'Pushed', 'progressDetail': {}, 'id': 'aaa'},
+    {'status': 'latest: digest: sha256:def size: 1234'},
+    {'progressDetail': {}, 'aux': {'Tag': 'latest', 'Digest': 'sha256:def', 'Size': 1234}},
+]
+
+
+def test_push_progress_per_layer():
+    progress = PushProgress()
+    messages = [progress.update(line) for line in PUSH_OUTPUT]
+    progress.finish()
+
+    assert [m for m in messages if m] == ['aaa: Preparing', 'bbb: Preparing', 'ccc: Preparing',
+                                          'ccc: Layer already exists', 'bbb: Mounted from library/python',
+                                          'aaa: Pushing', 'aaa: Pushed']
+    summary = progress.summary()
+    assert summary['layers'] == 3
+    assert summary['layers_pushed'] == 1
+    assert summary['layers_existing'] == 2
+    assert summary['bytes_pushed'] == 4000
+    assert summary['digest'] == 'sha256:def'
+    assert summary['done'] is True
+    assert progress.text().startswith('pushed 1 of 3 layers (2 already in the registry), 4000 bytes')
+
+
+def test_push_progress_keeps_last_errors():
+    progress = PushProgress()
+    for attempt in range(8):
+        message = progress.update({'errorDetail': {'message': f'denied {attempt}'}, 'error': f'denied {attempt}'})
+
+    assert message == 'error: denied 7'
+    assert progress.summary()['errors'] == [f'denied {attempt}' for attempt in range(3, 8)]
+    assert 'errors: denied 3' in progress.text()
+
+
+@pytest.fixture
+def settings_fixture():
+    settings = Settings()
+    settings.REGISTRY_USERNAME = 'funcx'
+    settings.REGISTRY_PWD = 'pwd'
+    return settings
+
+
+@pytest.fixture
+def hub():
+    return RegistryTarget(None, 'funcx', 'pwd', qualified=False)
+
+
+def test_split_repository():
+    assert split_repository('funcx/funcx_abc') == ('registry-1.docker.io', 'funcx/funcx_abc')
+    assert split_repository('python') == ('registry-1.docker.io', 'library/python')
+    assert split_repository('docker.io/funcx/x') == ('registry-1.docker.io', 'funcx/x')
+    assert split_repository('localhost:5000/funcx/x') == ('localhost:5000', 'funcx/x')
+    assert split_repository('ghcr.io/funcx/x') == ('ghcr.io', 'funcx/x')
+
+
+def test_registry_host(settings_fixture):
+    assert registry_host(settings_fixture) == 'docker.io'
+    settings_fixture.REGISTRY_URL = 'https://registry.example.com/v2/'
+    assert registry_host(settings_fixture) == 'registry.example.com'
+
+
+def test_immutable_tag():
+    assert immutable_tag('a' * 64, 'sha256:' + 'b' * 64) == 'a' * 16 + '-' + 'b' * 16
+
+
+def test_registry_targets(settings_fixture):
+    settings_fixture.REGISTRY_URL = 'https://registry.example.com'
+    settings_fixture.REGISTRY_MIRRORS = [{'url': 'https://mirror.site-a.org/v2/', 'username': 'funcx-a',
+                                          'site': 'site-a', 'max_concurrent_pushes': 4}]
+    settings_fixture = Settings(**settings_fixture.dict())
+    primary, mirror = registry_targets(settings_fixture)
+
+    assert primary.repository('funcx_abc') == 'funcx/funcx_abc'
+    assert primary.pull_reference('funcx_abc') == 'registry.example.com/funcx/funcx_abc'
+    assert primary.site == 'registry.example.com'
+    assert mirror.repository('funcx_abc') == 'mirror.site-a.org/funcx-a/funcx_abc'
+    assert mirror.site == 'site-a'
+    assert mirror.max_concurrent_pushes == 4
+
+
+def test_push_slots_per_target_config():
+    slots = PushSlots()
+    primary = RegistryTarget('https://registry.example.com', 'funcx', 'pw', max_concurrent_pushes=2)
+    same = RegistryTarget('https://registry.example.com', 'funcx', 'other', site='site-a', max_concurrent_pushes=2)
+    wider = RegistryTarget('https://registry.example.com', 'funcx', 'pw', max_concurrent_pushes=5)
+
+    assert slots.get(primary) is slots.get(same)
+    assert slots.get(wider) is not slots.get(primary)
+    assert slots.get(wider)._value == 5
+    slots.reset()
+    assert slots.get(primary)._value == 2
+
+
+def test_push_throughput_estimate():
+    throughput = PushThroughput(weight=0.5)
+    assert throughput.estimate(1000) is None
+    throughput.record({'throughput': 100, 'bytes_pushed': 5000})
+    throughput.record({'throughput': 300, 'bytes_pushed': 5000})
+    throughput.record({'throughput': None, 'bytes_pushed': 0})
+    assert throughput.estimate(1000) == 5
+
+
+async def test_existing_image_tagged_by_mounting_blobs(hub, httpx_mock: HTTPXMock, mocker):
+    docker_client = mocker.MagicMock()
+    docker_client.inspect_image.return_value = {'RepoDigests': ['funcx/funcx_old@sha256:m']}
+    source = f'{HUB}/funcx/funcx_old'
+    target = f'{HUB}/funcx/funcx_new'
+
+    challenge = 'Bearer realm="https://auth.example.com/token",service="registry.example.com"'
+    httpx_mock.add_response(method='HEAD', url=f'{source}/manifests/sha256:m', status_code=401,
+                            headers={'WWW-Authenticate': challenge})
+    httpx_mock.add_response(method='GET', url=re.compile(r'https://auth\.example\.com/token\?.*'), json={'token': 't'})
+    httpx_mock.add_response(method='HEAD', url=f'{source}/manifests/sha256:m',
+                            headers={'Docker-Content-Digest': 'sha256:m'}, match_headers={'Authorization': 'Bearer t'})
+    httpx_mock.add_response(method='GET', url=f'{source}/manifests/sha256:m', content=MANIFEST,
+                            headers={'Content-Type': MANIFEST_V2})
+    httpx_mock.add_response(method='HEAD', url=f'{target}/blobs/sha256:cfg')
+    httpx_mock.add_response(method='HEAD', url=f'{target}/blobs/sha256:l1', status_code=404)
+    httpx_mock.add_response(method='POST', url=re.compile(f'{target}/blobs/uploads/\\?.*'), status_code=201)
+    httpx_mock.add_response(method='HEAD', url=f'{target}/blobs/sha256:l2')
+    httpx_mock.add_response(method='HEAD', url=f'{target}/manifests/latest', status_code=404)
+    httpx_mock.add_response(method='PUT', url=f'{target}/manifests/latest', status_code=201,
+                            match_headers={'Content-Type': MANIFEST_V2})
+
+    saved = await tag_existing_image(docker_client, hub, 'funcx_new', 'funcx/funcx_new', 'latest', 30)
+
+    assert saved == ('sha256:m', 46000)
+    token_request = httpx_mock.get_requests(url=re.compile(r'https://auth.*'))[0]
+    assert token_request.url.params.get_list('scope') == ['repository:funcx/funcx_new:pull,push',
+                                                          'repository:funcx/funcx_old:pull']
+    mount = httpx_mock.get_requests(method='POST')[0]
+    assert mount.url.params['mount'] == 'sha256:l1'
+    assert mount.url.params['from'] == 'funcx/funcx_old'
+    assert httpx_mock.get_requests(method='PUT')[0].content == MANIFEST
+
+
+async def test_image_pushed_when_registry_lacks_it(hub, httpx_mock: HTTPXMock, mocker):
+    docker_client = mocker.MagicMock()
+    docker_client.inspect_image.return_value = {'RepoDigests': ['funcx/funcx_old@sha256:m',
+                                                                'ghcr.io/funcx/funcx_old@sha256:m']}
+    httpx_mock.add_response(method='HEAD', url=f'{HUB}/funcx/funcx_old/manifests/sha256:m', status_code=404)
+
+    assert await tag_existing_image(docker_client, hub, 'funcx_new', 'funcx/funcx_new', 'latest', 30) is None
+
+    docker_client.inspect_image.return_value = {'RepoDigests': []}
+    assert await tag_existing_image(docker_client, hub, 'funcx_new', 'funcx/funcx_new', 'latest', 30) is None
+
+
+async def test_pushed_digest_asks_the_registry(hub, httpx_mock: HTTPXMock):
+    httpx_mock.add_response(method='HEAD', url=f'{HUB}/funcx/funcx_new/manifests/abc',
+                            headers={'Docker-Content-Digest': 'sha256:m'})
+    httpx_mock.add_response(method='HEAD', url=f'{HUB}/funcx/funcx_new/manifests/missing', status_code=404)
+
+    assert await pushed_digest(hub, 'funcx/funcx_new', 'abc', 30) == 'sha256:m'
+    with pytest.raises(RegistryError, match='not in the registry'):
+        await pushed_digest(hub, 'funcx/funcx_new', 'missing', 30)
@@ -1,5 +1,9 @@
+import asyncio
+import time
+
 from fastapi.testclient import TestClient
 from funcx_container_service.__init__ import app
+from funcx_container_service.buildlog import BuildLog
 
 client = TestClient(app)
 
@@ -15,3 +19,89 @@ def test_read_verion():
     # pdb.set_trace()
     assert response.status_code == 200
     assert response.json()["version"] is not None
+
+
+def test_build_route_returns_ids(mocker):
+    mocker.patch('funcx_container_service.callback_router.update_status')
+    mocker.patch('funcx_container_service.scheduler.background_build')
+    mocker.patch('funcx_container_service.db.BuildStore.save')
+    spec = {'container_type': 'docker',
+            'container_id': '3f4a0b3c-5d8e-4f4a-9a0b-2c6e0f7d1a11',
+            'pip': ['flask']}
+    response = client.post("/build", json=spec)
+    assert response.status_code == 200
+    assert response.json()['container_id'] == spec['container_id']
+    assert response.json()['build_id'] is not None
+    assert response.json()['queue_position'] >= 1
+
+    info = client.get(f"/build/{response.json()['build_id']}")
+    assert info.status_code == 200
+    assert info.json()['queue_position'] >= 1
+
+
+def test_build_route_does_not_wait_for_status_update(mocker):
+    statuses = []
+
+    async def slow_update(container):
+        statuses.append(container.build_spec.build_status)
+        await asyncio.sleep(5)
+
+    mocker.patch('funcx_container_service.callback_router.update_status', side_effect=slow_update)
+    mocker.patch('funcx_container_service.scheduler.background_build')
+    mocker.patch('funcx_container_service.db.BuildStore.save')
+    spec = {'container_type': 'docker',
+            'container_id': '3f4a0b3c-5d8e-4f4a-9a0b-2c6e0f7d1a11',
+            'pip': ['requests']}
+    start = time.time()
+    response = client.post("/build", json=spec)
+    assert time.time() - start < 5
+    assert response.status_code == 200
+    assert response.json()['build_id'] is not None
+    assert statuses == ['queued']
+
+
+def test_build_info_unknown_build():
+    response = client.get("/build/not-a-build")
+    assert response.status_code == 404
+
+
+def test_stream_build_logs(mocker):
+    build_log = BuildLog(max_lines=10)
+    build_log.append('Step 1/2')
+    build_log.append('Step 2/2', stream='stdout')
+    build_log.close()
+    mocker.patch('funcx_container_service.scheduler.BuildScheduler.build_log', return_value=build_log)
+
+    response = client.get("/build/1234/logs")
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/event-stream')
+    assert 'id: 0\n' in response.text
+    assert '"line": "Step 2/2"' in response.text
+    assert response.text.endswith('event: end\ndata: {}\n\n')
+
+    response = client.get("/build/1234/logs", headers={'Last-Event-ID': '0'})
+    assert 'Step 1/2' not in response.text
+    assert 'Step 2/2' in response.text
+
+
+def test_stream_build_logs_from_saved_log(mocker, tmp_path):
+    build_id = '3f4a0b3c-5d8e-4f4a-9a0b-2c6e0f7d1a11'
+    build_log = BuildLog(max_lines=1)
+    build_log.save_to(str(tmp_path / f'{build_id}.log'))
+    build_log.append('Step 1/2')
+    build_log.append('Step 2/2')
+    build_log.close()
+    mocker.patch('funcx_container_service.scheduler.BuildScheduler.build_log', return_value=None)
+    mocker.patch('funcx_container_service.scheduler.BuildScheduler.log_path',
+                 return_value=str(tmp_path / f'{build_id}.log'))
+
+    response = client.get(f"/build/{build_id}/logs")
+    assert response.status_code == 200
+    assert '"line": "Step 1/2"' in response.text
+    assert 'id: 1\n' in response.text
+    assert response.text.endswith('event: end\ndata: {}\n\n')
+
+
+def test_stream_build_logs_unknown_build():
+    response = client.get("/build/not-a-build/logs")
+    assert response.status_code == 404
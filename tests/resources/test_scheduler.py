@@ -0,0 +1,235 @@
+import asyncio
+import tempfile
+import uuid
+
+import pytest
+
+from funcx_container_service import Settings
+from funcx_container_service.container import Container
+from funcx_container_service.models import ContainerSpec, BuildStatus
+from funcx_container_service.scheduler import BuildScheduler, SchedulerClosed
+from funcx_container_service import DOCKER_BASE_URL
+
+
+# Fixtures
+
+@pytest.fixture
+def settings_fixture():
+    settings = Settings()
+    settings.app_name = 'mocked_settings_app'
+    settings.admin_email = 'testing_admin@example.com'
+    return settings
+
+
+@pytest.fixture
+def make_container(settings_fixture):
+    def _make_container(pip=None, force_solve=False):
+        spec = ContainerSpec(container_type="docker",
+                             container_id=uuid.uuid4(),
+                             pip=pip or [f'package-{uuid.uuid4().hex}'],
+                             force_solve=force_solve)
+        return Container(spec,
+                         str(uuid.uuid4()),
+                         settings_fixture,
+                         tempfile.gettempdir(),
+                         DOCKER_BASE_URL)
+    return _make_container
+
+
+# Tests
+async def test_scheduler_limits_concurrency(make_container, mocker):
+    running = []
+    peak = []
+    started = []
+
+    async def fake_build(container):
+        started.append(container)
+        running.append(container)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(container)
+
+    mocker.patch('funcx_container_service.scheduler.background_build', side_effect=fake_build)
+
+    scheduler = BuildScheduler(max_concurrent_builds=2, shutdown_timeout=5)
+    containers = [make_container() for _ in range(5)]
+    positions = [await scheduler.submit(c) for c in containers]
+    assert positions == [1, 2, 3, 4, 5]
+
+    scheduler.start()
+    await scheduler.shutdown()
+
+    assert max(peak) == 2
+    assert started == containers
+    assert all(c.queue_wait_time is not None for c in containers)
+
+
+async def test_scheduler_reports_queue_position(make_container, mocker):
+    mocker.patch('funcx_container_service.scheduler.background_build')
+
+    scheduler = BuildScheduler(max_concurrent_builds=1, shutdown_timeout=5)
+    first, second = make_container(), make_container()
+    await scheduler.submit(first)
+    await scheduler.submit(second)
+
+    info = scheduler.build_info(str(second.build_spec.build_id))
+    assert info['queue_position'] == 2
+    assert info['queue_wait_time'] >= 0
+    assert scheduler.build_info(str(uuid.uuid4())) is None
+
+
+async def test_scheduler_rejects_after_shutdown(make_container, mocker):
+    mocker.patch('funcx_container_service.scheduler.background_build')
+
+    scheduler = BuildScheduler(max_concurrent_builds=1, shutdown_timeout=5)
+    scheduler.start()
+    await scheduler.shutdown()
+
+    with pytest.raises(SchedulerClosed):
+        await scheduler.submit(make_container())
+
+
+async def test_scheduler_fails_queued_builds_on_drain_timeout(make_container, mocker):
+    async def slow_build(container):
+        await asyncio.sleep(10)
+
+    mocker.patch('funcx_container_service.scheduler.background_build', side_effect=slow_build)
+    mocker.patch('funcx_container_service.callback_router.update_status')
+
+    scheduler = BuildScheduler(max_concurrent_builds=1, shutdown_timeout=0.05)
+    running, waiting = make_container(), make_container()
+    running.build_spec.build_status = BuildStatus.queued
+    waiting.build_spec.build_status = BuildStatus.queued
+    await scheduler.submit(running)
+    await scheduler.submit(waiting)
+    scheduler.start()
+    await asyncio.sleep(0)
+    await scheduler.shutdown()
+
+    assert waiting.build_spec.build_status == BuildStatus.failed
+
+
+async def test_scheduler_coalesces_identical_builds(make_container, mocker):
+    async def fake_build(container):
+        await asyncio.sleep(0.01)
+        container.build_spec.build_status = BuildStatus.ready
+
+    build = mocker.patch('funcx_container_service.scheduler.background_build', side_effect=fake_build)
+    attached = mocker.patch('funcx_container_service.scheduler.coalesced_build')
+
+    scheduler = BuildScheduler(max_concurrent_builds=2, shutdown_timeout=5)
+    leader = make_container(pip=['flask'])
+    followers = [make_container(pip=['flask']) for _ in range(3)]
+    other = make_container(pip=['numpy'])
+
+    assert await scheduler.submit(leader) == 1
+    assert [await scheduler.submit(c) for c in followers] == [1, 1, 1]
+    assert await scheduler.submit(other) == 2
+
+    info = scheduler.build_info(str(followers[0].build_spec.build_id))
+    assert info['coalesced_build_id'] == str(leader.build_spec.build_id)
+
+    scheduler.start()
+    await scheduler.shutdown()
+
+    assert [call.args[0] for call in build.call_args_list] == [leader, other]
+    assert sorted(id(call.args[0]) for call in attached.call_args_list) == sorted(id(c) for c in followers)
+    assert all(call.args[1] is leader for call in attached.call_args_list)
+
+
+async def test_scheduler_never_attaches_forced_solves(make_container, mocker):
+    build = mocker.patch('funcx_container_service.scheduler.background_build')
+    attached = mocker.patch('funcx_container_service.scheduler.coalesced_build')
+
+    scheduler = BuildScheduler(max_concurrent_builds=1, shutdown_timeout=5)
+    leader = make_container(pip=['flask'])
+    forced = make_container(pip=['flask'], force_solve=True)
+    follower = make_container(pip=['flask'])
+
+    assert await scheduler.submit(leader) == 1
+    assert await scheduler.submit(forced) == 2
+    assert await scheduler.submit(follower) == 1
+    assert scheduler.build_info(str(forced.build_spec.build_id))['coalesced_build_id'] is None
+
+    scheduler.start()
+    await scheduler.shutdown()
+
+    assert [call.args[0] for call in build.call_args_list] == [leader, forced]
+    assert [call.args[0] for call in attached.call_args_list] == [follower]
+
+
+async def test_attached_build_keeps_its_own_log(make_container, mocker):
+    async def fake_build(container):
+        container.build_log.append('Step 1/2')
+        await asyncio.sleep(0.01)
+        container.build_log.append('Step 2/2')
+
+    async def fake_coalesced_build(container, leader):
+        container.build_log.append('retagged and pushed', stream='push')
+
+    mocker.patch('funcx_container_service.scheduler.background_build', side_effect=fake_build)
+    mocker.patch('funcx_container_service.scheduler.coalesced_build', side_effect=fake_coalesced_build)
+
+    scheduler = BuildScheduler(max_concurrent_builds=1, shutdown_timeout=5)
+    leader = make_container(pip=['flask'])
+    follower = make_container(pip=['flask'])
+    await scheduler.submit(leader)
+    await scheduler.submit(follower)
+    follower_id = str(follower.build_spec.build_id)
+    assert scheduler.build_log(follower_id) is follower.build_log
+
+    scheduler.start()
+    await scheduler.shutdown()
+
+    assert scheduler.build_log(follower_id) is follower.build_log
+    assert [line for _, _, line in follower.build_log.lines] == ['Step 1/2', 'Step 2/2', 'retagged and pushed']
+    assert follower.build_log.closed
+
+
+async def test_log_stays_open_until_sif_conversion_is_done(make_container, mocker):
+    conversion = asyncio.Event()
+
+    async def convert(container):
+        container.build_log.append('INFO: Creating SIF file...', stream='sif')
+        await conversion.wait()
+        container.build_log.append('INFO: Build complete', stream='sif')
+
+    async def fake_build(container):
+        container.sif_task = asyncio.create_task(convert(container))
+
+    mocker.patch('funcx_container_service.scheduler.background_build', side_effect=fake_build)
+    scheduler = BuildScheduler(max_concurrent_builds=1, shutdown_timeout=5)
+    container = make_container()
+    await scheduler.submit(container)
+    scheduler.start()
+    await scheduler._queue.join()
+
+    assert not container.build_log.closed
+    conversion.set()
+    await container.sif_task
+    await asyncio.sleep(0)
+    assert container.build_log.closed
+    assert container.build_log.text(stream='sif') == 'INFO: Creating SIF file... INFO: Build complete'
+    await scheduler.shutdown()
+
+
+async def test_scheduler_saves_logs_and_forgets_old_builds(make_container, mocker, tmp_path):
+    async def fake_build(container):
+        container.build_log.append(f'building {container.build_spec.build_id}')
+
+    mocker.patch('funcx_container_service.scheduler.background_build', side_effect=fake_build)
+    scheduler = BuildScheduler(max_concurrent_builds=1, shutdown_timeout=5,
+                               log_dir=str(tmp_path / 'logs'), recent_builds=1)
+    first, second = make_container(), make_container()
+    await scheduler.submit(first)
+    await scheduler.submit(second)
+    scheduler.start()
+    await scheduler._queue.join()
+
+    first_id = str(first.build_spec.build_id)
+    assert scheduler.build_log(first_id) is None
+    assert scheduler.build_log(str(second.build_spec.build_id)) is second.build_log
+    with open(scheduler.log_path(first_id)) as f:
+        assert f'building {first_id}' in f.read()
+    assert scheduler.log_path('../builds') is None
+    await scheduler.shutdown()
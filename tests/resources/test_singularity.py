@@ -0,0 +1,113 @@
+import os
+import tempfile
+import uuid
+
+import pytest
+
+from funcx_container_service import DOCKER_BASE_URL
+from funcx_container_service.build import publish_image
+from funcx_container_service.cache import SifCache
+from funcx_container_service.config import Settings
+from funcx_container_service.container import Container
+from funcx_container_service.models import BuildStatus, CompletionSpec, ContainerSpec
+from funcx_container_service.singularity import SifConverter
+
+
+@pytest.fixture
+def settings_fixture():
+    settings = Settings()
+    settings.REGISTRY_USERNAME = 'funcx'
+    settings.REGISTRY_PWD = 'pwd'
+    settings.REGISTRY_URL = 'https://registry.example.com'
+    return settings
+
+
+@pytest.fixture
+def sif_cache(mocker):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = SifCache(cache_dir, max_size=1024 ** 2)
+        mocker.patch('funcx_container_service.singularity.sif_cache', cache)
+        yield cache
+
+
+@pytest.fixture
+def docker_client(mocker):
+    client = mocker.MagicMock()
+    client.inspect_image.return_value = {'Id': 'sha256:abc'}
+    mocker.patch('funcx_container_service.singularity.docker_clients.get', return_value=client)
+    return client
+
+
+def make_container(settings, temp_dir):
+    spec = ContainerSpec(container_type="singularity", container_id=uuid.uuid4(), pip=['numpy'])
+    container = Container(spec, str(uuid.uuid4()), settings, str(temp_dir), DOCKER_BASE_URL)
+    container.completion_spec = CompletionSpec(docker_client_version='1.0', spec_digest=spec.digest())
+    return container
+
+
+def write_sif(process):
+    with open(process.args[3], 'wb') as f:
+        f.write(b'SIF' * 100)
+
+
+async def test_sif_converted_cached_and_pushed(settings_fixture, sif_cache, docker_client, fp, tmp_path):
+    fp.register(['singularity', 'build', '--force', fp.any()], callback=write_sif)
+    fp.register(['singularity', 'push', fp.any()])
+    fp.keep_last_process(True)
+    converter = SifConverter(max_concurrent=1)
+
+    first = make_container(settings_fixture, tmp_path)
+    await converter.publish(first)
+
+    uri = f'oras://registry.example.com/funcx/{first.image_name}:sif'
+    assert first.completion_spec.sif_cache_hit is False
+    assert first.completion_spec.sif_size == 300
+    assert first.completion_spec.sif_conversion_time is not None
+    assert first.completion_spec.sif_uri == uri
+    assert first.completion_spec.sif_pull_command == f'singularity pull {uri}'
+    assert fp.call_count(['singularity', 'build', '--force', fp.any(),
+                          f'docker-daemon://{first.image_name}:latest']) == 1
+    assert fp.call_count(['singularity', 'push', sif_cache.sif_path(first.completion_spec.spec_digest), uri]) == 1
+
+    second = make_container(settings_fixture, tmp_path)
+    await converter.publish(second)
+
+    assert second.completion_spec.sif_cache_hit is True
+    assert second.completion_spec.sif_conversion_time is None
+    assert fp.call_count(['singularity', 'build', fp.any()]) == 1
+    assert fp.call_count(['singularity', 'push', fp.any()]) == 2
+    assert converter._digest_locks == {}
+
+
+async def test_sif_rebuilt_for_new_image(settings_fixture, sif_cache, docker_client, fp, tmp_path):
+    settings_fixture.REGISTRY_USERNAME = None
+    fp.register(['singularity', 'build', '--force', fp.any()], callback=write_sif)
+    fp.keep_last_process(True)
+    converter = SifConverter(max_concurrent=1)
+
+    await converter.publish(make_container(settings_fixture, tmp_path))
+    docker_client.inspect_image.return_value = {'Id': 'sha256:def'}
+    container = make_container(settings_fixture, tmp_path)
+    await converter.publish(container)
+
+    assert container.completion_spec.sif_cache_hit is False
+    assert container.completion_spec.sif_uri is None
+    assert fp.call_count(['singularity', 'build', fp.any()]) == 2
+
+
+async def test_failed_sif_fails_build(settings_fixture, sif_cache, docker_client, mocker, fp, tmp_path):
+    fp.register(['singularity', 'build', '--force', fp.any()], returncode=1, stderr=['FATAL: no space left'])
+    container = make_container(settings_fixture, tmp_path)
+    mocker.patch.object(container, 'push_image')
+    update_status = mocker.patch.object(container, 'update_status')
+    log_error = mocker.patch.object(container, 'log_error')
+    converter = SifConverter(max_concurrent=1)
+    mocker.patch('funcx_container_service.build.sif_converter', converter)
+
+    await publish_image(container)
+    update_status.assert_not_called()
+    await converter.drain(timeout=5)
+
+    assert BuildStatus.ready not in [call.args[0] for call in update_status.call_args_list]
+    assert 'no space left' in log_error.call_args.args[0]
+    assert os.listdir(os.path.join(sif_cache.cache_dir, 'tmp')) == []